@@ -1,17 +1,26 @@
-from fastapi import APIRouter, HTTPException, Query, Depends
-from typing import List
-from ..services.llm import analyze_note_with_llm
+from fastapi import APIRouter, Header, HTTPException, Query, Depends, Request
+from typing import List, Optional
+from ..services.llm_scheduler import INTERACTIVE, scheduled_analysis
 from ..core.security import get_current_user
 from ..db.models import User
 from ..services.wikipedia import populate_knowledge_base_from_keywords
 from ..services.hierarchy import create_hierarchical_graph
-from ..db.neo4j import get_neo4j_driver
+from ..db.tenancy import tenant_session
 from ..db.elastic import get_es
 from ..core.config import get_settings
 from ..models.schemas import GraphNode, GraphLink, GraphData
-from ..services.knowledge import upsert_node, link_nodes, search_nodes_by_keywords, graph_from_cypher_records
-from ..services.node_matching import normalize_for_id, find_matching_node, merge_node_data
+from ..services.knowledge import upsert_node, link_nodes, search_nodes_by_keywords
+from ..services.node_matching import normalize_for_id, find_matching_node, merge_node_data, compact_summary, rank_items
 from ..services.prompt_injection_filter import sanitize_content, detect_injection_attempt
+from ..services.graph_codec import GRAPH_FORMATS, graph_response
+from ..services.indexing import index_node, delete_node as delete_node_document
+from ..services.graph_events import GraphChange, publish
+from ..services.realtime import notify_analysis
+from ..services.adjacency import neighborhood
+from ..services.write_behind import get_write_buffer, overlay
+from ..services import quota
+from ..services.idempotency import IDEMPOTENCY_HEADER, fingerprint, run_idempotent
+from ..services.admission import admit
 import hashlib
 import logging
 
@@ -20,16 +29,29 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/analyze", tags=["analyze"])
 
+ANALYSIS_RETRY_AFTER = 30  # секунд до повтора после неудачного анализа
 
-@router.post("/note")
-async def analyze_note(
+
+@router.post("/note", dependencies=[Depends(admit("llm"))])
+def analyze_note(
     content: str = Query(..., min_length=10),
     note_id: str = Query(None),  # Optional note ID for tracking
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER, max_length=255),
     current_user: User = Depends(get_current_user)
 ):
     """
-    Анализирует заметку с помощью LLM и создает/связывает узлы графа знаний
+    Анализирует заметку с помощью LLM и создает/связывает узлы графа знаний.
+    С заголовком Idempotency-Key повтор запроса получает сохраненный ответ
     """
+    return run_idempotent(
+        str(current_user.id),
+        idempotency_key,
+        fingerprint("analyze_note", content, note_id),
+        lambda: _analyze_note(content, note_id, current_user),
+    )
+
+
+def _analyze_note(content: str, note_id: Optional[str], current_user: User):
     # Ограничение длины контента
     if len(content) > 2000:
         raise HTTPException(
@@ -49,16 +71,55 @@ async def analyze_note(
                 detail="Content contains prohibited instructions and cannot be processed"
             )
 
+    # Квота резервируется до вызова LLM, чтобы не тратить токены впустую
+    reservation = None
+    try:
+        reservation = quota.reserve(str(current_user.id))
+    except quota.QuotaExceeded as e:
+        raise _quota_error(e)
+    except Exception as e:
+        logger.error(f"Error reserving node quota: {e}")
+        # Продолжаем выполнение, если не удалось проверить лимит
+
+    try:
+        return _analyze_reserved(content, note_id, current_user, reservation)
+    finally:
+        if reservation is not None:
+            try:
+                quota.release(reservation)
+            except Exception as e:
+                logger.error(f"Error releasing node quota reservation: {e}")
+
+
+def _quota_error(e: quota.QuotaExceeded) -> HTTPException:
+    if e.remaining <= 0:
+        return HTTPException(
+            status_code=429,
+            detail=f"🚫 Лимит узлов исчерпан! За последние {e.window_hours} ч создано уже {e.used} узлов "
+                   f"из {e.limit}. Пожалуйста, берегите токены автора - проект может развалиться на этапе "
+                   "бутстрэппинга. Попробуйте через пару дней."
+        )
+    return HTTPException(
+        status_code=429,
+        detail=f"⚠️ Почти достигнут лимит! За последние {e.window_hours} ч создано {e.used} узлов. "
+               f"Можно создать еще только {e.remaining} узл(ов). "
+               "Берегите токены автора - проект может развалиться на этапе бутстрэппинга!"
+    )
+
+
+def _analyze_reserved(content: str, note_id: Optional[str], current_user: User, reservation):
+    settings = get_settings()
     # Анализ с помощью LLM
-    analysis = analyze_note_with_llm(content)
+    notify_analysis(str(current_user.id), "started", note_id=note_id)
+    analysis = scheduled_analysis(str(current_user.id), content, INTERACTIVE)
     if not analysis:
-        return {
-            "tags": [],
-            "nodes": [],
-            "links": [],
-            "model_used": "none",
-            "main_topic": "Анализ не удался"
-        }
+        notify_analysis(str(current_user.id), "failed", note_id=note_id)
+        # Ошибка, а не пустой ответ: не сохраняется под Idempotency-Key, повтор выполнит анализ заново
+        raise HTTPException(
+            status_code=503,
+            detail="Анализ не удался: LLM недоступна. Попробуйте позже.",
+            headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+        )
 
     # Обработка НОВОГО формата (concepts/relationships)
     concepts = analysis.get("concepts", [])
@@ -68,85 +129,71 @@ async def analyze_note(
     model_used = analysis.get("model_used", "unknown")
     
     logger.info(f"Analysis completed. Model: {model_used}, Topic: {main_topic}, Concepts: {len(concepts)}")
+    notify_analysis(
+        str(current_user.id), "llm_done", note_id=note_id, main_topic=main_topic, concepts=len(concepts)
+    )
+    
+    # Резерв покрывает только часть концептов: расширяем до их числа
+    if reservation is not None:
+        try:
+            quota.extend(reservation, len(concepts))
+        except quota.QuotaExceeded as e:
+            raise _quota_error(e)
+        except Exception as e:
+            logger.error(f"Error extending node quota reservation: {e}")
+
+    # Создаем узлы из концептов
+    created_nodes = []
+    links = []
+    node_id_map = {}  # map concept_id -> node_id
+    staged_ids = set()  # обновления в буфере: событие о них публикует запись буфера
+    new_nodes_count = 0  # для квоты: узлы, которых раньше не было
     
-    # Проверка лимита узлов за последние 2 дня
-    driver = get_neo4j_driver()
     try:
-        with driver.session() as session:
-            # Подсчитываем количество новых узлов, которые будут созданы
-            new_nodes_count = len(concepts)
-            
-            # Подсчитываем количество узлов, созданных за последние 2 дня
-            # Используем упрощенный запрос - считаем узлы с created_at за последние 2 дня
-            nodes_created_result = session.run(
+        with tenant_session(str(current_user.id)) as session:
+            # Получаем все существующие узлы пользователя для сопоставления
+            existing_nodes_result = session.run(
                 """
                 MATCH (n:Node {user_id: $user_id})
-                WHERE n.created_at IS NOT NULL
-                AND n.created_at >= datetime() - duration({days: 2})
-                RETURN count(n) AS node_count
+                RETURN n.id AS id, n.label AS label, n.summary AS summary,
+                       n.knowledge_gaps AS knowledge_gaps, n.recommendations AS recommendations,
+                       n.tags AS tags, n.has_gap AS has_gap, n.level AS level, n.pagerank AS pagerank
                 """,
                 user_id=str(current_user.id)
             )
-            record = nodes_created_result.single()
-            nodes_created_last_2_days = record["node_count"] if record else 0
+            # Вместе с еще не записанными обновлениями из буфера
+            existing_nodes = [overlay(str(current_user.id), dict(record)) for record in existing_nodes_result]
+            existing_by_id = {n["id"]: n for n in existing_nodes}
+            logger.info(f"Found {len(existing_nodes)} existing nodes for matching")
             
-            # Если запрос не сработал (старые узлы без created_at), считаем все узлы
-            # но только если их больше 30 (тогда применяем лимит)
-            if nodes_created_last_2_days == 0:
-                total_nodes_result = session.run(
-                    """
-                    MATCH (n:Node {user_id: $user_id})
-                    RETURN count(n) AS total_count
-                    """,
-                    user_id=str(current_user.id)
-                )
-                total_record = total_nodes_result.single()
-                total_nodes = total_record["total_count"] if total_record else 0
-                
-                # Если узлов больше 30, считаем что лимит достигнут (старые узлы)
-                if total_nodes >= 100:
-                    nodes_created_last_2_days = 100
+            # Сопоставляем концепты с существующими узлами один раз
+            concept_matches = {}
+            for concept in concepts:
+                label = concept.get("label", "")
+                # Порог 0.9 для избежания ложных совпадений
+                matching_node = find_matching_node(label, existing_nodes, threshold=0.9)
+                if not matching_node:
+                    # Пробуем также найти по нормализованному ID
+                    stable_id = hashlib.md5(f"{normalize_for_id(label)}_{current_user.id}".encode()).hexdigest()[:16]
+                    if stable_id in existing_by_id:
+                        logger.info(f"Found exact ID match: '{label}' -> node_id={stable_id}")
+                        matching_node = (stable_id, 1.0)
+                concept_matches[concept.get("id", "")] = matching_node
             
-            # Проверяем лимит
-            MAX_NODES_PER_2_DAYS = 100
-            if nodes_created_last_2_days + new_nodes_count > MAX_NODES_PER_2_DAYS:
-                remaining = MAX_NODES_PER_2_DAYS - nodes_created_last_2_days
-                if remaining <= 0:
-                    raise HTTPException(
-                        status_code=429,
-                        detail="🚫 Лимит узлов исчерпан! За последние 2 дня создано уже 100 узлов. "
-                               "Пожалуйста, берегите токены автора - проект может развалиться на этапе бутстрэппинга"
-                               "Попробуйте через пару дней или удалите старые узлы."
-                    )
-                else:
-                    raise HTTPException(
-                        status_code=429,
-                        detail=f"⚠️ Почти достигнут лимит! За последние 2 дня создано {nodes_created_last_2_days} узлов. "
-                               f"Можно создать еще только {remaining} узл(ов). "
-                               "Берегите токены автора - проект может развалиться на этапе бутстрэппинга!"
-                    )
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error checking node limit: {e}")
-        # Продолжаем выполнение, если не удалось проверить лимит
-    
-    # Создаем узлы из концептов
-    created_nodes = []
-    node_id_map = {}  # map concept_id -> node_id
-    
-    try:
-        with driver.session() as session:
-            # Сначала определяем главный концепт (с наибольшим количеством связей)
-            concept_connections = {}
+            # Главный концепт: связи внутри заметки плюс центральность уже
+            # существующего узла во всем графе (PageRank, в среднем 1)
+            concept_scores = {}
             for rel in relationships:
                 source = rel.get("source", "")
                 target = rel.get("target", "")
-                concept_connections[source] = concept_connections.get(source, 0) + 1
-                concept_connections[target] = concept_connections.get(target, 0) + 1
+                concept_scores[source] = concept_scores.get(source, 0) + 1
+                concept_scores[target] = concept_scores.get(target, 0) + 1
+            for concept_id, matching_node in concept_matches.items():
+                if matching_node and concept_id in concept_scores:
+                    pagerank = existing_by_id.get(matching_node[0], {}).get("pagerank") or 0
+                    concept_scores[concept_id] += pagerank
             
-            # Главный концепт - тот, у которого больше всего связей
-            main_concept_id = max(concept_connections.items(), key=lambda x: x[1])[0] if concept_connections else (concepts[0].get("id", "") if concepts else "")
+            main_concept_id = max(concept_scores.items(), key=lambda x: x[1])[0] if concept_scores else (concepts[0].get("id", "") if concepts else "")
             
             # Строим граф связей для определения уровней
             adjacency = {}
@@ -173,19 +220,6 @@ async def analyze_note(
                             visited.add(neighbor)
                             queue.append((neighbor, level + 1))
             
-            # Получаем все существующие узлы пользователя для сопоставления
-            existing_nodes_result = session.run(
-                """
-                MATCH (n:Node {user_id: $user_id})
-                RETURN n.id AS id, n.label AS label, n.summary AS summary,
-                       n.knowledge_gaps AS knowledge_gaps, n.recommendations AS recommendations,
-                       n.tags AS tags, n.has_gap AS has_gap, n.level AS level
-                """,
-                user_id=str(current_user.id)
-            )
-            existing_nodes = [dict(record) for record in existing_nodes_result]
-            logger.info(f"Found {len(existing_nodes)} existing nodes for matching")
-            
             # Создаем/обновляем узлы для каждого концепта
             for concept in concepts:
                 concept_id = concept.get("id", "")
@@ -201,16 +235,7 @@ async def analyze_note(
                 
                 logger.debug(f"Processing concept: '{label}' -> normalized: '{normalized_label}' -> stable_id: {stable_id}")
                 
-                # Пытаемся найти существующий похожий узел (порог 0.9 для избежания ложных совпадений)
-                matching_node = find_matching_node(label, existing_nodes, threshold=0.9)
-                if not matching_node:
-                    # Пробуем также найти по нормализованному ID
-                    for existing_node in existing_nodes:
-                        existing_id = existing_node.get("id", "")
-                        if existing_id == stable_id:
-                            logger.info(f"Found exact ID match: '{label}' -> node_id={stable_id}")
-                            matching_node = (stable_id, 1.0)
-                            break
+                matching_node = concept_matches.get(concept_id)
                 existing_node_data = None
                 merged_data = None
                 if matching_node:
@@ -258,52 +283,78 @@ async def analyze_note(
                     existing_gaps = existing_node["gaps"] if existing_node and existing_node["gaps"] else []
                     existing_recs = existing_node["recs"] if existing_node and existing_node["recs"] else []
                     
-                    # Объединяем пробелы и рекомендации (убираем дубликаты)
-                    merged_gaps = list(set(existing_gaps + knowledge_gaps))
-                    merged_recs = list(set(existing_recs + recommendations))
+                    # Объединяем пробелы и рекомендации: новые первыми, без
+                    # почти повторов, не больше лимита (node_max_gaps/recommendations)
+                    merged_gaps = rank_items(knowledge_gaps + existing_gaps, settings.node_max_gaps)
+                    merged_recs = rank_items(recommendations + existing_recs, settings.node_max_recommendations)
+                    description = compact_summary(description)
                 
                 # Проверяем, есть ли пробелы знаний
                 has_gap = len(merged_gaps) > 0 or len(merged_recs) > 0
                 
-                # Upsert узел в Neo4j
-                result = session.run(
-                    """
-                    MERGE (n:Node {id: $id, user_id: $user_id})
-                    ON CREATE SET 
-                        n.label = $label,
-                        n.summary = $description,
-                        n.tags = $tags,
-                        n.created_at = datetime(),
-                        n.has_gap = $has_gap,
-                        n.level = $level,
-                        n.knowledge_gaps = $gaps,
-                        n.recommendations = $recs
-                    ON MATCH SET
-                        n.summary = CASE WHEN n.summary IS NULL OR n.summary = '' THEN $description ELSE n.summary END,
-                        n.updated_at = datetime(),
-                        n.has_gap = CASE WHEN size($gaps) > 0 OR size($recs) > 0 THEN true ELSE n.has_gap END,
-                        n.knowledge_gaps = $gaps,
-                        n.recommendations = $recs,
-                        n.level = CASE WHEN $level < n.level OR n.level IS NULL THEN $level ELSE n.level END
-                    WITH n
-                    OPTIONAL MATCH (note:Note {id: $note_id}) 
-                    WHERE $note_id IS NOT NULL
-                    FOREACH(_ IN CASE WHEN note IS NOT NULL THEN [1] ELSE [] END |
-                        MERGE (n)-[:MENTIONED_IN]->(note)
+                write_buffer = get_write_buffer()
+                if existing_node_data and write_buffer is not None:
+                    # Обновление существующего узла сливается с соседними
+                    # в буфере и пишется пакетом (services.write_behind)
+                    staged_ids.add(stable_id)
+                    write_buffer.stage(str(current_user.id), stable_id, {
+                        "summary": description,
+                        "knowledge_gaps": merged_gaps,
+                        "recommendations": merged_recs,
+                        "has_gap": has_gap,
+                        "level": level,
+                    })
+                    if note_id is not None:
+                        session.run(
+                            """
+                            MATCH (n:Node {id: $id, user_id: $user_id}), (note:Note {id: $note_id})
+                            MERGE (n)-[:MENTIONED_IN]->(note)
+                            """,
+                            id=stable_id,
+                            user_id=str(current_user.id),
+                            note_id=note_id,
+                        )
+                else:
+                    # Upsert узел в Neo4j
+                    result = session.run(
+                        """
+                        MERGE (n:Node {id: $id, user_id: $user_id})
+                        ON CREATE SET 
+                            n.label = $label,
+                            n.summary = $description,
+                            n.tags = $tags,
+                            n.created_at = datetime(),
+                            n.has_gap = $has_gap,
+                            n.level = $level,
+                            n.knowledge_gaps = $gaps,
+                            n.recommendations = $recs
+                        ON MATCH SET
+                            n.summary = CASE WHEN n.summary IS NULL OR n.summary = '' THEN $description ELSE n.summary END,
+                            n.updated_at = datetime(),
+                            n.has_gap = CASE WHEN size($gaps) > 0 OR size($recs) > 0 THEN true ELSE n.has_gap END,
+                            n.knowledge_gaps = $gaps,
+                            n.recommendations = $recs,
+                            n.level = CASE WHEN $level < n.level OR n.level IS NULL THEN $level ELSE n.level END
+                        WITH n
+                        OPTIONAL MATCH (note:Note {id: $note_id}) 
+                        WHERE $note_id IS NOT NULL
+                        FOREACH(_ IN CASE WHEN note IS NOT NULL THEN [1] ELSE [] END |
+                            MERGE (n)-[:MENTIONED_IN]->(note)
+                        )
+                        RETURN n
+                        """,
+                        id=stable_id,
+                        user_id=str(current_user.id),
+                        label=label,
+                        description=description,
+                        tags=concept_tags,
+                        note_id=note_id,
+                        has_gap=has_gap,
+                        level=level,
+                        gaps=merged_gaps,
+                        recs=merged_recs
                     )
-                    RETURN n
-                    """,
-                    id=stable_id,
-                    user_id=str(current_user.id),
-                    label=label,
-                    description=description,
-                    tags=concept_tags,
-                    note_id=note_id,
-                    has_gap=has_gap,
-                    level=level,
-                    gaps=merged_gaps,
-                    recs=merged_recs
-                )
+                    new_nodes_count += result.consume().counters.nodes_created
                 
                 node_id_map[concept_id] = stable_id
                 created_nodes.append({
@@ -318,7 +369,6 @@ async def analyze_note(
                 })
             
             # Создаем связи между узлами
-            links = []
             for rel in relationships:
                 source_concept_id = rel.get("source", "")
                 target_concept_id = rel.get("target", "")
@@ -348,46 +398,45 @@ async def analyze_note(
                         "relation": rel_type
                     })
             
-            # Эволюция узлов: если у узла первого уровня большая подветка, превращаем его в центральный
-            for node_id in node_id_map.values():
-                # Подсчитываем количество связей (исходящих и входящих)
-                result = session.run(
-                    """
-                    MATCH (n:Node {id: $node_id, user_id: $user_id})-[r:RELATED]-(connected:Node {user_id: $user_id})
-                    WITH n, count(r) AS connection_count
-                    MATCH (n)-[out:RELATED]->(outgoing:Node {user_id: $user_id})
-                    WITH n, connection_count, count(out) AS outgoing_count
-                    RETURN n.level AS level, connection_count, outgoing_count
-                    """,
-                    node_id=node_id,
-                    user_id=str(current_user.id)
-                )
-                record = result.single()
-                if record:
-                    connection_count = record["connection_count"] or 0
-                    outgoing_count = record["outgoing_count"] or 0
-                    current_level = record["level"] or 0
-                    
-                    # Если у узла первого уровня больше 5 связей или больше 3 исходящих, делаем его центральным
-                    if current_level == 1 and (connection_count >= 5 or outgoing_count >= 3):
-                        session.run(
-                            """
-                            MATCH (n:Node {id: $node_id, user_id: $user_id})
-                            SET n.level = 0
-                            """,
-                            node_id=node_id,
-                            user_id=str(current_user.id)
-                        )
-                        logger.info(f"Node {node_id} evolved to level 0 (central) due to {connection_count} connections")
-            
-        logger.info(f"Created {len(created_nodes)} nodes and {len(links)} links")
-        
     except Exception as e:
         logger.error(f"Failed to create graph: {e}")
         logger.exception(e)
-        created_nodes = []
-        links = []
+        write_failed = True
+    else:
+        write_failed = False
+        logger.info(f"Created {len(created_nodes)} nodes and {len(links)} links")
+
+    # Узлы и связи, записанные до сбоя, тоже индексируются и публикуются.
+    # Уровни по центральности во всем графе пересчитываются в фоне
+    # (services.centrality) по событию ниже
+    for node in created_nodes:
+        index_node(node, str(current_user.id))
+    change = GraphChange(
+        str(current_user.id),
+        upserted_nodes={node["id"] for node in created_nodes} - staged_ids,
+        upserted_links=[(link["source"], link["target"], link["relation"]) for link in links],
+    )
+    if not change.empty:
+        publish(change)
 
+    # Списываются узлы, созданные до сбоя, если он был; остаток резерва освобождается
+    if reservation is not None:
+        try:
+            quota.commit(reservation, new_nodes_count)
+        except Exception as e:
+            logger.error(f"Error committing node quota: {e}")
+
+    if write_failed:
+        notify_analysis(str(current_user.id), "failed", note_id=note_id)
+        # Как и при сбое LLM: ошибка не сохраняется под Idempotency-Key, повтор
+        # допишет граф (узлы сопоставляются с уже созданными)
+        raise HTTPException(
+            status_code=503,
+            detail="Анализ не удался: ошибка записи графа. Попробуйте позже.",
+            headers={"Retry-After": str(ANALYSIS_RETRY_AFTER)},
+        )
+
+    notify_analysis(str(current_user.id), "done", note_id=note_id, nodes=len(created_nodes), links=len(links))
     return {
         "main_topic": main_topic,
         "tags": tags if tags else ["общее"],
@@ -397,25 +446,22 @@ async def analyze_note(
     }
 
 
+@router.get("/quota")
+def get_quota(current_user: User = Depends(get_current_user)):
+    """Квота новых узлов: лимит тарифа, использовано за окно (с резервами), остаток"""
+    return quota.usage(str(current_user.id))
+
+
 @router.get("/graph/{node_id}", response_model=GraphData)
 def get_node_graph(
     node_id: str,
+    request: Request,
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
     current_user: User = Depends(get_current_user)
 ):
-    """Получает граф вокруг узла"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
-        records = session.run(
-            """
-            MATCH (a:Node {id: $id, user_id: $user_id})-[r:RELATED|contains|related_to]-(b:Node {user_id: $user_id})
-            RETURN a, r, b
-            LIMIT 50
-            """,
-            id=node_id,
-            user_id=str(current_user.id)
-        )
-        data = graph_from_cypher_records(records)
-    return data
+    """Получает граф вокруг узла (до 50 связей, из кэша смежности)"""
+    data = neighborhood(str(current_user.id), node_id, limit=50) or {"nodes": [], "links": []}
+    return graph_response(request, format, data)
 
 
 @router.get("/node/{node_id}/notes")
@@ -424,8 +470,7 @@ def get_node_notes(
     current_user: User = Depends(get_current_user)
 ):
     """Получает список заметок, в которых упоминается узел"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         result = session.run(
             """
             MATCH (n:Node {id: $node_id, user_id: $user_id})-[:MENTIONED_IN]->(note:Note)
@@ -447,7 +492,6 @@ def update_node(
     current_user: User = Depends(get_current_user)
 ):
     """Обновляет узел графа"""
-    driver = get_neo4j_driver()
     updates = []
     params = {"node_id": node_id, "user_id": str(current_user.id)}
     
@@ -461,7 +505,7 @@ def update_node(
     if not updates:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         result = session.run(
             f"""
             MATCH (n:Node {{id: $node_id, user_id: $user_id}})
@@ -470,8 +514,11 @@ def update_node(
             """,
             **params
         )
-        if not result.single():
+        record = result.single()
+        if not record:
             raise HTTPException(status_code=404, detail="Node not found")
+        index_node(dict(record["n"]), str(current_user.id))
+    publish(GraphChange(str(current_user.id), upserted_nodes={node_id}))
     
     return {"status": "updated", "node_id": node_id}
 
@@ -482,8 +529,7 @@ def delete_node(
     current_user: User = Depends(get_current_user)
 ):
     """Удаляет узел графа и все его связи"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         result = session.run(
             """
             MATCH (n:Node {id: $node_id, user_id: $user_id})
@@ -496,5 +542,7 @@ def delete_node(
         record = result.single()
         if not record or record["deleted"] == 0:
             raise HTTPException(status_code=404, detail="Node not found")
+    delete_node_document(node_id, str(current_user.id))
+    publish(GraphChange(str(current_user.id), deleted_nodes={node_id}))
     
     return {"status": "deleted", "node_id": node_id}
@@ -1,9 +1,34 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Dict, Iterator, List, Optional, Tuple
 from pydantic import BaseModel
-from ..db.neo4j import get_neo4j_driver
-from ..models.schemas import GraphNode, GraphLink, GraphData
-from ..services.knowledge import upsert_node, link_nodes, graph_from_cypher_records
+import orjson
+from ..db.tenancy import tenant_session
+from ..models.schemas import GraphNode, GraphLink, GraphData, LearningPath
+from ..services.knowledge import (
+    upsert_node,
+    link_nodes,
+    graph_dict_from_cypher_records,
+    iter_user_graph,
+    GRAPH_RELATION_TYPES,
+)
+from ..services.indexing import index_node, delete_node as delete_node_document
+from ..services.graph_events import GraphChange, publish
+from ..services.clustering import graph_overview, cluster_members
+from ..services.layout import get_layout_worker
+from ..services.changelog import changes_since, current_seq
+from ..services.adjacency import neighborhood, bounded_subgraph, get_adjacency_cache
+from ..services.paths import learning_path
+from ..services import quota
+from ..services.graph_codec import (
+    GRAPH_FORMATS,
+    NDJSON_MEDIA_TYPE,
+    COMPACT_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+    negotiate_format,
+    compact_response,
+    graph_response,
+)
 from ..core.security import get_current_user
 from ..db.models import User
 
@@ -20,9 +45,11 @@ def create_or_update_node(
     node: GraphNode,
     current_user: User = Depends(get_current_user)
 ):
-    driver = get_neo4j_driver()
-    with driver.session() as session:
-        upsert_node(session, node, user_id=str(current_user.id))
+    with tenant_session(str(current_user.id)) as session:
+        created = upsert_node(session, node, user_id=str(current_user.id))
+    index_node(node.model_dump(), str(current_user.id))
+    quota.record(str(current_user.id), created)
+    publish(GraphChange(str(current_user.id), upserted_nodes={node.id}))
     return node
 
 
@@ -31,9 +58,9 @@ def create_link(
     link: GraphLink,
     current_user: User = Depends(get_current_user)
 ):
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         link_nodes(session, link.source, link.target, link.relation, user_id=str(current_user.id))
+    publish(GraphChange(str(current_user.id), upserted_links=[(link.source, link.target, link.relation)]))
     return link
 
 
@@ -43,8 +70,7 @@ def delete_node(
     current_user: User = Depends(get_current_user)
 ):
     """Удаляет узел графа и все его связи"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         result = session.run(
             """
             MATCH (n:Node {id: $node_id, user_id: $user_id})
@@ -57,6 +83,8 @@ def delete_node(
         record = result.single()
         if not record or record["deleted"] == 0:
             raise HTTPException(status_code=404, detail="Node not found")
+    delete_node_document(node_id, str(current_user.id))
+    publish(GraphChange(str(current_user.id), deleted_nodes={node_id}))
     
     return {"status": "deleted", "node_id": node_id}
 
@@ -68,8 +96,7 @@ def update_node(
     current_user: User = Depends(get_current_user)
 ):
     """Обновляет узел графа"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    with tenant_session(str(current_user.id)) as session:
         result = session.run(
             """
             MATCH (n:Node {id: $node_id, user_id: $user_id})
@@ -89,56 +116,109 @@ def update_node(
             has_gap=node.has_gap,
             level=node.level
         )
-        if not result.single():
+        record = result.single()
+        if not record:
             raise HTTPException(status_code=404, detail="Node not found")
+    index_node(dict(record["n"]), str(current_user.id))
+    publish(GraphChange(str(current_user.id), upserted_nodes={node_id}))
     
     return node
 
 
-@router.get("/all", response_model=GraphData)
+STREAM_CHUNK_SIZE = 64 * 1024
+GRAPH_SEQ_HEADER = "X-Graph-Seq"
+
+
+def _chunked(parts: Iterator[bytes], size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Склеивает мелкие части в куски ~size байт, чтобы не слать по записи на чанк"""
+    buffer = bytearray()
+    for part in parts:
+        buffer += part
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def _layout_checked(items: Iterator[Tuple[str, Dict]], user_id: str) -> Iterator[Tuple[str, Dict]]:
+    """Пропускает поток графа; если у узлов нет координат - ставит раскладку в очередь"""
+    missing = False
+    for kind, item in items:
+        if kind == "node" and "x" not in item:
+            missing = True
+        yield kind, item
+    if missing:
+        get_layout_worker().schedule(user_id)
+
+
+def _graph_json(user_id: str) -> Iterator[bytes]:
+    # Узлы пишутся по мере чтения, связи (три короткие строки) копятся до конца
+    links: List[bytes] = []
+    first = True
+    with tenant_session(user_id) as session:
+        yield b'{"nodes":['
+        for kind, item in _layout_checked(iter_user_graph(session, user_id), user_id):
+            if kind == "node":
+                yield (b"" if first else b",") + orjson.dumps(item)
+                first = False
+            else:
+                links.append(orjson.dumps(item))
+    yield b'],"links":[' + b",".join(links) + b"]}"
+
+
+def _graph_ndjson(user_id: str) -> Iterator[bytes]:
+    with tenant_session(user_id) as session:
+        for kind, item in _layout_checked(iter_user_graph(session, user_id), user_id):
+            yield orjson.dumps({"type": kind, **item}) + b"\n"
+
+
+@router.get(
+    "/all",
+    response_class=StreamingResponse,
+    responses={200: {"content": {
+        "application/json": {}, NDJSON_MEDIA_TYPE: {}, COMPACT_MEDIA_TYPE: {}, MSGPACK_MEDIA_TYPE: {},
+    }}},
+)
 def get_all_graph(
+    request: Request,
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
     current_user: User = Depends(get_current_user)
 ):
-    """Получает весь граф пользователя"""
-    driver = get_neo4j_driver()
-    with driver.session() as session:
-        # Получаем все узлы
-        nodes_result = session.run(
-            """
-            MATCH (n:Node {user_id: $user_id})
-            RETURN n
-            """,
-            user_id=str(current_user.id)
-        )
-        
-        # Получаем все связи
-        links_result = session.run(
-            """
-            MATCH (a:Node {user_id: $user_id})-[r:RELATED|contains|related_to]-(b:Node {user_id: $user_id})
-            RETURN a, r, b
-            """,
-            user_id=str(current_user.id)
-        )
-        
-        # Объединяем результаты
-        all_records = list(links_result)
-        # Добавляем узлы без связей
-        for node_rec in nodes_result:
-            node = node_rec["n"]
-            # Проверяем, есть ли уже этот узел в связях
-            found = False
-            for rec in all_records:
-                if rec.get("a") and rec["a"].id == node.id:
-                    found = True
-                    break
-                if rec.get("b") and rec["b"].id == node.id:
-                    found = True
-                    break
-            if not found:
-                all_records.append({"a": node, "r": None, "b": None})
-        
-        data = graph_from_cypher_records(all_records)
-    return data
+    """
+    Получает весь граф пользователя в формате GraphData, потоково.
+    ?format=ndjson (или Accept: application/x-ndjson) - по строке на узел/связь,
+    ?format=compact|msgpack - колоночный формат (см. services.graph_codec).
+    Узлы несут координаты x/y серверной раскладки, если она уже посчитана.
+    Заголовок X-Graph-Seq - позиция журнала изменений для /graph/changes
+    """
+    user_id = str(current_user.id)
+    # seq читается до снимка графа: изменения между ними клиент получит повторно
+    headers = {GRAPH_SEQ_HEADER: str(current_seq(user_id))}
+    fmt = negotiate_format(request, format)
+    if fmt in ("compact", "msgpack"):
+        with tenant_session(user_id) as session:
+            response = compact_response(_layout_checked(iter_user_graph(session, user_id), user_id), fmt)
+        response.headers.update(headers)
+        return response
+    if fmt == "ndjson":
+        return StreamingResponse(_chunked(_graph_ndjson(user_id)), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+    return StreamingResponse(_chunked(_graph_json(user_id)), media_type="application/json", headers=headers)
+
+
+@router.get("/changes")
+def get_graph_changes(
+    since: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=50000),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Изменения графа после seq=since (из X-Graph-Seq или прошлого ответа):
+    актуальные nodes/links и удаления deleted_nodes/deleted_links. Удаление
+    узла удаляет и его связи. reset=true - журнал уже сжат, нужна полная
+    загрузка /graph/all; has_more=true - продолжить с возвращенного seq
+    """
+    return ORJSONResponse(changes_since(str(current_user.id), since, limit))
 
 
 @router.post("/nodes/batch-delete")
@@ -150,9 +230,9 @@ def batch_delete_nodes(
     if not request.node_ids:
         raise HTTPException(status_code=400, detail="No nodes to delete")
     
-    driver = get_neo4j_driver()
     deleted_count = 0
-    with driver.session() as session:
+    change = GraphChange(str(current_user.id))
+    with tenant_session(str(current_user.id)) as session:
         for node_id in request.node_ids:
             result = session.run(
                 """
@@ -166,6 +246,9 @@ def batch_delete_nodes(
             record = result.single()
             if record and record["deleted"] > 0:
                 deleted_count += 1
+                delete_node_document(node_id, str(current_user.id))
+                change.deleted_nodes.add(node_id)
+    publish(change)
     
     return {"status": "deleted", "deleted_count": deleted_count, "total_requested": len(request.node_ids)}
 
@@ -173,17 +256,124 @@ def batch_delete_nodes(
 @router.get("/neighbors/{node_id}", response_model=GraphData)
 def get_neighbors(
     node_id: str,
+    request: Request,
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
+    current_user: User = Depends(get_current_user)
+):
+    """Узел и его соседи; отвечается из кэша смежности (services.adjacency)"""
+    data = neighborhood(str(current_user.id), node_id) or {"nodes": [], "links": []}
+    return graph_response(request, format, data)
+
+
+@router.get("/subgraph", response_model=GraphData)
+def get_subgraph(
+    request: Request,
+    root: List[str] = Query(..., description="Стартовые узлы"),
+    depth: int = Query(2, ge=1, le=6),
+    relation: Optional[List[str]] = Query(None, description="Типы связей для обхода"),
+    direction: str = Query("both", pattern="^(both|out|in)$"),
+    max_nodes: int = Query(200, ge=1, le=5000),
+    max_fanout: int = Query(100, ge=1, le=5000, description="Соседей на узел, не больше"),
+    has_gap: Optional[bool] = Query(None),
+    level: Optional[List[int]] = Query(None),
+    tag: Optional[List[str]] = Query(None, description="Хотя бы один из тегов"),
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Окрестность узлов на depth шагов с фильтрами. Обход в ширину по кэшу
+    смежности с бюджетом узлов и ограничением на соседей у узлов-хабов,
+    поэтому время ответа не зависит от степени узлов. Корни включаются
+    всегда, фильтры has_gap/level/tag отсекают остальные узлы вместе с их
+    окрестностью. truncated=true - ответ обрезан лимитом
+    """
+    levels = set(level) if level else None
+    tags = set(tag) if tag else None
+
+    def node_filter(node: Dict) -> bool:
+        if has_gap is not None and node["has_gap"] != has_gap:
+            return False
+        if levels is not None and node["level"] not in levels:
+            return False
+        if tags is not None and tags.isdisjoint(node["tags"]):
+            return False
+        return True
+
+    use_filter = has_gap is not None or levels is not None or tags is not None
+    graph = get_adjacency_cache().get(str(current_user.id))
+    data = bounded_subgraph(
+        graph,
+        root,
+        depth,
+        relations=relation,
+        direction=direction,
+        max_nodes=max_nodes,
+        max_fanout=max_fanout,
+        node_filter=node_filter if use_filter else None,
+    )
+    if data is None:
+        raise HTTPException(status_code=404, detail="Node not found")
+    return graph_response(request, format, data)
+
+
+@router.get("/path", response_model=LearningPath)
+def get_learning_path(
+    request: Request,
+    source: str = Query(..., alias="from"),
+    target: str = Query(..., alias="to"),
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Путь обучения от концепта from до концепта to: узлы и связи по порядку
+    и суммарная стоимость cost. Связи-предпосылки (part_of, consists_of...)
+    дешевле ассоциативных (related). Считается в памяти по снимку графа
+    """
+    found, path = learning_path(str(current_user.id), source, target)
+    if not found:
+        raise HTTPException(status_code=404, detail="Node not found")
+    if path is None:
+        raise HTTPException(status_code=404, detail="No path between nodes")
+    return graph_response(request, format, path)
+
+
+@router.get("/overview")
+def get_graph_overview(
+    max_clusters: Optional[int] = Query(None, ge=2, le=2000),
     current_user: User = Depends(get_current_user)
 ):
-    driver = get_neo4j_driver()
-    with driver.session() as session:
+    """
+    Обзор большого графа: кластеры-супер-узлы (size, gap_count) и связи
+    между ними с весом. Кластер раскрывается через /graph/cluster/{id}
+    """
+    return ORJSONResponse(graph_overview(str(current_user.id), max_clusters))
+
+
+@router.get("/cluster/{cluster_id}", response_model=GraphData)
+def get_cluster(
+    cluster_id: str,
+    request: Request,
+    max_clusters: Optional[int] = Query(None, ge=2, le=2000),
+    format: Optional[str] = Query(None, pattern=GRAPH_FORMATS),
+    current_user: User = Depends(get_current_user)
+):
+    """Узлы кластера и связи между ними"""
+    user_id = str(current_user.id)
+    members = cluster_members(user_id, cluster_id, max_clusters)
+    if members is None:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    with tenant_session(user_id) as session:
         records = session.run(
-            """
-            MATCH (a:Node {id: $id, user_id: $user_id})-[r:RELATED]-(b:Node {user_id: $user_id})
+            f"""
+            MATCH (a:Node {{user_id: $user_id}})
+            WHERE a.id IN $ids
+            OPTIONAL MATCH (a)-[r:{GRAPH_RELATION_TYPES}]->(b:Node {{user_id: $user_id}})
+            WHERE b.id IN $ids
             RETURN a, r, b
+            ORDER BY a.id
             """,
-            id=node_id,
-            user_id=str(current_user.id)
+            user_id=user_id,
+            ids=members,
         )
-        data = graph_from_cypher_records(records)
-    return data
+        data = graph_dict_from_cypher_records(records)
+    return graph_response(request, format, data)
@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+from ..core.security import get_current_user
+from ..db.pool_stats import all_pool_stats
+from ..db.neo4j import get_neo4j_driver
+from ..db.elastic import get_es
+from ..services.adjacency import get_adjacency_cache
+from ..services.admission import admission_stats
+from ..services.llm_scheduler import get_llm_scheduler
+from ..services.write_behind import get_write_buffer
+
+
+# Внутреннее состояние процесса (пулы, очереди, кэши) - только для вошедших пользователей
+router = APIRouter(prefix="/health", tags=["health"], dependencies=[Depends(get_current_user)])
+
+
+@router.get("/pools")
+def get_pool_stats():
+    """Текущее состояние пулов соединений: занятые, свободные, ожидание, таймауты"""
+    # Инициализируем клиентов, чтобы пулы попали в отчет даже до первого запроса
+    get_neo4j_driver()
+    get_es()
+    return all_pool_stats()
+
+
+@router.get("/caches")
+def get_cache_stats():
+    """Заполнение и попадания кэшей графа в памяти процесса"""
+    write_buffer = get_write_buffer()
+    return {
+        "adjacency": get_adjacency_cache().stats(),
+        "write_behind": write_buffer.stats() if write_buffer is not None else None,
+    }
+
+
+@router.get("/admission")
+def get_admission_stats():
+    """Допуск к дорогим эндпоинтам: занятые слоты, очередь, отказы по причинам"""
+    return admission_stats()
+
+
+@router.get("/llm")
+def get_llm_stats():
+    """Очереди планировщика LLM по классам приоритета: глубина, ожидание, вызовы в работе"""
+    return get_llm_scheduler().stats()
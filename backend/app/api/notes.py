@@ -1,22 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
+from typing import Optional
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.orm import Session
 from ..db.postgres import get_db_session
 from ..db.models import Note, User
-from ..db.elastic import get_es
+from ..services.indexing import index_note, delete_note as delete_note_document
 from ..models.schemas import NoteCreate, NoteOut, NoteUpdate
-from ..services.llm import analyze_note_with_llm
+from ..services.note_tags import enrich_note_tags
 from ..core.security import get_current_user
+from ..services.admission import admit
+from ..services.idempotency import IDEMPOTENCY_HEADER, fingerprint, run_idempotent
 
 
 router = APIRouter(prefix="/notes", tags=["notes"])
 
 
-@router.post("/", response_model=NoteOut)
+def _note_dict(note: Note) -> dict:
+    # Поля NoteOut; orjson сам сериализует UUID и datetime
+    return {
+        "id": note.id,
+        "user_id": note.user_id,
+        "title": note.title,
+        "content": note.content,
+        "tags": note.tags,
+        "created_at": note.created_at,
+        "updated_at": note.updated_at,
+    }
+
+
+@router.post("/", response_model=NoteOut, dependencies=[Depends(admit("notes"))])
 def create_note(
     payload: NoteCreate,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER, max_length=255),
     db: Session = Depends(get_db_session),
     current_user: User = Depends(get_current_user)
 ):
+    # Повтор с тем же Idempotency-Key не создает вторую заметку
+    return run_idempotent(
+        str(current_user.id),
+        idempotency_key,
+        fingerprint("create_note", payload.model_dump()),
+        lambda: _create_note(payload, db, current_user),
+    )
+
+
+def _create_note(payload: NoteCreate, db: Session, current_user: User):
     note = Note(
         title=payload.title,
         content=payload.content,
@@ -27,28 +55,11 @@ def create_note(
     db.commit()
     db.refresh(note)
 
-    es = get_es()
-    es.index(index="notes", id=note.id, document={
-        "id": note.id,
-        "user_id": str(note.user_id),
-        "title": note.title,
-        "content": note.content,
-        "tags": note.tags,
-    })
-
-    # Анализ заметки с помощью LLM
-    try:
-        analysis = analyze_note_with_llm(note.content)
-        if analysis:
-            # Обновляем теги на основе анализа
-            if analysis.get("tags"):
-                note.tags = list(set(note.tags + analysis["tags"]))
-            db.commit()
-            db.refresh(note)
-    except Exception as e:
-        print(f"LLM analysis error: {e}")
+    index_note(note)
+    # Теги от LLM дописываются в фоне (services.note_tags)
+    enrich_note_tags(note)
 
-    return note
+    return ORJSONResponse(_note_dict(note))
 
 
 @router.get("/", response_model=list[NoteOut])
@@ -57,10 +68,12 @@ def list_notes(
     current_user: User = Depends(get_current_user)
 ):
     """Get all notes for current user"""
-    notes = db.query(Note).filter(
+    rows = db.query(
+        Note.id, Note.user_id, Note.title, Note.content, Note.tags, Note.created_at, Note.updated_at
+    ).filter(
         Note.user_id == current_user.id
     ).order_by(Note.created_at.desc()).all()
-    return notes
+    return ORJSONResponse([row._asdict() for row in rows])
 
 
 @router.get("/{note_id}", response_model=NoteOut)
@@ -75,10 +88,10 @@ def get_note(
     ).first()
     if not note:
         raise HTTPException(status_code=404, detail="Note not found")
-    return note
+    return ORJSONResponse(_note_dict(note))
 
 
-@router.patch("/{note_id}", response_model=NoteOut)
+@router.patch("/{note_id}", response_model=NoteOut, dependencies=[Depends(admit("notes"))])
 def update_note(
     note_id: int,
     payload: NoteUpdate,
@@ -100,27 +113,13 @@ def update_note(
     db.commit()
     db.refresh(note)
 
-    es = get_es()
-    es.index(index="notes", id=note.id, document={
-        "id": note.id,
-        "user_id": str(note.user_id),
-        "title": note.title,
-        "content": note.content,
-        "tags": note.tags,
-    })
+    index_note(note)
 
-    # Повторный анализ при обновлении
+    # Повторный анализ при обновлении текста
     if payload.content is not None:
-        try:
-            analysis = analyze_note_with_llm(note.content)
-            if analysis and analysis.get("tags"):
-                note.tags = list(set(note.tags + analysis["tags"]))
-                db.commit()
-                db.refresh(note)
-        except Exception as e:
-            print(f"LLM analysis error: {e}")
+        enrich_note_tags(note)
 
-    return note
+    return ORJSONResponse(_note_dict(note))
 
 
 @router.delete("/{note_id}")
@@ -141,10 +140,6 @@ def delete_note(
     db.commit()
     
     # Delete from Elasticsearch
-    try:
-        es = get_es()
-        es.delete(index="notes", id=note_id)
-    except Exception as e:
-        print(f"ES delete error: {e}")
+    delete_note_document(note_id, str(current_user.id))
     
     return {"status": "deleted"}
@@ -0,0 +1,59 @@
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect, status
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import logging
+from ..db.postgres import SessionLocal
+from ..core.security import user_from_token
+from ..services.realtime import get_hub
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(tags=["realtime"])
+
+
+def _authenticate(token: str):
+    db = SessionLocal()
+    try:
+        user = user_from_token(token, db)
+        return str(user.id) if user else None
+    finally:
+        db.close()
+
+
+@router.websocket("/ws")
+async def events(websocket: WebSocket, token: str = Query(...)):
+    """
+    Поток событий пользователя: изменения графа ({"type": "graph"}) и ход
+    анализа заметок ({"type": "analysis"}). Токен передается в ?token=,
+    так как браузер не дает задать заголовки WebSocket. На "ping" сервер
+    отвечает "pong"
+    """
+    user_id = await run_in_threadpool(_authenticate, token)
+    if user_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    hub = get_hub()
+    queue = hub.connect(user_id)
+
+    async def send():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    async def receive():
+        while True:
+            if await websocket.receive_text() == "ping":
+                await websocket.send_text("pong")
+
+    tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            if error is not None and not isinstance(error, WebSocketDisconnect):
+                logger.warning(f"WebSocket for user {user_id} closed: {error}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.disconnect(user_id, queue)
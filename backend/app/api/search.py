@@ -1,52 +1,330 @@
-from fastapi import APIRouter, Query
-from typing import List
-from ..db.elastic import get_es
+from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from typing import Dict, List, Optional
+import base64
+import orjson
+from ..db.elastic import embedding_compatible, get_es
+from ..services.embeddings import get_embedder
 from ..core.config import get_settings
-from ..models.schemas import NoteOut, GraphNode
+from ..core.security import get_current_user
+from ..db.models import User
+from ..models.schemas import NoteSearchPage, NodeSearchPage, Suggestion
 
 
 router = APIRouter(prefix="/search", tags=["search"])
 
+SNIPPET_SIZE = 160
+SNIPPETS_PER_HIT = 2
+RRF_K = 60
 
-@router.get("/notes", response_model=List[NoteOut])
-def search_notes(q: str = Query("")):
-    if not q or not q.strip():
-        return []
-    es = get_es()
-    s = get_settings()
-    res = es.search(index=s.elastic_index_notes, body={
+
+def _encode_cursor(sort_values: List) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(sort_values)).decode()
+
+
+def _decode_cursor(cursor: str) -> List:
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def _user_search(
+    index: str,
+    user_id: str,
+    q: str,
+    fields: List[str],
+    source: List[str],
+    highlight_fields: List[str],
+    size: int,
+    cursor: Optional[str],
+) -> Dict:
+    """
+    Поиск в пределах документов пользователя: фильтр по user_id и
+    маршрутизация по user_id (запрос попадает в один шард),
+    пагинация через search_after, вместо полного текста - подсветка
+    """
+    body = {
         "query": {
-            "multi_match": {
-                "query": q,
-                "fields": ["title^2", "content", "tags"]
+            "bool": {
+                "must": {"multi_match": {"query": q, "fields": fields}},
+                "filter": [{"term": {"user_id": user_id}}],
             }
         },
-        "size": 20
-    })
-    results: List[NoteOut] = []
-    for hit in res["hits"]["hits"]:
-        src = hit["_source"]
-        results.append(NoteOut(**src))
-    return results
+        "_source": source,
+        "highlight": {
+            "fields": {
+                f: {"fragment_size": SNIPPET_SIZE, "number_of_fragments": SNIPPETS_PER_HIT}
+                for f in highlight_fields
+            },
+            "no_match_size": SNIPPET_SIZE,
+        },
+        # id как tiebreaker делает порядок стабильным для search_after
+        "sort": [{"_score": "desc"}, {"id": "asc"}],
+        "track_total_hits": False,
+        "size": size,
+    }
+    if cursor:
+        body["search_after"] = _decode_cursor(cursor)
+    return get_es().search(index=index, routing=user_id, body=body)
+
+
+def _snippets(hit: Dict, fields: List[str]) -> List[str]:
+    highlight = hit.get("highlight", {})
+    snippets: List[str] = []
+    for f in fields:
+        snippets.extend(highlight.get(f, []))
+    return snippets[:SNIPPETS_PER_HIT]
+
+
+# Хиты собираются в простые dict с полями NoteSearchHit/NodeSearchHit и
+# отдаются через ORJSONResponse без повторной валидации response_model
+
+def _note_hit(hit: Dict, score: Optional[float] = None) -> Dict:
+    src = hit["_source"]
+    return {
+        "id": src["id"],
+        "title": src.get("title", ""),
+        "tags": src.get("tags", []),
+        "snippets": _snippets(hit, ["content"]),
+        "score": score if score is not None else hit.get("_score"),
+    }
+
+
+def _node_hit(hit: Dict, score: Optional[float] = None) -> Dict:
+    src = hit["_source"]
+    return {
+        "id": src["id"],
+        "label": src.get("label", src["id"]),
+        "tags": src.get("tags", []),
+        "has_gap": bool(src.get("has_gap", False)),
+        "level": src.get("level"),
+        "snippets": _snippets(hit, ["summary"]),
+        "score": score if score is not None else hit.get("_score"),
+    }
+
+
+def _page(hits: List[Dict], next_cursor: Optional[str] = None) -> ORJSONResponse:
+    return ORJSONResponse({"hits": hits, "next_cursor": next_cursor})
+
+
+def _next_cursor(hits: List[Dict], size: int) -> Optional[str]:
+    if len(hits) < size:
+        return None
+    return _encode_cursor(hits[-1]["sort"])
+
+
+@router.get("/notes", response_model=NoteSearchPage)
+def search_notes(
+    q: str = Query(""),
+    size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    current_user: User = Depends(get_current_user)
+):
+    if not q or not q.strip():
+        return _page([])
+    s = get_settings()
+    res = _user_search(
+        s.elastic_index_notes,
+        str(current_user.id),
+        q,
+        fields=["title^2", "content", "tags"],
+        source=["id", "title", "tags"],
+        highlight_fields=["content"],
+        size=size,
+        cursor=cursor,
+    )
+    hits = res["hits"]["hits"]
+    results = [_note_hit(hit) for hit in hits]
+    return _page(results, _next_cursor(hits, size))
 
 
-@router.get("/nodes", response_model=List[GraphNode])
-def search_nodes(q: str = Query("")):
+@router.get("/nodes", response_model=NodeSearchPage)
+def search_nodes(
+    q: str = Query(""),
+    size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    current_user: User = Depends(get_current_user)
+):
+    if not q or not q.strip():
+        return _page([])
+    s = get_settings()
+    res = _user_search(
+        s.elastic_index_nodes,
+        str(current_user.id),
+        q,
+        fields=["label^2", "summary", "tags"],
+        source=["id", "label", "tags", "has_gap", "level"],
+        highlight_fields=["summary"],
+        size=size,
+        cursor=cursor,
+    )
+    hits = res["hits"]["hits"]
+    results = [_node_hit(hit) for hit in hits]
+    return _page(results, _next_cursor(hits, size))
+
+
+@router.get("/suggest", response_model=List[Suggestion])
+def suggest(
+    q: str = Query(""),
+    k: int = Query(8, ge=1, le=20),
+    kind: str = Query("all", pattern="^(all|nodes|notes)$"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Автодополнение по префиксу: названия узлов и заголовки заметок пользователя.
+    Запрос идет по edge-n-gram подполям и не затрагивает основной поиск
+    """
     if not q or not q.strip():
         return []
-    es = get_es()
     s = get_settings()
-    res = es.search(index=s.elastic_index_nodes, body={
-        "query": {
-            "multi_match": {
-                "query": q,
-                "fields": ["label^2", "summary", "tags"]
-            }
+    indices = []
+    if kind in ("all", "nodes"):
+        indices.append(s.elastic_index_nodes)
+    if kind in ("all", "notes"):
+        indices.append(s.elastic_index_notes)
+    user_id = str(current_user.id)
+    res = get_es().search(
+        index=",".join(indices),
+        routing=user_id,
+        body={
+            "query": {
+                "bool": {
+                    "must": {
+                        "multi_match": {
+                            "query": q.strip(),
+                            "fields": ["label.prefix", "title.prefix"],
+                            "operator": "and",
+                        }
+                    },
+                    "filter": [{"term": {"user_id": user_id}}],
+                }
+            },
+            "_source": ["id", "label", "title"],
+            "track_total_hits": False,
+            "size": k,
         },
-        "size": 20
-    })
-    results: List[GraphNode] = []
+    )
+    results: List[Dict] = []
     for hit in res["hits"]["hits"]:
         src = hit["_source"]
-        results.append(GraphNode(**src))
-    return results
+        if "label" in src:
+            results.append({"id": str(src["id"]), "text": src["label"], "kind": "node"})
+        else:
+            results.append({"id": str(src["id"]), "text": src.get("title", ""), "kind": "note"})
+    return ORJSONResponse(results)
+
+
+def _hybrid_search(
+    index: str,
+    user_id: str,
+    q: str,
+    fields: List[str],
+    source: List[str],
+    highlight_fields: List[str],
+    size: int,
+) -> List[tuple]:
+    """
+    Гибридный поиск: BM25 и kNN по эмбеддингам выполняются одним msearch,
+    результаты объединяются reciprocal-rank fusion. Без эмбеддера или если
+    индекс заполнен другим эмбеддером, остается только BM25.
+    Возвращает [(hit, rrf_score)] по убыванию score
+    """
+    user_filter = {"term": {"user_id": user_id}}
+    window = size * 2
+    lexical = {
+        "query": {
+            "bool": {
+                "must": {"multi_match": {"query": q, "fields": fields}},
+                "filter": [user_filter],
+            }
+        },
+        "_source": source,
+        "highlight": {
+            "fields": {
+                f: {"fragment_size": SNIPPET_SIZE, "number_of_fragments": SNIPPETS_PER_HIT}
+                for f in highlight_fields
+            },
+        },
+        "track_total_hits": False,
+        "size": window,
+    }
+    header = {"index": index, "routing": user_id}
+    searches = [header, lexical]
+    es = get_es()
+    embedder = get_embedder()
+    if embedder is not None and embedding_compatible(es, index):
+        searches += [header, {
+            "knn": {
+                "field": "embedding",
+                "query_vector": embedder.embed_one(q),
+                "k": window,
+                "num_candidates": max(window * 5, 100),
+                "filter": user_filter,
+            },
+            "_source": source,
+            "track_total_hits": False,
+            "size": window,
+        }]
+    res = es.msearch(searches=searches)
+
+    fused: Dict[str, float] = {}
+    best_hit: Dict[str, Dict] = {}
+    for response in res["responses"]:
+        if "error" in response:
+            continue
+        for rank, hit in enumerate(response["hits"]["hits"], start=1):
+            key = hit["_id"]
+            fused[key] = fused.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            # Предпочитаем вариант с подсветкой (из лексического запроса)
+            if key not in best_hit or ("highlight" in hit and "highlight" not in best_hit[key]):
+                best_hit[key] = hit
+    ranked = sorted(fused.items(), key=lambda kv: (-kv[1], kv[0]))[:size]
+    return [(best_hit[key], score) for key, score in ranked]
+
+
+@router.get("/notes/hybrid", response_model=NoteSearchPage)
+def hybrid_search_notes(
+    q: str = Query(""),
+    size: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
+):
+    """Поиск заметок по словам и по смыслу (BM25 + kNN, RRF)"""
+    if not q or not q.strip():
+        return _page([])
+    s = get_settings()
+    ranked = _hybrid_search(
+        s.elastic_index_notes,
+        str(current_user.id),
+        q,
+        fields=["title^2", "content", "tags"],
+        source=["id", "title", "tags"],
+        highlight_fields=["content"],
+        size=size,
+    )
+    return _page([_note_hit(hit, score) for hit, score in ranked])
+
+
+@router.get("/nodes/hybrid", response_model=NodeSearchPage)
+def hybrid_search_nodes(
+    q: str = Query(""),
+    size: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
+):
+    """Поиск узлов по словам и по смыслу (BM25 + kNN, RRF)"""
+    if not q or not q.strip():
+        return _page([])
+    s = get_settings()
+    ranked = _hybrid_search(
+        s.elastic_index_nodes,
+        str(current_user.id),
+        q,
+        fields=["label^2", "summary", "tags"],
+        source=["id", "label", "tags", "has_gap", "level"],
+        highlight_fields=["summary"],
+        size=size,
+    )
+    return _page([_node_hit(hit, score) for hit, score in ranked])
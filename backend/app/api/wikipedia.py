@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from typing import List
 from ..services.wikipedia import (
     import_wikipedia_article,
@@ -8,6 +8,9 @@ from ..services.wikipedia import (
     fetch_wikipedia_article
 )
 from ..models.schemas import GraphNode
+from ..core.security import get_current_user
+from ..services.admission import admit
+from ..db.models import User
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,12 +18,15 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/wikipedia", tags=["wikipedia"])
 
 
-@router.post("/import/article")
-def import_article(title: str = Query(..., min_length=1)):
+@router.post("/import/article", dependencies=[Depends(admit("import"))])
+def import_article(
+    title: str = Query(..., min_length=1),
+    current_user: User = Depends(get_current_user)
+):
     """
-    Импортирует одну статью из Wikipedia по названию
+    Импортирует одну статью из Wikipedia по названию в граф пользователя
     """
-    node = import_wikipedia_article(title)
+    node = import_wikipedia_article(title, user_id=str(current_user.id))
     if not node:
         raise HTTPException(status_code=404, detail=f"Article '{title}' not found")
     return {
@@ -31,15 +37,19 @@ def import_article(title: str = Query(..., min_length=1)):
     }
 
 
-@router.post("/import/keywords")
-def import_by_keywords(keywords: List[str], max_articles: int = Query(20, ge=1, le=100)):
+@router.post("/import/keywords", dependencies=[Depends(admit("import"))])
+def import_by_keywords(
+    keywords: List[str],
+    max_articles: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
+):
     """
-    Импортирует статьи из Wikipedia по ключевым словам
+    Импортирует статьи из Wikipedia по ключевым словам в граф пользователя
     """
     if not keywords:
         raise HTTPException(status_code=400, detail="Keywords list is empty")
     
-    nodes = populate_knowledge_base_from_keywords(keywords, max_articles)
+    nodes = populate_knowledge_base_from_keywords(keywords, max_articles, user_id=str(current_user.id))
     return {
         "imported": len(nodes),
         "articles": [
@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Dict, Optional
 
 
 class Settings(BaseSettings):
@@ -14,16 +15,131 @@ class Settings(BaseSettings):
     postgres_db: str = "kyppg"
     postgres_host: str = "postgres"
     postgres_port: int = 5432
+    postgres_pool_size: int = 10
+    postgres_max_overflow: int = 20
+    postgres_pool_timeout: float = 10.0  # секунды ожидания свободного соединения
+    postgres_pool_recycle: int = 1800  # максимальное время жизни соединения, секунды
+    postgres_keepalives_idle: int = 60  # TCP keep-alive, секунды
 
     neo4j_uri: str = "bolt://neo4j:7687"
     neo4j_user: str = "neo4j"
     neo4j_password: str = "neo4jpassword"
+    neo4j_max_connection_pool_size: int = 50
+    neo4j_connection_acquisition_timeout: float = 10.0
+    neo4j_max_connection_lifetime: int = 1800
+    neo4j_keep_alive: bool = True
+    neo4j_liveness_check_timeout: Optional[float] = 60.0
 
     elasticsearch_url: str = "http://elasticsearch:9200"
     elastic_index_notes: str = "notes"
     elastic_index_nodes: str = "nodes"
+    elasticsearch_connections_per_node: int = 10
+    elasticsearch_request_timeout: float = 5.0
+    elasticsearch_max_retries: int = 2
+    elasticsearch_retry_on_timeout: bool = False
+    elastic_number_of_shards: int = 1
+    elastic_number_of_replicas: int = 0
+    elastic_refresh_interval: str = "1s"
+
+    # Семантический поиск: локальный эмбеддер (sentence-transformers | hashing).
+    # Модель скачивается при сборке образа (backend/Dockerfile); hashing - для
+    # разработки без модели, синонимы между языками он не находит
+    embedding_backend: str = "sentence-transformers"
+    embedding_model_path: str = "/models/paraphrase-multilingual-MiniLM-L12-v2"
+    embedding_dims: int = 384
+    embedding_batch_size: int = 32
+    embedding_cache_size: int = 10000
+
+    # Фоновая индексация в Elasticsearch
+    indexing_batch_size: int = 64
+    indexing_flush_interval: float = 0.5
+    indexing_queue_size: int = 10000
+
+    # Обзор графа (кластеры)
+    cluster_cache_users: int = 256
+    overview_max_clusters: int = 300
+
+    # Серверная раскладка графа
+    layout_iterations: int = 100
+    layout_incremental_iterations: int = 30
+    layout_debounce: float = 2.0  # секунд тишины перед пересчетом
+
+    # Журнал изменений графа (GET /graph/changes)
+    changelog_retention_days: int = 7  # сколько хранить удаления (tombstones)
+    changelog_compact_interval: float = 3600.0
+    changelog_follow_interval: float = 2.0  # как часто подхватывать записи других процессов
+    changelog_page_size: int = 5000
+
+    # Центральность узлов (PageRank) и повышение уровня до центрального
+    centrality_debounce: float = 1.0
+    centrality_promote_score: float = 3.0  # PageRank относительно среднего узла
+    centrality_promote_min_degree: int = 5
+
+    # Кэш смежности графов в памяти процесса (окрестности узлов)
+    adjacency_cache_mb: int = 256
+    adjacency_patch_max_nodes: int = 2000  # запись, задевшая больше узлов, сбрасывает снимок
+    path_cache_size: int = 4096
+
+    # Push-уведомления по WebSocket (/ws)
+    realtime_broker: str = "memory"  # "memory" (один процесс) или "postgres" (LISTEN/NOTIFY)
+    realtime_queue_size: int = 256
+
+    # Квота новых узлов (анализ заметок) за скользящее окно, по тарифам
+    quota_plans: Dict[str, int] = {"free": 100, "pro": 1000}
+    quota_default_plan: str = "free"
+    quota_window_hours: int = 48
+    quota_bucket_minutes: int = 60
+    quota_reservation: int = 15  # резерв до вызова LLM, узлов
+    quota_reservation_ttl: float = 300.0  # незакрытый резерв освобождается сам
+
+    # Допуск к дорогим эндпоинтам (services.admission): token bucket на
+    # пользователя и на класс, лимит одновременных запросов с очередью
+    rate_limit_backend: str = "memory"  # "memory" (один процесс) или "postgres"
+    admission_classes: Dict[str, Dict[str, float]] = {
+        "llm": {
+            "concurrency": 8, "queue": 32, "max_wait": 30.0,
+            "user_rate": 0.1, "user_burst": 5, "global_rate": 2.0, "global_burst": 20,
+        },
+        # Запись заметок: быстрая, но ставит фоновый анализ тегов в очередь LLM
+        "notes": {
+            "concurrency": 16, "queue": 64, "max_wait": 10.0,
+            "user_rate": 0.2, "user_burst": 10, "global_rate": 5.0, "global_burst": 50,
+        },
+        "import": {
+            "concurrency": 2, "queue": 4, "max_wait": 60.0,
+            "user_rate": 0.02, "user_burst": 2, "global_rate": 0.2, "global_burst": 4,
+        },
+    }
+
+    # Ограничения размера узла (node_matching.compact_node_data, services.compaction)
+    node_summary_max_chars: int = 1200
+    node_max_gaps: int = 8
+    node_max_recommendations: int = 8
+    node_max_tags: int = 20
+    node_summary_rewrite_chars: int = 600  # длиннее - переписывается LLM (compaction --rewrite)
+
+    # Поиск и слияние дубликатов узлов (services.dedup)
+    dedup_num_perm: int = 60  # хешей MinHash на сигнатуру
+    dedup_bands: int = 20  # полос LSH; кандидаты от сходства ~ (1 / bands) ** (bands / num_perm)
+    dedup_max_bucket: int = 50  # корзина LSH больше - слишком общий признак, пропускается
+    dedup_merge_threshold: float = 0.81  # выше 1 - SUMMARY_WEIGHT; подобран на benchmarks/dedup_calibration.py
+    dedup_batch_size: int = 50  # слияний в одной транзакции
+
+    # Отложенная пакетная запись обновлений существующих узлов (services.write_behind)
+    write_behind_enabled: bool = False
+    write_behind_interval: float = 0.5  # секунд между записями буфера
+
+    # Idempotency-Key для создания заметок и анализа
+    idempotency_ttl_hours: int = 24
+    idempotency_wait_timeout: float = 90.0  # сколько повтор ждет выполняющийся оригинал
+    idempotency_pending_timeout: float = 600.0  # pending старше - считается брошенным
 
     llm_provider: str = "timeweb"
+    # Планировщик LLM (services.llm_scheduler): одновременные вызовы на провайдера,
+    # из них не больше llm_bulk_max_in_flight - фоновые
+    llm_provider_max_in_flight: Dict[str, int] = {"google": 8, "timeweb": 4, "custom": 4}
+    llm_bulk_max_in_flight: int = 2
+    llm_queue_timeout: float = 120.0
     custom_llm_api_key: str = ""
     custom_llm_endpoint: str = ""
 
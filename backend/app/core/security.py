@@ -45,33 +45,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db_session)
-) -> User:
-    """Get current authenticated user from JWT token."""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    
+def user_from_token(token: str, db: Session) -> Optional[User]:
+    """Resolve a JWT access token to a user, None if the token is invalid."""
     try:
         payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
         user_id_str: str = payload.get("sub")
         if user_id_str is None:
-            raise credentials_exception
+            return None
         
         try:
             user_id = uuid.UUID(user_id_str)
         except ValueError:
-            raise credentials_exception
+            return None
             
         token_data = TokenData(user_id=user_id)
     except JWTError:
-        raise credentials_exception
+        return None
+    
+    return db.query(User).filter(User.id == token_data.user_id).first()
+
+
+def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db_session)
+) -> User:
+    """Get current authenticated user from JWT token."""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
     
-    user = db.query(User).filter(User.id == token_data.user_id).first()
+    user = user_from_token(token, db)
     if user is None:
         raise credentials_exception
     
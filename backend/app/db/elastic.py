@@ -1,22 +1,258 @@
 from elasticsearch import Elasticsearch
-from elastic_transport import ConnectionError as ESConnectionError
+from elastic_transport import ConnectionError as ESConnectionError, ConnectionTimeout, Urllib3HttpNode
 from ..core.config import get_settings
+from .pool_stats import get_pool_stats
 from functools import lru_cache
+from typing import Dict, List, Tuple
+import os
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+pool_stats = get_pool_stats("elasticsearch")
+
+# Индексы версионируются: физический индекс "<name>_v<N>" доступен через
+# алиас чтения "<name>" и алиас записи "<name>_write". Изменение маппинга
+# выкатывается командой переиндексации (app.services.reindex).
+#
+# Edge-n-gram анализатор для автодополнения: "нейро" -> "н", "не", "ней", ...
+# При поиске запрос не режется на n-граммы, поэтому префикс совпадает целиком
+PREFIX_MAX_GRAM = 20
+INDEX_SETTINGS = {
+    "analysis": {
+        "tokenizer": {
+            "prefix_tokenizer": {
+                "type": "edge_ngram",
+                "min_gram": 1,
+                "max_gram": PREFIX_MAX_GRAM,
+                "token_chars": ["letter", "digit"],
+            }
+        },
+        "filter": {
+            # Токен запроса длиннее max_gram не совпал бы ни с одной n-граммой
+            "prefix_truncate": {"type": "truncate", "length": PREFIX_MAX_GRAM},
+            "russian_stop": {"type": "stop", "stopwords": "_russian_"},
+            "english_stop": {"type": "stop", "stopwords": "_english_"},
+            "russian_stemmer": {"type": "stemmer", "language": "russian"},
+            "english_stemmer": {"type": "stemmer", "language": "english"},
+        },
+        "analyzer": {
+            # Заметки смешивают русский и английский: стеммеры не пересекаются
+            # по алфавиту, поэтому их можно применять последовательно
+            "ru_en": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": ["lowercase", "russian_stop", "english_stop", "russian_stemmer", "english_stemmer"],
+            },
+            "prefix_index": {
+                "type": "custom",
+                "tokenizer": "prefix_tokenizer",
+                "filter": ["lowercase"],
+            },
+            "prefix_search": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": ["lowercase", "prefix_truncate"],
+            },
+        },
+    }
+}
+
+PREFIX_SUBFIELD = {
+    "prefix": {
+        "type": "text",
+        "analyzer": "prefix_index",
+        "search_analyzer": "prefix_search",
+    }
+}
+
+EMBEDDING_FIELD = {
+    "type": "dense_vector",
+    "dims": get_settings().embedding_dims,
+    "index": True,
+    "similarity": "cosine",
+}
+
+
+def _embedding_meta() -> dict:
+    s = get_settings()
+    model = "" if s.embedding_backend == "hashing" else os.path.basename(s.embedding_model_path.rstrip("/"))
+    return {"backend": s.embedding_backend, "model": model, "dims": s.embedding_dims}
+
+
+# Эмбеддер, которым заполняется поле embedding (services.embeddings). Векторы
+# запроса сравнимы с векторами индекса, только если эмбеддер тот же; смена
+# модели выкатывается переиндексацией
+EMBEDDING_META = _embedding_meta()
+EMBEDDING_META_TTL = 60.0  # секунд между проверками _meta индекса
+
+NOTE_MAPPINGS = {
+    "_meta": {"embedding": EMBEDDING_META},
+    "properties": {
+        "id": {"type": "integer"},
+        "user_id": {"type": "keyword"},
+        "title": {"type": "text", "analyzer": "ru_en", "fields": PREFIX_SUBFIELD},
+        "content": {"type": "text", "analyzer": "ru_en"},
+        "tags": {"type": "keyword"},
+        "embedding": EMBEDDING_FIELD,
+    }
+}
+
+NODE_MAPPINGS = {
+    "_meta": {"embedding": EMBEDDING_META},
+    "properties": {
+        "id": {"type": "keyword"},
+        "user_id": {"type": "keyword"},
+        "label": {"type": "text", "analyzer": "ru_en", "fields": PREFIX_SUBFIELD},
+        "summary": {"type": "text", "analyzer": "ru_en"},
+        "tags": {"type": "keyword"},
+        "has_gap": {"type": "boolean"},
+        "level": {"type": "integer"},
+        "embedding": EMBEDDING_FIELD,
+    }
+}
+
+
+class InstrumentedHttpNode(Urllib3HttpNode):
+    """
+    HTTP-узел с учетом запросов в полете и таймаутов.
+    urllib3-пул не блокируется при исчерпании, поэтому время ожидания
+    здесь - это полное время запроса к узлу.
+    """
+
+    def perform_request(self, *args, **kwargs):
+        with pool_stats.track(lambda e: isinstance(e, ConnectionTimeout)):
+            return super().perform_request(*args, **kwargs)
+
+
+def _probe_es_pool(es: Elasticsearch):
+    idle = 0
+    for node in es.transport.node_pool.all():
+        queue = getattr(getattr(node, "pool", None), "pool", None)
+        if queue is not None:
+            idle += sum(1 for conn in list(queue.queue) if conn is not None)
+    return {
+        "in_use": pool_stats.in_flight,
+        "idle": idle,
+        "size": get_settings().elasticsearch_connections_per_node,
+    }
+
+
 @lru_cache
 def get_es() -> Elasticsearch:
     s = get_settings()
-    return Elasticsearch(s.elasticsearch_url, request_timeout=5)
+    es = Elasticsearch(
+        s.elasticsearch_url,
+        request_timeout=s.elasticsearch_request_timeout,
+        connections_per_node=s.elasticsearch_connections_per_node,
+        max_retries=s.elasticsearch_max_retries,
+        retry_on_timeout=s.elasticsearch_retry_on_timeout,
+        node_class=InstrumentedHttpNode,
+    )
+    pool_stats.probe = lambda: _probe_es_pool(es)
+    return es
+
+
+def write_alias(name: str) -> str:
+    return f"{name}_write"
+
+
+def index_mappings(name: str) -> dict:
+    s = get_settings()
+    return NOTE_MAPPINGS if name == s.elastic_index_notes else NODE_MAPPINGS
+
+
+_embedding_checks: Dict[str, Tuple[float, bool]] = {}
+
+
+def embedding_compatible(es: Elasticsearch, index: str) -> bool:
+    """
+    Векторы индекса (или индексов за алиасом) посчитаны текущим эмбеддером
+    (EMBEDDING_META). Результат кэшируется на EMBEDDING_META_TTL: после
+    переиндексации алиас указывает на новый индекс
+    """
+    now = time.monotonic()
+    cached = _embedding_checks.get(index)
+    if cached is not None and now - cached[0] < EMBEDDING_META_TTL:
+        return cached[1]
+    try:
+        mappings = es.indices.get_mapping(index=index)
+        compatible = bool(mappings) and all(
+            (item["mappings"].get("_meta") or {}).get("embedding") == EMBEDDING_META
+            for _, item in mappings.items()
+        )
+        if not compatible:
+            logger.warning(
+                f"Index {index} was embedded by another embedder than {EMBEDDING_META}: "
+                f"semantic search is disabled until 'python -m app.services.reindex'"
+            )
+    except Exception as e:
+        logger.warning(f"Failed to read the mapping of {index}: {e}")
+        compatible = False
+    _embedding_checks[index] = (now, compatible)
+    return compatible
+
+
+def alias_targets(es: Elasticsearch, alias: str) -> List[str]:
+    """Физические индексы за алиасом (пустой список, если алиаса нет)"""
+    if not es.indices.exists_alias(name=alias):
+        return []
+    return sorted(es.indices.get_alias(name=alias).keys())
+
+
+def next_index_version(es: Elasticsearch, name: str) -> int:
+    existing = es.indices.get(index=f"{name}_v*", allow_no_indices=True, expand_wildcards="all")
+    versions = [0]
+    for index in existing.keys():
+        suffix = index[len(name) + 2:]
+        if suffix.isdigit():
+            versions.append(int(suffix))
+    return max(versions) + 1
+
+
+def create_versioned_index(es: Elasticsearch, name: str, version: int, bulk_load: bool = False, aliases: dict = None) -> str:
+    """
+    Создает физический индекс "<name>_v<version>".
+    При bulk_load индекс создается без реплик и без refresh - для быстрой загрузки
+    """
+    s = get_settings()
+    index = f"{name}_v{version}"
+    settings = {
+        **INDEX_SETTINGS,
+        "number_of_shards": s.elastic_number_of_shards,
+        "number_of_replicas": 0 if bulk_load else s.elastic_number_of_replicas,
+        "refresh_interval": "-1" if bulk_load else s.elastic_refresh_interval,
+    }
+    es.indices.create(index=index, settings=settings, mappings=index_mappings(name), aliases=aliases or {})
+    logger.info(f"Created index: {index}")
+    return index
+
+
+def _ensure_aliases(es: Elasticsearch, name: str):
+    write = write_alias(name)
+    if es.indices.exists_alias(name=name):
+        if not es.indices.exists_alias(name=write):
+            target = alias_targets(es, name)[-1]
+            es.indices.put_alias(index=target, name=write, is_write_index=True)
+            logger.info(f"Pointed write alias {write} to {target}")
+        return
+    if es.indices.exists(index=name):
+        # Индекс старого формата без версии: пишем в него до переиндексации
+        if not es.indices.exists_alias(name=write):
+            es.indices.put_alias(index=name, name=write, is_write_index=True)
+        logger.warning(
+            f"Index {name} is not versioned. Run 'python -m app.services.reindex {name}' "
+            "to migrate it to the current mapping."
+        )
+        return
+    create_versioned_index(es, name, 1, aliases={name: {}, write: {"is_write_index": True}})
 
 
 def ensure_indices(max_retries=5, retry_delay=2):
     """
-    Создает индексы в Elasticsearch с повторными попытками подключения
+    Создает индексы и алиасы в Elasticsearch с повторными попытками подключения
     """
     s = get_settings()
     
@@ -27,36 +263,8 @@ def ensure_indices(max_retries=5, retry_delay=2):
             if not es.ping():
                 raise ESConnectionError("Elasticsearch is not available")
             
-            note_mapping = {
-                "mappings": {
-                    "properties": {
-                        "id": {"type": "integer"},
-                        "title": {"type": "text"},
-                        "content": {"type": "text"},
-                        "tags": {"type": "keyword"},
-                    }
-                }
-            }
-
-            node_mapping = {
-                "mappings": {
-                    "properties": {
-                        "id": {"type": "keyword"},
-                        "label": {"type": "text"},
-                        "summary": {"type": "text"},
-                        "tags": {"type": "keyword"},
-                        "has_gap": {"type": "boolean"}
-                    }
-                }
-            }
-
-            if not es.indices.exists(index=s.elastic_index_notes):
-                es.indices.create(index=s.elastic_index_notes, **note_mapping)
-                logger.info(f"Created index: {s.elastic_index_notes}")
-            
-            if not es.indices.exists(index=s.elastic_index_nodes):
-                es.indices.create(index=s.elastic_index_nodes, **node_mapping)
-                logger.info(f"Created index: {s.elastic_index_nodes}")
+            _ensure_aliases(es, s.elastic_index_notes)
+            _ensure_aliases(es, s.elastic_index_nodes)
             
             logger.info("Elasticsearch indices initialized successfully")
             return
@@ -0,0 +1,265 @@
+"""
+Версионированные миграции схемы Neo4j и проверка планов запросов.
+
+Миграции применяются по порядку при старте (init_neo4j_schema); номер
+каждой примененной миграции хранится в узле (:SchemaMigration {version}).
+Все операторы идемпотентны (IF NOT EXISTS), поэтому одновременный старт
+нескольких воркеров и повторный запуск безопасны.
+
+Проверка планов: EXPLAIN для запросов роутеров и сервисов, собранных из
+их исходного кода (collect_queries); полный обход метки (NodeByLabelScan)
+или всех узлов (AllNodesScan) считается ошибкой.
+
+    python -m app.db.migrations            # применить миграции
+    python -m app.db.migrations status     # примененные и ожидающие
+    python -m app.db.migrations verify     # EXPLAIN; код выхода 1 при сканах
+
+После миграции 4 (ключ узла (user_id, id)) id документов узлов в
+Elasticsearch включают user_id: python -m app.services.reindex nodes
+"""
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+import argparse
+import ast
+import importlib
+import inspect
+import logging
+import pkgutil
+import re
+import sys
+from neo4j import Session
+from .neo4j import get_neo4j_driver
+from .tenancy import TenantScopeError, check_tenant_scope
+
+logger = logging.getLogger(__name__)
+
+
+# Оператор Cypher или функция для шагов, которым нужны данные из базы
+Step = Union[str, Callable[[Session], None]]
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    statements: Tuple[Step, ...]
+
+
+def _drop_node_id_constraints(session: Session):
+    result = session.run(
+        """
+        SHOW CONSTRAINTS YIELD name, labelsOrTypes, properties
+        WHERE labelsOrTypes = ['Node'] AND properties = ['id']
+        RETURN name
+        """
+    )
+    for name in [record["name"] for record in result]:
+        session.run(f"DROP CONSTRAINT `{name}` IF EXISTS").consume()
+
+
+def _split_shared_nodes(session: Session):
+    """
+    Пока узлы сливались по одному id, узел мог перейти к другому
+    пользователю вместе со связями прежнего владельца. Такая связь остается
+    у пользователя ее источника: для него создается своя копия цели, связь
+    переносится на копию. Узлы без user_id не трогаются
+    """
+    while True:
+        moved = session.run(
+            """
+            MATCH (a:Node)-[r]->(b:Node)
+            WHERE a.user_id IS NOT NULL AND b.user_id IS NOT NULL AND a.user_id <> b.user_id
+            WITH a, r, b LIMIT 1000
+            MERGE (c:Node {id: b.id, user_id: a.user_id})
+            ON CREATE SET c.label = b.label, c.summary = b.summary, c.tags = b.tags,
+                          c.has_gap = b.has_gap, c.level = b.level, c.created_at = b.created_at,
+                          c.knowledge_gaps = b.knowledge_gaps, c.recommendations = b.recommendations
+            MERGE (a)-[copy:RELATED {relation: coalesce(r.relation, r.type, toLower(type(r)))}]->(c)
+            SET copy += properties(r)
+            DELETE r
+            RETURN count(*) AS moved
+            """
+        ).single()["moved"]
+        if not moved:
+            return
+        logger.info(f"Moved {moved} cross-user links to per-user node copies")
+
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(1, "Unique node id", (
+        "CREATE CONSTRAINT IF NOT EXISTS FOR (n:Node) REQUIRE n.id IS UNIQUE",
+    )),
+    Migration(2, "Range indexes for per-user node lookups", (
+        "CREATE INDEX node_user IF NOT EXISTS FOR (n:Node) ON (n.user_id)",
+        "CREATE INDEX node_user_id IF NOT EXISTS FOR (n:Node) ON (n.user_id, n.id)",
+        "CREATE INDEX node_user_created IF NOT EXISTS FOR (n:Node) ON (n.user_id, n.created_at)",
+        "CREATE INDEX node_user_level IF NOT EXISTS FOR (n:Node) ON (n.user_id, n.level)",
+    )),
+    Migration(3, "Note id lookup for MENTIONED_IN links", (
+        "CREATE INDEX note_id IF NOT EXISTS FOR (n:Note) ON (n.id)",
+    )),
+    Migration(4, "Node key is (user_id, id) instead of a global id", (
+        # Ограничение создает собственный индекс по тем же свойствам
+        "DROP INDEX node_user_id IF EXISTS",
+        _drop_node_id_constraints,
+        "CREATE CONSTRAINT node_tenant_key IF NOT EXISTS FOR (n:Node) REQUIRE (n.user_id, n.id) IS UNIQUE",
+        _split_shared_nodes,
+    )),
+)
+
+SCAN_OPERATORS = ("NodeByLabelScan", "AllNodesScan")
+
+
+def applied_versions(session: Session) -> List[int]:
+    result = session.run("MATCH (m:SchemaMigration) RETURN m.version AS version ORDER BY version")
+    return [record["version"] for record in result]
+
+
+def apply_migrations(session: Session) -> List[int]:
+    """Применяет недостающие миграции по порядку, возвращает их номера"""
+    done = set(applied_versions(session))
+    applied = []
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        for statement in migration.statements:
+            if callable(statement):
+                statement(session)
+            else:
+                session.run(statement).consume()
+        session.run(
+            """
+            MERGE (m:SchemaMigration {version: $version})
+            ON CREATE SET m.description = $description, m.applied_at = datetime()
+            """,
+            version=migration.version,
+            description=migration.description,
+        ).consume()
+        logger.info(f"Applied Neo4j migration {migration.version}: {migration.description}")
+        applied.append(migration.version)
+    if applied:
+        # Новые индексы строятся в фоне; запросы ниже должны их уже видеть
+        session.run("CALL db.awaitIndexes(300)").consume()
+    return applied
+
+
+# Пакеты, из кода которых собираются запросы для проверки планов
+QUERY_PACKAGES = ("api", "services")
+_PARAM = re.compile(r"\$(\w+)")
+_READS_NODES = re.compile(r"\b(MATCH|MERGE)\b")
+_SAMPLE_USER = "00000000-0000-0000-0000-000000000000"
+
+
+def _query_text(arg: ast.expr, namespace: Dict) -> Optional[str]:
+    """Текст запроса: строка, f-строка из констант модуля или константа модуля; None - собран динамически"""
+    if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+        return arg.value
+    if isinstance(arg, ast.Name):
+        value = namespace.get(arg.id)
+        return value if isinstance(value, str) else None
+    if isinstance(arg, ast.JoinedStr):
+        parts = []
+        for value in arg.values:
+            if isinstance(value, ast.Constant):
+                parts.append(value.value)
+                continue
+            part = _query_text(value.value, namespace) if not value.format_spec and value.conversion == -1 else None
+            if part is None:
+                return None
+            parts.append(part)
+        return "".join(parts)
+    return None
+
+
+def collect_queries() -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Запросы Cypher из кода роутеров и сервисов (первый аргумент вызовов
+    .run(...)) - те же строки, что выполняются, а не их копии. Проверяются
+    запросы, которые пропускает tenant_session (check_tenant_scope):
+    служебные обходы всех тенантов обходят метку намеренно.
+    Возвращает ([(модуль:строка, запрос)], [места динамически собранных запросов])
+    """
+    root = __package__.rsplit(".", 1)[0]
+    queries: List[Tuple[str, str]] = []
+    dynamic: List[str] = []
+    for package_name in QUERY_PACKAGES:
+        package = importlib.import_module(f"{root}.{package_name}")
+        for info in pkgutil.iter_modules(package.__path__):
+            module = importlib.import_module(f"{package.__name__}.{info.name}")
+            tree = ast.parse(inspect.getsource(module))
+            calls = [
+                node for node in ast.walk(tree)
+                if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and node.func.attr == "run" and node.args
+            ]
+            for call in sorted(calls, key=lambda node: node.lineno):
+                where = f"{module.__name__}:{call.lineno}"
+                text = _query_text(call.args[0], vars(module))
+                if text is None:
+                    # Аргумент-переменная - не запрос (планировщик LLM и т.п.)
+                    if isinstance(call.args[0], (ast.JoinedStr, ast.Call)):
+                        dynamic.append(where)
+                    continue
+                if not _READS_NODES.search(text):
+                    continue
+                try:
+                    check_tenant_scope(text)
+                except TenantScopeError:
+                    continue
+                queries.append((where, text))
+    return queries, dynamic
+
+
+def _sample_params(query: str) -> Dict:
+    """Параметры только для планировщика: EXPLAIN их не исполняет"""
+    params = {name: None for name in _PARAM.findall(query)}
+    params["user_id"] = _SAMPLE_USER
+    return params
+
+
+def _operators(plan) -> Iterator[str]:
+    yield plan.get("operatorType", "") if isinstance(plan, dict) else plan.operator_type
+    children = plan.get("children", []) if isinstance(plan, dict) else plan.children
+    for child in children:
+        yield from _operators(child)
+
+
+def verify_query_plans(session: Session) -> List[Tuple[str, List[str]]]:
+    """EXPLAIN по collect_queries(); возвращает [(место запроса, операторы-сканы)] для проблемных"""
+    queries, dynamic = collect_queries()
+    for where in dynamic:
+        logger.info(f"skip: {where}: query is built at runtime")
+    failures = []
+    for name, query in queries:
+        summary = session.run("EXPLAIN " + query, _sample_params(query)).consume()
+        operators = list(_operators(summary.plan))
+        scans = [op for op in operators if op.split("@")[0] in SCAN_OPERATORS]
+        if scans:
+            failures.append((name, scans))
+        logger.info(f"{'FAIL' if scans else 'ok'}: {name}: {' > '.join(operators)}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Neo4j schema migrations")
+    parser.add_argument("command", nargs="?", default="apply", choices=("apply", "status", "verify"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    with get_neo4j_driver().session() as session:
+        if args.command == "apply":
+            applied = apply_migrations(session)
+            print(f"Applied: {applied or 'nothing, schema is up to date'}")
+        elif args.command == "status":
+            done = set(applied_versions(session))
+            for migration in MIGRATIONS:
+                mark = "x" if migration.version in done else " "
+                print(f"[{mark}] {migration.version}: {migration.description}")
+        else:
+            failures = verify_query_plans(session)
+            for name, scans in failures:
+                print(f"Unexpected scan in '{name}': {', '.join(scans)}")
+            sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
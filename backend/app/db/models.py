@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, func, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, Float, LargeBinary, String, Text, DateTime, func, ForeignKey, Index
 from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 import uuid
@@ -32,3 +32,120 @@ class Note(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
     user = relationship("User", back_populates="notes")
+
+
+class GraphChangeEntry(Base):
+    """Журнал изменений графа пользователя (для дельта-синхронизации)"""
+    __tablename__ = "graph_changes"
+
+    seq = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(UUID(as_uuid=True), nullable=False)
+    entity = Column(String(8), nullable=False)  # "node" или "link"
+    op = Column(String(8), nullable=False)  # "upsert" или "delete"
+    key = Column(String(1024), nullable=False)  # id узла или source/target/relation связи
+    data = Column(JSONB, nullable=True)  # для связей: {"source", "target", "relation"}
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_graph_changes_user_seq", "user_id", "seq"),
+        Index("ix_graph_changes_user_key", "user_id", "entity", "key"),
+    )
+
+
+class GraphChangeWatermark(Base):
+    """Последний seq, удаленный при сжатии журнала: клиентам со since ниже нужна полная загрузка"""
+    __tablename__ = "graph_change_watermarks"
+
+    user_id = Column(UUID(as_uuid=True), primary_key=True)
+    seq = Column(BigInteger, nullable=False, default=0)
+
+
+class UserPlan(Base):
+    """Тариф пользователя; нет записи - тариф по умолчанию (quota_default_plan)"""
+    __tablename__ = "user_plans"
+
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    plan = Column(String(32), nullable=False)
+
+
+class NodeQuotaBucket(Base):
+    """Число узлов, созданных пользователем за интервал quota_bucket_minutes"""
+    __tablename__ = "node_quota_buckets"
+
+    user_id = Column(UUID(as_uuid=True), primary_key=True)
+    bucket = Column(DateTime(timezone=True), primary_key=True)
+    used = Column(Integer, nullable=False, default=0)
+
+
+class NodeQuotaReservation(Base):
+    """Резерв квоты на время анализа; просроченные резервы не учитываются"""
+    __tablename__ = "node_quota_reservations"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    amount = Column(Integer, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class RateLimitBucket(Base):
+    """Token bucket общего хранилища лимитов (rate_limit_backend="postgres")"""
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String(255), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class IdempotencyRecord(Base):
+    """Запрос с Idempotency-Key: отпечаток и сохраненный ответ (services.idempotency)"""
+    __tablename__ = "idempotency_keys"
+
+    user_id = Column(UUID(as_uuid=True), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status = Column(String(16), nullable=False)  # "pending" или "done"
+    response_status = Column(Integer, nullable=True)
+    response_body = Column(LargeBinary, nullable=True)
+    media_type = Column(String(100), nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class NodeMerge(Base):
+    """Слияние узла-дубликата с основным (services.dedup) и снимок для отмены"""
+    __tablename__ = "node_merges"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    run_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    user_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    survivor_id = Column(String(255), nullable=False)
+    merged_id = Column(String(255), nullable=False)
+    score = Column(Float, nullable=False)
+    # merged/survivor - свойства до слияния, edges - связи дубликата,
+    # created_edges - связи, добавленные основному узлу
+    snapshot = Column(JSONB, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    undone_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class SearchReindexRun(Base):
+    """Идущая переиндексация: пока строка есть, удаления из индекса записываются в search_tombstones"""
+    __tablename__ = "search_reindex_runs"
+
+    index = Column(String(255), primary_key=True)  # алиас записи
+    started_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class SearchTombstone(Base):
+    """Удаление документа поиска: переиндексация повторяет удаления, пришедшие во время загрузки"""
+    __tablename__ = "search_tombstones"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    index = Column(String(255), nullable=False)  # алиас записи, через который шло удаление
+    doc_id = Column(String(1024), nullable=False)
+    routing = Column(String(255), nullable=True)
+    deleted_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_search_tombstones_index_deleted", "index", "deleted_at"),
+    )
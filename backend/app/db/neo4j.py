@@ -1,6 +1,7 @@
 from neo4j import GraphDatabase, Driver
-from neo4j.exceptions import ServiceUnavailable
+from neo4j.exceptions import ServiceUnavailable, ClientError
 from ..core.config import get_settings
+from .pool_stats import get_pool_stats
 from functools import lru_cache
 import time
 import logging
@@ -8,23 +9,75 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+pool_stats = get_pool_stats("neo4j")
+
+
+def _is_acquisition_timeout(e: BaseException) -> bool:
+    return isinstance(e, ClientError) and "failed to obtain a connection" in str(e)
+
+
+def _instrument_pool(driver: Driver):
+    """
+    Оборачивает acquire() внутреннего пула драйвера для сбора статистики.
+    Публичного API для метрик пула у драйвера нет, поэтому при изменении
+    внутренностей драйвера инструментирование просто отключается.
+    """
+    pool = getattr(driver, "_pool", None)
+    if pool is None or not hasattr(pool, "acquire"):
+        logger.warning("Neo4j pool instrumentation is not available for this driver version")
+        return
+    acquire = pool.acquire
+
+    def timed_acquire(*args, **kwargs):
+        with pool_stats.track(_is_acquisition_timeout):
+            return acquire(*args, **kwargs)
+
+    pool.acquire = timed_acquire
+
+    def probe():
+        with pool.lock:
+            connections = [c for conns in pool.connections.values() for c in conns]
+        in_use = sum(1 for c in connections if c.in_use)
+        return {
+            "in_use": in_use,
+            "idle": len(connections) - in_use,
+            "size": get_settings().neo4j_max_connection_pool_size,
+            "waiting": pool_stats.in_flight,
+        }
+
+    pool_stats.probe = probe
+
+
 @lru_cache
 def get_neo4j_driver() -> Driver:
     s = get_settings()
-    return GraphDatabase.driver(s.neo4j_uri, auth=(s.neo4j_user, s.neo4j_password))
+    driver = GraphDatabase.driver(
+        s.neo4j_uri,
+        auth=(s.neo4j_user, s.neo4j_password),
+        max_connection_pool_size=s.neo4j_max_connection_pool_size,
+        connection_acquisition_timeout=s.neo4j_connection_acquisition_timeout,
+        max_connection_lifetime=s.neo4j_max_connection_lifetime,
+        keep_alive=s.neo4j_keep_alive,
+        liveness_check_timeout=s.neo4j_liveness_check_timeout,
+    )
+    _instrument_pool(driver)
+    return driver
 
 
 def init_neo4j_schema(max_retries=5, retry_delay=2):
     """
-    Инициализирует схему Neo4j с повторными попытками подключения
+    Инициализирует схему Neo4j (миграции из db.migrations) с повторными
+    попытками подключения
     """
     for attempt in range(max_retries):
         try:
             driver = get_neo4j_driver()
             # Проверяем доступность Neo4j
             driver.verify_connectivity()
+            # Импорт здесь: migrations сам импортирует этот модуль
+            from .migrations import apply_migrations
             with driver.session() as session:
-                session.run("CREATE CONSTRAINT IF NOT EXISTS FOR (n:Node) REQUIRE n.id IS UNIQUE")
+                apply_migrations(session)
             logger.info("Neo4j schema initialized successfully")
             return
         except (ServiceUnavailable, Exception) as e:
@@ -0,0 +1,90 @@
+"""
+Статистика пулов соединений (Postgres, Neo4j, Elasticsearch)
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+import threading
+import time
+
+
+class PoolStats:
+    """
+    Потокобезопасные счетчики одного пула: число выдач соединения,
+    суммарное/максимальное время ожидания, таймауты и текущая занятость.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.acquisitions = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Функция, возвращающая живые показатели пула (in_use, idle, ...)
+        self.probe: Optional[Callable[[], Dict]] = None
+
+    def record(self, wait: float, timed_out: bool = False, failed: bool = False):
+        with self._lock:
+            self.acquisitions += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+            if timed_out:
+                self.timeouts += 1
+            elif failed:
+                self.errors += 1
+
+    @contextmanager
+    def track(self, is_timeout: Callable[[BaseException], bool]):
+        """
+        Оборачивает операцию получения соединения/запроса:
+        замеряет время и считает таймауты
+        """
+        start = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        except BaseException as e:
+            self.record(time.perf_counter() - start, timed_out=is_timeout(e), failed=True)
+            raise
+        else:
+            self.record(time.perf_counter() - start)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            data = {
+                "acquisitions": self.acquisitions,
+                "timeouts": self.timeouts,
+                "errors": self.errors,
+                "wait_avg_ms": round(self.wait_total / self.acquisitions * 1000, 3) if self.acquisitions else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+        if self.probe:
+            try:
+                data.update(self.probe())
+            except Exception as e:
+                data["probe_error"] = str(e)
+        return data
+
+
+_registry: Dict[str, PoolStats] = {}
+_registry_lock = threading.Lock()
+
+
+def get_pool_stats(name: str) -> PoolStats:
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = PoolStats(name)
+        return _registry[name]
+
+
+def all_pool_stats() -> Dict[str, Dict]:
+    with _registry_lock:
+        stats = list(_registry.values())
+    return {s.name: s.snapshot() for s in stats}
@@ -1,6 +1,9 @@
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.pool import QueuePool
 from ..core.config import get_settings
+from .pool_stats import get_pool_stats
 
 
 class Base(DeclarativeBase):
@@ -15,9 +18,45 @@ def _build_postgres_url() -> str:
     )
 
 
-engine = create_engine(_build_postgres_url(), pool_pre_ping=True)
+pool_stats = get_pool_stats("postgres")
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool, замеряющий время ожидания соединения и таймауты"""
+
+    def _do_get(self):
+        with pool_stats.track(lambda e: isinstance(e, PoolTimeoutError)):
+            return super()._do_get()
+
+
+def _build_engine():
+    s = get_settings()
+    return create_engine(
+        _build_postgres_url(),
+        poolclass=InstrumentedQueuePool,
+        pool_pre_ping=True,
+        pool_size=s.postgres_pool_size,
+        max_overflow=s.postgres_max_overflow,
+        pool_timeout=s.postgres_pool_timeout,
+        pool_recycle=s.postgres_pool_recycle,
+        connect_args={
+            "keepalives": 1,
+            "keepalives_idle": s.postgres_keepalives_idle,
+        },
+    )
+
+
+engine = _build_engine()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
+pool_stats.probe = lambda: {
+    "in_use": engine.pool.checkedout(),
+    "idle": engine.pool.checkedin(),
+    "overflow": max(engine.pool.overflow(), 0),
+    "size": engine.pool.size(),
+    "waiting": pool_stats.in_flight,
+}
+
 
 def get_db_session():
     session = SessionLocal()
@@ -0,0 +1,67 @@
+"""
+Разделение графа по пользователям (тенантам).
+
+Все узлы лежат под одной меткой :Node, тенант задается свойством user_id.
+Ключ узла - пара (user_id, id) (ограничение уникальности из миграции 4 в
+db.migrations), поэтому одинаковые md5-id у разных пользователей - разные
+узлы, а запрос по тенанту идет через составной индекс и стоит
+пропорционально графу этого тенанта, а не всем графам вместе.
+
+Единственная точка проверки - tenant_session(user_id): сессия сама
+подставляет $user_id и отклоняет запрос, в котором узел :Node
+сопоставляется без user_id: $user_id.
+"""
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Optional, Union
+import re
+from neo4j import Result, Session, Transaction
+from .neo4j import get_neo4j_driver
+
+# (n:Node ...) / (:Node ...) вместе со свойствами в фигурных скобках
+_NODE_PATTERN = re.compile(r"\(\s*\w*\s*:\s*Node\b([^)]*)\)")
+_SCOPE = re.compile(r"\buser_id\s*:\s*\$user_id\b")
+
+
+class TenantScopeError(ValueError):
+    """Запрос обращается к узлам без ограничения тенантом"""
+
+
+@lru_cache(maxsize=1024)
+def check_tenant_scope(query: str) -> None:
+    for match in _NODE_PATTERN.finditer(query):
+        if not _SCOPE.search(match.group(1)):
+            raise TenantScopeError(f"Node pattern is not scoped to $user_id: {match.group(0)}")
+
+
+class TenantSession:
+    """Сессия Neo4j, привязанная к одному пользователю"""
+
+    def __init__(self, session: Union[Session, Transaction], user_id: str):
+        if not user_id:
+            raise TenantScopeError("user_id is required for tenant session")
+        self.session = session
+        self.user_id = user_id
+
+    def run(self, query: str, parameters: Optional[Dict[str, Any]] = None, **kwargs) -> Result:
+        check_tenant_scope(query)
+        params = {**(parameters or {}), **kwargs}
+        if params.setdefault("user_id", self.user_id) != self.user_id:
+            raise TenantScopeError("Query user_id differs from the session tenant")
+        return self.session.run(query, params)
+
+    @contextmanager
+    def transaction(self) -> Iterator["TenantSession"]:
+        """Явная транзакция с теми же проверками; фиксируется, если блок завершился без ошибки"""
+        tx = self.session.begin_transaction()
+        try:
+            yield TenantSession(tx, self.user_id)
+            tx.commit()
+        finally:
+            tx.close()
+
+
+@contextmanager
+def tenant_session(user_id: str) -> Iterator[TenantSession]:
+    with get_neo4j_driver().session() as session:
+        yield TenantSession(session, user_id)
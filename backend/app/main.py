@@ -1,30 +1,36 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-import orjson
+from fastapi.responses import ORJSONResponse
 import logging
 from .core.config import get_settings
 from .db.postgres import Base, engine
 from .db.elastic import ensure_indices
 from .db.neo4j import init_neo4j_schema
+from .services.indexing import get_indexer
+from .services.layout import get_layout_worker
+from .services.changelog import get_change_log
+from .services.realtime import get_hub
+from .services.centrality import get_centrality_service
+from .services.llm_scheduler import get_llm_scheduler
+from .services.write_behind import get_write_buffer
+from .services.embeddings import get_embedder
 from .api.notes import router as notes_router
 from .api.graph import router as graph_router
 from .api.search import router as search_router
 from .api.analyze import router as analyze_router
 from .api.wikipedia import router as wikipedia_router
 from .api.auth import router as auth_router
+from .api.health import router as health_router
+from .api.realtime import router as realtime_router
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def orjson_dumps(v, *, default):
-    return orjson.dumps(v, default=default).decode()
-
-
 def create_app() -> FastAPI:
     s = get_settings()
-    app = FastAPI(title=s.app_name)
+    app = FastAPI(title=s.app_name, default_response_class=ORJSONResponse)
 
     app.add_middleware(
         CORSMiddleware,
@@ -32,6 +38,7 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Graph-Seq", "Retry-After", "Idempotent-Replayed"],
     )
 
     @app.on_event("startup")
@@ -51,17 +58,47 @@ def create_app() -> FastAPI:
             # Инициализация Neo4j (с повторными попытками)
             init_neo4j_schema()
             
+            # Модель эмбеддингов загружается при старте: если ее нет, это видно
+            # в логе сразу, а семантический поиск выключается (services.embeddings)
+            get_embedder()
+            # Фоновая индексация в Elasticsearch (эмбеддинги считаются там же)
+            get_indexer().start()
+            get_layout_worker().start()
+            get_change_log().start()
+            get_hub().start()
+            get_centrality_service().worker.start()
+            get_llm_scheduler().start()
+            write_buffer = get_write_buffer()
+            if write_buffer is not None:
+                write_buffer.start()
+            
             logger.info("Application startup completed")
         except Exception as e:
             logger.error(f"Startup error: {e}")
             # Приложение продолжит работу даже если некоторые сервисы недоступны
 
+    @app.on_event("shutdown")
+    def on_shutdown():
+        # Сначала дописываем отложенные обновления узлов
+        write_buffer = get_write_buffer()
+        if write_buffer is not None:
+            write_buffer.stop()
+        # Дописываем накопленные операции индексации
+        get_indexer().stop()
+        get_layout_worker().stop()
+        get_change_log().stop()
+        get_hub().stop()
+        get_centrality_service().worker.stop()
+        get_llm_scheduler().stop()
+
     app.include_router(auth_router)
     app.include_router(notes_router)
     app.include_router(graph_router)
     app.include_router(search_router)
     app.include_router(analyze_router)
     app.include_router(wikipedia_router)
+    app.include_router(health_router)
+    app.include_router(realtime_router)
     return app
 
 
@@ -79,6 +79,8 @@ class GraphNode(BaseModel):
     level: Optional[int] = None  # 0 - центральный узел, 1 - первый уровень, 2 - второй уровень
     knowledge_gaps: List[str] = Field(default_factory=list)
     recommendations: List[str] = Field(default_factory=list)
+    x: Optional[float] = None  # координаты серверной раскладки
+    y: Optional[float] = None
 
 
 class GraphLink(BaseModel):
@@ -90,3 +92,42 @@ class GraphLink(BaseModel):
 class GraphData(BaseModel):
     nodes: List[GraphNode]
     links: List[GraphLink]
+
+
+class LearningPath(GraphData):
+    cost: float
+
+
+# Search schemas
+class NoteSearchHit(BaseModel):
+    id: int
+    title: str
+    tags: List[str] = Field(default_factory=list)
+    snippets: List[str] = Field(default_factory=list)
+    score: Optional[float] = None
+
+
+class NodeSearchHit(BaseModel):
+    id: str
+    label: str
+    tags: List[str] = Field(default_factory=list)
+    has_gap: bool = False
+    level: Optional[int] = None
+    snippets: List[str] = Field(default_factory=list)
+    score: Optional[float] = None
+
+
+class NoteSearchPage(BaseModel):
+    hits: List[NoteSearchHit]
+    next_cursor: Optional[str] = None
+
+
+class NodeSearchPage(BaseModel):
+    hits: List[NodeSearchHit]
+    next_cursor: Optional[str] = None
+
+
+class Suggestion(BaseModel):
+    id: str
+    text: str
+    kind: str  # "node" | "note"
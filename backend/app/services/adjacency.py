@@ -0,0 +1,430 @@
+"""
+Кэш смежности графов пользователей в памяти процесса (CSR).
+
+Граф пользователя хранится компактно: узлы пронумерованы, соседи узла i -
+targets[offsets[i]:offsets[i + 1]] (обе стороны каждой связи, с флагом
+направления и индексом типа связи). Запросы окрестностей узла, которые UI
+делает при каждом клике, отвечаются без обращения к Neo4j.
+
+Снимок грузится по требованию одним запросом и вытесняется по LRU при
+превышении бюджета памяти. События graph_events не сбрасывают его, а
+исправляют: затронутые узлы и их связи читаются из Neo4j заново, а CSR
+пересобирается в памяти из остальных связей (CSRGraph.patched) - без
+полной перезагрузки графа на каждую запись. Крупные изменения
+(adjacency_patch_max_nodes) и ошибки чтения сбрасывают снимок.
+"""
+from collections import OrderedDict
+from itertools import compress
+from typing import Callable, Dict, List, Optional, Set
+import threading
+import logging
+import numpy as np
+import orjson
+from ..core.config import get_settings
+from ..db.tenancy import tenant_session
+from .knowledge import iter_nodes_with_links, iter_user_graph
+from .graph_events import GraphChange, subscribe
+
+logger = logging.getLogger(__name__)
+
+NODE_OVERHEAD = 200  # dict, ключи индекса и списков на узел, байт (оценка)
+PATCH_LOCKS = 64  # патчи одного пользователя идут по очереди
+
+
+def _node_nbytes(node: Dict) -> int:
+    return len(orjson.dumps(node)) + NODE_OVERHEAD
+
+
+class CSRGraph:
+    """Неизменяемый снимок графа пользователя"""
+
+    def __init__(self, nodes: List[Dict], links: List[Dict], version: int = 0):
+        ids = [node["id"] for node in nodes]
+        index = {node_id: i for i, node_id in enumerate(ids)}
+        relation_index: Dict[str, int] = {}
+        src, dst, rel = [], [], []
+        for link in links:
+            s, t = index.get(link["source"]), index.get(link["target"])
+            if s is None or t is None:
+                continue
+            src.append(s)
+            dst.append(t)
+            rel.append(relation_index.setdefault(link["relation"], len(relation_index)))
+        self._build(
+            nodes, ids, index, list(relation_index),
+            np.array(src, dtype=np.int32), np.array(dst, dtype=np.int32), np.array(rel, dtype=np.int32),
+            sum(_node_nbytes(node) for node in nodes), version,
+        )
+
+    def _build(
+        self,
+        nodes: List[Dict],
+        ids: List[str],
+        index: Dict[str, int],
+        relation_names: List[str],
+        src_a: np.ndarray,
+        dst_a: np.ndarray,
+        rel_a: np.ndarray,
+        node_bytes: int,
+        version: int,
+    ):
+        self.version = version
+        self.nodes = nodes
+        self.ids = ids
+        self.index = index
+        self.relation_names = relation_names
+
+        n = len(ids)
+        # Каждая связь видна с обеих сторон; outgoing=True - со стороны источника
+        heads = np.concatenate([src_a, dst_a])
+        order = np.argsort(heads, kind="stable")
+        self.targets = np.concatenate([dst_a, src_a])[order]
+        self.relations = np.concatenate([rel_a, rel_a])[order]
+        self.outgoing = np.concatenate([np.ones(len(src_a), bool), np.zeros(len(dst_a), bool)])[order]
+        self.offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(heads, minlength=n), out=self.offsets[1:])
+        self.node_bytes = node_bytes
+        self.nbytes = (
+            self.targets.nbytes + self.relations.nbytes + self.outgoing.nbytes + self.offsets.nbytes + node_bytes
+        )
+
+    def edges(self):
+        """Массивы (source, target, relation) - каждая связь один раз, со стороны источника"""
+        heads = np.repeat(np.arange(len(self.ids), dtype=np.int32), np.diff(self.offsets))
+        return heads[self.outgoing], self.targets[self.outgoing], self.relations[self.outgoing]
+
+    def patched(self, touched: Set[str], nodes: List[Dict], links: List[Dict], version: int) -> "CSRGraph":
+        """
+        Новый снимок, в котором узлы touched и все их связи заменены текущим
+        состоянием: nodes/links - то, что вернул iter_nodes_with_links для
+        touched (узла из touched нет в nodes - он удален). Остальные связи
+        переносятся массивами, без обращения к Neo4j
+        """
+        fresh = {node["id"]: node for node in nodes}
+        new_nodes = list(self.nodes)
+        node_bytes = self.node_bytes
+        touched_old = np.zeros(len(self.ids), dtype=bool)
+        removed = []
+        for node_id in touched:
+            i = self.index.get(node_id)
+            if i is None:
+                continue
+            touched_old[i] = True
+            node_bytes -= _node_nbytes(self.nodes[i])
+            node = fresh.pop(node_id, None)
+            if node is None:
+                removed.append(i)
+            else:
+                new_nodes[i] = node
+                node_bytes += _node_nbytes(node)
+
+        src, dst, rel = self.edges()
+        kept = ~(touched_old[src] | touched_old[dst])
+        src, dst, rel = src[kept], dst[kept], rel[kept]
+        if removed:
+            alive = np.ones(len(self.ids), dtype=bool)
+            alive[removed] = False
+            remap = (np.cumsum(alive) - 1).astype(np.int32)
+            src, dst = remap[src], remap[dst]
+            new_nodes = list(compress(new_nodes, alive.tolist()))
+        # Новые узлы - в конец снимка
+        for node_id in sorted(fresh):
+            new_nodes.append(fresh[node_id])
+            node_bytes += _node_nbytes(fresh[node_id])
+
+        ids = [node["id"] for node in new_nodes]
+        index = {node_id: i for i, node_id in enumerate(ids)}
+        relation_index = {name: i for i, name in enumerate(self.relation_names)}
+        added_src, added_dst, added_rel = [], [], []
+        # Связь между двумя затронутыми узлами приходит с обеих сторон
+        for link in {(link["source"], link["target"], link["relation"]) for link in links}:
+            s, t = index.get(link[0]), index.get(link[1])
+            if s is None or t is None:
+                continue
+            added_src.append(s)
+            added_dst.append(t)
+            added_rel.append(relation_index.setdefault(link[2], len(relation_index)))
+
+        graph = CSRGraph.__new__(CSRGraph)
+        graph._build(
+            new_nodes, ids, index, list(relation_index),
+            np.concatenate([src, np.array(added_src, dtype=np.int32)]),
+            np.concatenate([dst, np.array(added_dst, dtype=np.int32)]),
+            np.concatenate([rel, np.array(added_rel, dtype=np.int32)]),
+            node_bytes, version,
+        )
+        return graph
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def degree(self, i: int) -> int:
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def neighbor_slice(self, i: int) -> slice:
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def link(self, i: int, position: int) -> Dict:
+        """Связь из позиции position списка соседей узла i в виде GraphLink-dict"""
+        j = int(self.targets[position])
+        source, target = (i, j) if self.outgoing[position] else (j, i)
+        return {
+            "source": self.ids[source],
+            "target": self.ids[target],
+            "relation": self.relation_names[self.relations[position]],
+        }
+
+    def neighborhood(self, node_id: str, limit: Optional[int] = None) -> Optional[Dict]:
+        """
+        Узел, его соседи и связи с ними ({"nodes", "links"}); limit ограничивает
+        число связей. None, если узла нет
+        """
+        i = self.index.get(node_id)
+        if i is None:
+            return None
+        positions = range(*self.neighbor_slice(i).indices(len(self.targets)))
+        if limit is not None:
+            positions = positions[:limit]
+        nodes = {i: self.nodes[i]}
+        links = []
+        for position in positions:
+            j = int(self.targets[position])
+            nodes.setdefault(j, self.nodes[j])
+            links.append(self.link(i, position))
+        return {"nodes": list(nodes.values()), "links": links}
+
+
+def bounded_subgraph(
+    graph: CSRGraph,
+    roots: List[str],
+    depth: int,
+    relations: Optional[List[str]] = None,
+    direction: str = "both",
+    max_nodes: int = 200,
+    max_fanout: int = 100,
+    node_filter: Optional[Callable[[Dict], bool]] = None,
+) -> Optional[Dict]:
+    """
+    Ограниченный обход в ширину от roots на depth шагов.
+
+    Вместо переменной длины пути в Cypher (число путей растет
+    комбинаторно) каждый узел раскрывается один раз, у узла берется не
+    больше max_fanout подходящих соседей, обход останавливается на
+    max_nodes узлах. Узлы, не прошедшие node_filter, не включаются и не
+    раскрываются (корни включаются всегда). Связи - все связи между
+    включенными узлами с подходящим типом и направлением.
+    truncated=True, если сработал какой-либо лимит. None, если ни один
+    корень не найден
+    """
+    start = [graph.index[r] for r in dict.fromkeys(roots) if r in graph.index]
+    if not start:
+        return None
+    n = len(graph)
+    allowed = None
+    if relations is not None:
+        wanted = set(relations)
+        allowed = np.array([i for i, name in enumerate(graph.relation_names) if name in wanted], dtype=np.int32)
+    included = np.zeros(n, dtype=bool)
+    rejected = np.zeros(n, dtype=bool)
+    included[start] = True
+    order = list(start)
+    frontier = list(start)
+    truncated = False
+
+    def edge_mask(positions: slice) -> np.ndarray:
+        mask = np.ones(positions.stop - positions.start, dtype=bool)
+        if allowed is not None:
+            mask &= np.isin(graph.relations[positions], allowed)
+        if direction == "out":
+            mask &= graph.outgoing[positions]
+        elif direction == "in":
+            mask &= ~graph.outgoing[positions]
+        return mask
+
+    for _ in range(depth):
+        next_frontier = []
+        for i in frontier:
+            positions = graph.neighbor_slice(i)
+            targets = graph.targets[positions][edge_mask(positions)]
+            candidates = targets[~(included[targets] | rejected[targets])]
+            if len(candidates) > 1:
+                candidates = np.unique(candidates)
+            taken = 0
+            for j in candidates.tolist():
+                if taken >= max_fanout or len(order) >= max_nodes:
+                    truncated = True
+                    break
+                if node_filter is not None and not node_filter(graph.nodes[j]):
+                    rejected[j] = True
+                    continue
+                included[j] = True
+                order.append(j)
+                next_frontier.append(j)
+                taken += 1
+            if len(order) >= max_nodes:
+                break
+        frontier = next_frontier
+        if not frontier or len(order) >= max_nodes:
+            truncated = truncated or bool(frontier)
+            break
+
+    links = []
+    for i in order:
+        positions = graph.neighbor_slice(i)
+        # Каждая связь берется со стороны источника, чтобы не повторяться
+        mask = graph.outgoing[positions] & included[graph.targets[positions]]
+        if allowed is not None:
+            mask &= np.isin(graph.relations[positions], allowed)
+        for offset in np.nonzero(mask)[0].tolist():
+            links.append(graph.link(i, positions.start + offset))
+    return {
+        "nodes": [graph.nodes[i] for i in order],
+        "links": links,
+        "truncated": truncated,
+    }
+
+
+def load_user_graph(user_id: str, version: int = 0) -> CSRGraph:
+    nodes: List[Dict] = []
+    links: List[Dict] = []
+    with tenant_session(user_id) as session:
+        for kind, item in iter_user_graph(session, user_id):
+            (nodes if kind == "node" else links).append(item)
+    return CSRGraph(nodes, links, version)
+
+
+def load_graph_delta(user_id: str, node_ids: Set[str]):
+    """Узлы node_ids и их связи для CSRGraph.patched"""
+    nodes: List[Dict] = []
+    links: List[Dict] = []
+    with tenant_session(user_id) as session:
+        for kind, item in iter_nodes_with_links(session, user_id, sorted(node_ids)):
+            (nodes if kind == "node" else links).append(item)
+    return nodes, links
+
+
+class AdjacencyCache:
+    """LRU снимков CSR по пользователям с общим бюджетом памяти"""
+
+    def __init__(self, max_bytes: int, patch_max_nodes: int):
+        self.max_bytes = max_bytes
+        self.patch_max_nodes = patch_max_nodes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.patches = 0
+        self.patch_failures = 0
+        self._patch_locks = [threading.Lock() for _ in range(PATCH_LOCKS)]
+        self._graphs: "OrderedDict[str, CSRGraph]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id: str) -> int:
+        """Версия графа пользователя; растет с каждой записью"""
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def get(self, user_id: str) -> CSRGraph:
+        with self._lock:
+            graph = self._graphs.get(user_id)
+            if graph is not None:
+                self._graphs.move_to_end(user_id)
+                self.hits += 1
+                return graph
+            self.misses += 1
+            load_lock = self._load_locks.setdefault(user_id, threading.Lock())
+
+        # Один загрузчик на пользователя, остальные ждут его результат
+        with load_lock:
+            with self._lock:
+                graph = self._graphs.get(user_id)
+                version = self._versions.get(user_id, 0)
+            if graph is not None:
+                return graph
+            graph = load_user_graph(user_id, version)
+            with self._lock:
+                self._load_locks.pop(user_id, None)
+                # Запись, случившаяся во время загрузки, делает снимок устаревшим
+                if self._versions.get(user_id, 0) == version and graph.nbytes <= self.max_bytes:
+                    self._graphs[user_id] = graph
+                    self.nbytes += graph.nbytes
+                    while self.nbytes > self.max_bytes:
+                        _, evicted = self._graphs.popitem(last=False)
+                        self.nbytes -= evicted.nbytes
+            return graph
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._drop(user_id)
+
+    def _drop(self, user_id: str):
+        graph = self._graphs.pop(user_id, None)
+        if graph is not None:
+            self.nbytes -= graph.nbytes
+
+    def on_graph_change(self, change: GraphChange):
+        touched = change.touched_nodes
+        # Патч строится от предыдущего снимка, поэтому патчи пользователя
+        # не должны обгонять друг друга
+        with self._patch_locks[hash(change.user_id) % PATCH_LOCKS]:
+            with self._lock:
+                version = self._versions.get(change.user_id, 0) + 1
+                self._versions[change.user_id] = version
+                graph = self._graphs.get(change.user_id)
+                if graph is None:
+                    # Загрузка, идущая сейчас, увидит новую версию и не закэширует снимок
+                    return
+                if len(touched) > self.patch_max_nodes:
+                    self._drop(change.user_id)
+                    return
+            try:
+                patched = graph.patched(touched, *load_graph_delta(change.user_id, touched), version)
+            except Exception as e:
+                logger.warning(f"Adjacency patch for user {change.user_id} failed, dropping snapshot: {e}")
+                patched = None
+            with self._lock:
+                if self._graphs.get(change.user_id) is not graph:
+                    return
+                if patched is None:
+                    self.patch_failures += 1
+                if patched is None or self._versions.get(change.user_id) != version:
+                    self._drop(change.user_id)
+                    return
+                self._graphs[change.user_id] = patched
+                self.nbytes += patched.nbytes - graph.nbytes
+                self.patches += 1
+                while self.nbytes > self.max_bytes:
+                    _, evicted = self._graphs.popitem(last=False)
+                    self.nbytes -= evicted.nbytes
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "users": len(self._graphs),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "patches": self.patches,
+                "patch_failures": self.patch_failures,
+            }
+
+
+_cache: Optional[AdjacencyCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_adjacency_cache() -> AdjacencyCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            s = get_settings()
+            _cache = AdjacencyCache(s.adjacency_cache_mb * 1024 * 1024, s.adjacency_patch_max_nodes)
+            subscribe(_cache.on_graph_change)
+        return _cache
+
+
+def neighborhood(user_id: str, node_id: str, limit: Optional[int] = None) -> Optional[Dict]:
+    return get_adjacency_cache().get(user_id).neighborhood(node_id, limit)
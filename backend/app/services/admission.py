@@ -0,0 +1,257 @@
+"""
+Допуск запросов к дорогим эндпоинтам (LLM, импорт из Wikipedia).
+
+Каждый класс эндпоинтов (admission_classes в настройках) ограничивается:
+
+1. token bucket на пользователя - превышение дает 429 с Retry-After,
+   через сколько накопится токен;
+2. общий token bucket класса (лимиты провайдера LLM) - 503;
+3. лимит одновременных запросов с ограниченной очередью: если очередь
+   полна или ожидаемое время ожидания (позиция в очереди * среднее время
+   обработки / лимит) больше max_wait - 503 с этой оценкой в Retry-After.
+
+Проверки идут в цикле событий до того, как эндпоинт займет поток пула,
+так что шторм анализов не вытесняет дешевые запросы из пула потоков.
+
+Хранилище token bucket - RATE_BACKENDS: "memory" (один процесс) или
+"postgres" (общие лимиты для нескольких воркеров). Лимит одновременности
+всегда на процесс.
+"""
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple, Type
+import asyncio
+import math
+import threading
+import time
+import logging
+from fastapi import Depends, HTTPException, Request
+from sqlalchemy import text
+from ..core.config import get_settings
+from ..core.security import get_current_user
+from ..db.models import User
+from ..db.postgres import SessionLocal
+from .idempotency import IDEMPOTENCY_HEADER, completed
+
+logger = logging.getLogger(__name__)
+
+SERVICE_TIME_ALPHA = 0.2  # вес нового замера в скользящем среднем времени обработки
+
+
+@dataclass(frozen=True)
+class ClassLimits:
+    concurrency: int
+    queue: int
+    max_wait: float  # секунд в очереди
+    user_rate: float  # токенов в секунду
+    user_burst: float
+    global_rate: float
+    global_burst: float
+
+    @classmethod
+    def from_settings(cls, limits: Dict[str, float]) -> "ClassLimits":
+        return cls(**{**limits, "concurrency": int(limits["concurrency"]), "queue": int(limits["queue"])})
+
+
+class RateBackend:
+    """Хранилище token bucket"""
+
+    blocking = False  # take() ходит в сеть: вызывать вне цикла событий
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        """Снимает cost токенов; 0 - допущен, иначе через сколько секунд их хватит"""
+        raise NotImplementedError
+
+
+class InMemoryRateBackend(RateBackend):
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < cost:
+                self._buckets[key] = (tokens, now)
+                return (cost - tokens) / rate
+            self._buckets[key] = (tokens - cost, now)
+            return 0.0
+
+
+class PostgresRateBackend(RateBackend):
+    """Token bucket одной строкой rate_limit_buckets: пополнение и списание в одном UPSERT"""
+
+    blocking = True
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        params = {"key": key, "rate": rate, "burst": burst, "cost": cost}
+        db = SessionLocal()
+        try:
+            admitted = db.execute(text(
+                """
+                INSERT INTO rate_limit_buckets (key, tokens, updated_at)
+                VALUES (:key, :burst - :cost, clock_timestamp())
+                ON CONFLICT (key) DO UPDATE SET
+                    tokens = LEAST(:burst, rate_limit_buckets.tokens + :rate * EXTRACT(EPOCH FROM
+                             clock_timestamp() - rate_limit_buckets.updated_at)) - :cost,
+                    updated_at = clock_timestamp()
+                WHERE LEAST(:burst, rate_limit_buckets.tokens + :rate * EXTRACT(EPOCH FROM
+                      clock_timestamp() - rate_limit_buckets.updated_at)) >= :cost
+                RETURNING tokens
+                """
+            ), params).first()
+            if admitted is not None:
+                db.commit()
+                return 0.0
+            tokens = db.execute(text(
+                """
+                SELECT LEAST(:burst, tokens + :rate * EXTRACT(EPOCH FROM clock_timestamp() - updated_at))
+                FROM rate_limit_buckets WHERE key = :key
+                """
+            ), params).scalar() or 0.0
+            db.commit()
+            return max((cost - float(tokens)) / rate, 0.0)
+        finally:
+            db.close()
+
+
+RATE_BACKENDS: Dict[str, Type[RateBackend]] = {
+    "memory": InMemoryRateBackend,
+    "postgres": PostgresRateBackend,
+}
+
+
+class EndpointClass:
+    """Лимиты и метрики одного класса эндпоинтов"""
+
+    def __init__(self, name: str, limits: ClassLimits, backend: RateBackend):
+        self.name = name
+        self.limits = limits
+        self.backend = backend
+        self.active = 0
+        self.waiting = 0
+        self.service_time = 1.0  # скользящее среднее, секунд
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected_user_rate = 0
+        self.rejected_global_rate = 0
+        self.rejected_queue = 0
+        self.queue_timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def expected_wait(self, position: int) -> float:
+        return position * self.service_time / self.limits.concurrency
+
+    def check_rate(self, user_id: str):
+        limits = self.limits
+        wait = self.backend.take(f"{self.name}:user:{user_id}", limits.user_rate, limits.user_burst)
+        if wait > 0:
+            self._count("rejected_user_rate")
+            raise _rejection(429, f"Too many {self.name} requests, retry later", wait)
+        wait = self.backend.take(f"{self.name}:global", limits.global_rate, limits.global_burst)
+        if wait > 0:
+            self._count("rejected_global_rate")
+            raise _rejection(503, f"Service is busy with {self.name} requests, retry later", wait)
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limits.concurrency)
+        # waiting включает и тех, кто еще не успел занять свободный слот
+        position = max(self.active + self.waiting + 1 - self.limits.concurrency, 0)
+        estimate = self.expected_wait(position)
+        if position and (position > self.limits.queue or estimate > self.limits.max_wait):
+            self._count("rejected_queue")
+            raise _rejection(503, f"Too many concurrent {self.name} requests, retry later", estimate)
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.limits.max_wait)
+        except asyncio.TimeoutError:
+            self._count("queue_timeouts")
+            raise _rejection(503, f"Too many concurrent {self.name} requests, retry later",
+                             self.expected_wait(max(self.waiting, 1)))
+        finally:
+            self.waiting -= 1
+        waited = time.perf_counter() - started
+        self.active += 1
+        with self._lock:
+            self.admitted += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def release(self, service_time: float):
+        self.active -= 1
+        self.service_time += SERVICE_TIME_ALPHA * (service_time - self.service_time)
+        self._semaphore.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "waiting": self.waiting,
+                "concurrency": self.limits.concurrency,
+                "service_time_ms": round(self.service_time * 1000, 1),
+                "admitted": self.admitted,
+                "rejected_user_rate": self.rejected_user_rate,
+                "rejected_global_rate": self.rejected_global_rate,
+                "rejected_queue": self.rejected_queue,
+                "queue_timeouts": self.queue_timeouts,
+                "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 3) if self.admitted else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+def _rejection(status: int, detail: str, retry_after: float) -> HTTPException:
+    return HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+_classes: Dict[str, EndpointClass] = {}
+_classes_lock = threading.Lock()
+
+
+def get_endpoint_class(name: str) -> EndpointClass:
+    with _classes_lock:
+        if not _classes:
+            s = get_settings()
+            backend = RATE_BACKENDS[s.rate_limit_backend]()
+            for class_name, limits in s.admission_classes.items():
+                _classes[class_name] = EndpointClass(class_name, ClassLimits.from_settings(limits), backend)
+        return _classes[name]
+
+
+def admission_stats() -> Dict:
+    get_endpoint_class(next(iter(get_settings().admission_classes)))
+    return {name: endpoint_class.stats() for name, endpoint_class in _classes.items()}
+
+
+def admit(class_name: str) -> Callable[..., AsyncIterator[None]]:
+    """
+    Зависимость FastAPI: Depends(admit("llm")). Выполняется в цикле событий
+    до тела эндпоинта и держит слот до его завершения. Повтор запроса с уже
+    выполненным Idempotency-Key допускается без слота и токена
+    """
+    async def dependency(request: Request, current_user: User = Depends(get_current_user)) -> AsyncIterator[None]:
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key and await asyncio.to_thread(completed, str(current_user.id), key):
+            yield
+            return
+        endpoint_class = get_endpoint_class(class_name)
+        if endpoint_class.backend.blocking:
+            await asyncio.to_thread(endpoint_class.check_rate, str(current_user.id))
+        else:
+            endpoint_class.check_rate(str(current_user.id))
+        await endpoint_class.acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            endpoint_class.release(time.perf_counter() - started)
+
+    return dependency
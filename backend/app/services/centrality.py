@@ -0,0 +1,249 @@
+"""
+Центральность узлов графа пользователя: PageRank и степень.
+
+Оценки пересчитываются в фоне после каждой серии записей (graph_events)
+локально: от прошлого вектора (в памяти, а после перезапуска - сохраненного
+на узлах) считается невязка уравнения PageRank, и она проталкивается
+(residual push) только от узлов, где превышает порог, - то есть в
+окрестности изменившихся узлов. Если проталкиваний слишком много (запись
+задела хабы или большую часть графа), выполняется полный пересчет с
+теплого старта. В Neo4j пишутся только изменившиеся оценки. По ним во
+всем графе повышаются уровни: узел первого уровня с высокой
+центральностью становится центральным (0). Оценки на узлах (pagerank,
+degree) анализ заметки использует для выбора главного концепта без
+дополнительных запросов.
+
+PageRank считается по неориентированному графу: направления связей в
+графе знаний смешанные, а важность концепта не зависит от того, с какой
+стороны его упомянули. Нормирован так, что средний узел имеет оценку 1.
+"""
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+import threading
+import time
+import logging
+import numpy as np
+from ..core.config import get_settings
+from ..db.tenancy import tenant_session
+from .adjacency import CSRGraph, get_adjacency_cache
+from .graph_events import LAYOUT, GraphChange, publish, subscribe
+from .workers import DebouncedUserWorker
+
+logger = logging.getLogger(__name__)
+
+DAMPING = 0.85
+TOLERANCE = 1e-4  # максимальный шаг итерации в единицах оценки (средняя 1)
+MAX_ITERATIONS = 200
+PUSH_TOLERANCE = 2e-4  # невязка меньше не проталкивается; больше погрешности округления хранимых оценок
+PUSH_EDGE_RATIO = 20  # проталкиваний больше (связей / 20) - дороже полного пересчета
+MIN_PUSH_BUDGET = 2000
+SCORE_EPSILON = 1e-3  # изменения меньше не записываются в Neo4j
+
+
+def pagerank(graph: CSRGraph, initial: Optional[np.ndarray] = None) -> np.ndarray:
+    """PageRank по CSR (обе стороны связей), нормированный к среднему 1"""
+    n = len(graph)
+    if n == 0:
+        return np.zeros(0)
+    degree = np.diff(graph.offsets).astype(np.float64)
+    heads = np.repeat(np.arange(n), np.diff(graph.offsets))
+    dangling = degree == 0
+    rank = initial / initial.sum() if initial is not None and initial.sum() > 0 else np.full(n, 1.0 / n)
+    safe_degree = np.where(dangling, 1.0, degree)
+    for _ in range(MAX_ITERATIONS):
+        share = rank / safe_degree
+        spread = np.bincount(graph.targets, weights=share[heads], minlength=n)
+        new_rank = (1 - DAMPING) / n + DAMPING * (spread + rank[dangling].sum() / n)
+        delta = np.abs(new_rank - rank).max() * n
+        rank = new_rank
+        if delta < TOLERANCE:
+            break
+    return rank * n
+
+
+def pagerank_push(graph: CSRGraph, initial: np.ndarray, budget: int) -> Optional[np.ndarray]:
+    """
+    Дорешивает PageRank (в нормировке pagerank) от приближения initial:
+    невязка r = (1 - d) + d * (приток от соседей + висячие / n) - x узла
+    переносится в его оценку, а d * r / степень - в невязку соседей.
+    Работа пропорциональна области, где оценки действительно меняются.
+    None, если понадобилось больше budget проталкиваний
+    """
+    n = len(graph)
+    if n == 0:
+        return np.zeros(0)
+    counts = np.diff(graph.offsets)
+    degree = counts.astype(np.float64)
+    dangling = counts == 0
+    heads = np.repeat(np.arange(n), counts)
+    x = initial.astype(np.float64)
+    spread = np.bincount(graph.targets, weights=(x / np.where(dangling, 1.0, degree))[heads], minlength=n)
+    residual = (1 - DAMPING) + DAMPING * (spread + x[dangling].sum() / n) - x
+    # Невязка изолированных узлов делится поровну между всеми
+    uniform = 0.0
+    pushes = 0
+    while True:
+        queued = np.abs(residual) > PUSH_TOLERANCE
+        queue = deque(np.nonzero(queued)[0].tolist())
+        while queue:
+            i = queue.popleft()
+            queued[i] = False
+            r = residual[i]
+            if abs(r) <= PUSH_TOLERANCE:
+                continue
+            pushes += 1
+            if pushes > budget:
+                return None
+            x[i] += r
+            residual[i] = 0.0
+            if dangling[i]:
+                uniform += DAMPING * r / n
+                continue
+            neighbors = graph.targets[graph.offsets[i]:graph.offsets[i + 1]]
+            np.add.at(residual, neighbors, DAMPING * r / degree[i])
+            for j in neighbors[np.abs(residual[neighbors]) > PUSH_TOLERANCE].tolist():
+                if not queued[j]:
+                    queued[j] = True
+                    queue.append(j)
+        if abs(uniform) <= PUSH_TOLERANCE:
+            return x + uniform
+        residual += uniform
+        uniform = 0.0
+
+
+class UserCentrality:
+    def __init__(self, ids: List[str], scores: np.ndarray, degrees: np.ndarray):
+        self.scores = dict(zip(ids, scores.tolist()))
+        self.degrees = dict(zip(ids, degrees.tolist()))
+
+
+class CentralityService:
+    """Оценки по пользователям (LRU) и фоновый пересчет после записей"""
+
+    def __init__(self, max_users: int):
+        s = get_settings()
+        self.max_users = max_users
+        self.promote_score = s.centrality_promote_score
+        self.promote_min_degree = s.centrality_promote_min_degree
+        self._users: "OrderedDict[str, UserCentrality]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.worker = DebouncedUserWorker("graph-centrality", self.recompute, s.centrality_debounce)
+
+    def get(self, user_id: str) -> Optional[UserCentrality]:
+        """Последние посчитанные оценки; None - еще не считались в этом процессе"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+            return entry
+
+    def _remember(self, user_id: str, entry: UserCentrality):
+        with self._lock:
+            self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def on_graph_change(self, change: GraphChange):
+        # Координаты раскладки не меняют структуру графа
+        if change.source == LAYOUT:
+            return
+        self.worker.schedule(change.user_id)
+
+    def _stored(self, user_id: str) -> Optional[UserCentrality]:
+        """Оценки, сохраненные на узлах (после перезапуска процесса)"""
+        with tenant_session(user_id) as session:
+            result = session.run(
+                """
+                MATCH (n:Node {user_id: $user_id})
+                WHERE n.pagerank IS NOT NULL
+                RETURN n.id AS id, n.pagerank AS pagerank, n.degree AS degree
+                """,
+                user_id=user_id,
+            )
+            rows = [(record["id"], record["pagerank"], record["degree"]) for record in result]
+        if not rows:
+            return None
+        ids, scores, degrees = zip(*rows)
+        return UserCentrality(list(ids), np.array(scores), np.array([-1 if d is None else d for d in degrees]))
+
+    def recompute(self, user_id: str):
+        started = time.perf_counter()
+        graph = get_adjacency_cache().get(user_id)
+        previous = self.get(user_id) or self._stored(user_id)
+        degrees = np.diff(graph.offsets)
+        mode = "full"
+        if previous is None:
+            scores = pagerank(graph)
+            old_scores = np.full(len(graph), np.nan)
+            old_degrees = np.full(len(graph), -1)
+        else:
+            old_scores = np.array([previous.scores.get(node_id, np.nan) for node_id in graph.ids])
+            old_degrees = np.array([previous.degrees.get(node_id, -1) for node_id in graph.ids])
+            # Новые узлы стартуют со средней оценкой 1
+            initial = np.where(np.isnan(old_scores), 1.0, old_scores)
+            budget = max(MIN_PUSH_BUDGET, len(graph.targets) // PUSH_EDGE_RATIO)
+            scores = pagerank_push(graph, initial, budget)
+            if scores is None:
+                scores = pagerank(graph, initial)
+            else:
+                mode = "push"
+        self._remember(user_id, UserCentrality(graph.ids, scores, degrees))
+
+        changed_mask = np.isnan(old_scores) | (np.abs(scores - old_scores) > SCORE_EPSILON) | (old_degrees != degrees)
+        changed = [
+            {"id": graph.ids[i], "pagerank": round(float(scores[i]), 4), "degree": int(degrees[i])}
+            for i in np.nonzero(changed_mask)[0].tolist()
+        ]
+        promoted = [
+            graph.ids[i]
+            for i in np.nonzero((scores >= self.promote_score) & (degrees >= self.promote_min_degree))[0].tolist()
+            if graph.nodes[i].get("level") == 1
+        ]
+        self._store(user_id, changed, promoted)
+        logger.info(
+            f"Centrality for user {user_id} ({mode}): {len(graph)} nodes, {len(changed)} updated, "
+            f"{len(promoted)} promoted in {time.perf_counter() - started:.2f}s"
+        )
+        if promoted:
+            publish(GraphChange(user_id, upserted_nodes=set(promoted)))
+
+    def _store(self, user_id: str, changed: List[Dict], promoted: List[str]):
+        if not changed and not promoted:
+            return
+        with tenant_session(user_id) as session:
+            for start in range(0, len(changed), 1000):
+                session.run(
+                    """
+                    UNWIND $rows AS row
+                    MATCH (n:Node {id: row.id, user_id: $user_id})
+                    SET n.pagerank = row.pagerank, n.degree = row.degree
+                    """,
+                    rows=changed[start:start + 1000],
+                    user_id=user_id,
+                )
+            if promoted:
+                session.run(
+                    """
+                    MATCH (n:Node {user_id: $user_id})
+                    WHERE n.id IN $ids AND n.level = 1
+                    SET n.level = 0
+                    """,
+                    ids=promoted,
+                    user_id=user_id,
+                )
+                logger.info(f"Nodes {promoted} promoted to level 0 by centrality")
+
+
+_service: Optional[CentralityService] = None
+_service_lock = threading.Lock()
+
+
+def get_centrality_service() -> CentralityService:
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = CentralityService(get_settings().cluster_cache_users)
+            subscribe(_service.on_graph_change)
+        return _service
+
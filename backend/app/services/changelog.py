@@ -0,0 +1,338 @@
+"""
+Журнал изменений графа для дельта-синхронизации клиентов.
+
+Каждое событие graph_events записывается в Postgres (graph_changes) с
+монотонным seq. GET /graph/changes?since=N отдает только то, что изменилось
+после N: актуальные узлы и связи и удаления (tombstones). Удаление узла
+подразумевает удаление всех его связей.
+
+Сжатие журнала убирает записи, перекрытые более поздними по тому же ключу,
+и удаления старше срока хранения; для таких пользователей запоминается
+водяной знак, и клиент со since ниже него получает reset (полная загрузка).
+
+Журнал - общий для процессов: запись CLI-задания (dedup, compaction) или
+другого воркера не доходит до graph_events этого процесса, и его кэши
+(смежность, кластеры, центральность, раскладка) остались бы устаревшими.
+Поэтому ChangeLog следит за журналом (changelog_follow_interval): чужие
+записи публикуются здесь как GraphChange с source=CHANGELOG, свои (seq
+запоминаются при вставке) пропускаются.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+import threading
+import time
+import uuid
+import logging
+from sqlalchemy import func, insert, or_, select, text
+from ..core.config import get_settings
+from ..db.postgres import SessionLocal
+from ..db.models import GraphChangeEntry, GraphChangeWatermark
+from ..db.tenancy import tenant_session
+from .knowledge import node_to_dict
+from .graph_events import CHANGELOG, GraphChange, publish, subscribe
+
+logger = logging.getLogger(__name__)
+
+NODE = "node"
+LINK = "link"
+UPSERT = "upsert"
+DELETE = "delete"
+
+FOLLOW_GAP_TIMEOUT = 60.0  # сколько ждать пропуски seq (транзакции коммитятся не по порядку seq)
+FOLLOW_MAX_GAP = 10000  # больший пропуск - сжатие журнала, а не незакоммиченные записи
+
+
+def link_key(source: str, target: str, relation: str) -> str:
+    return f"{source}\t{target}\t{relation}"
+
+
+def _rows(change: GraphChange) -> List[Dict]:
+    user_id = uuid.UUID(change.user_id)
+    rows = []
+    # Удаления раньше вставок: если в пакете есть и то и другое, побеждает вставка
+    for node_id in sorted(change.deleted_nodes):
+        rows.append({"user_id": user_id, "entity": NODE, "op": DELETE, "key": node_id, "data": None})
+    for source, target, relation in change.deleted_links:
+        rows.append({
+            "user_id": user_id, "entity": LINK, "op": DELETE, "key": link_key(source, target, relation),
+            "data": {"source": source, "target": target, "relation": relation},
+        })
+    for node_id in sorted(change.upserted_nodes):
+        rows.append({"user_id": user_id, "entity": NODE, "op": UPSERT, "key": node_id, "data": None})
+    for source, target, relation in change.upserted_links:
+        rows.append({
+            "user_id": user_id, "entity": LINK, "op": UPSERT, "key": link_key(source, target, relation),
+            "data": {"source": source, "target": target, "relation": relation},
+        })
+    return rows
+
+
+def record_change(change: GraphChange):
+    """Подписчик graph_events: одна вставка на пакет изменений"""
+    if change.source == CHANGELOG:
+        return  # уже в журнале
+    rows = _rows(change)
+    db = SessionLocal()
+    try:
+        # Записи одного пользователя сериализуются, чтобы seq коммитились по
+        # порядку и клиент, прочитавший seq=N, не пропустил более ранний seq
+        db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:user_id))"), {"user_id": change.user_id})
+        seqs = db.execute(insert(GraphChangeEntry).returning(GraphChangeEntry.seq), rows).scalars().all()
+        # До COMMIT, чтобы слежение за журналом не приняло свою запись за чужую
+        if _changelog is not None:
+            _changelog.remember_own(seqs)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _replayed_changes(rows) -> List[GraphChange]:
+    changes: Dict[str, GraphChange] = {}
+    for row in rows:
+        user_id = str(row.user_id)
+        change = changes.setdefault(user_id, GraphChange(user_id, source=CHANGELOG))
+        if row.entity == NODE:
+            (change.upserted_nodes if row.op == UPSERT else change.deleted_nodes).add(row.key)
+        else:
+            link = (row.data["source"], row.data["target"], row.data["relation"])
+            (change.upserted_links if row.op == UPSERT else change.deleted_links).append(link)
+    return list(changes.values())
+
+
+def current_seq(user_id: str) -> int:
+    """Последний seq пользователя - точка отсчета для клиента после полной загрузки"""
+    db = SessionLocal()
+    try:
+        uid = uuid.UUID(user_id)
+        seq = db.scalar(select(func.max(GraphChangeEntry.seq)).where(GraphChangeEntry.user_id == uid))
+        if seq is None:
+            seq = db.scalar(select(GraphChangeWatermark.seq).where(GraphChangeWatermark.user_id == uid))
+        return seq or 0
+    finally:
+        db.close()
+
+
+def _fetch_nodes(user_id: str, node_ids: List[str]) -> Dict[str, Dict]:
+    if not node_ids:
+        return {}
+    with tenant_session(user_id) as session:
+        result = session.run(
+            "MATCH (n:Node {user_id: $user_id}) WHERE n.id IN $ids RETURN n",
+            user_id=user_id,
+            ids=node_ids,
+        )
+        return {record["n"]["id"]: node_to_dict(record["n"]) for record in result}
+
+
+def changes_since(user_id: str, since: int, limit: Optional[int] = None) -> Dict:
+    """
+    Свернутые изменения после since: по каждому узлу/связи - последнее
+    состояние. Узлы берутся из Neo4j в текущем виде; узел, которого уже нет,
+    попадает в deleted_nodes. Если записей больше limit, has_more=True и
+    следующий запрос продолжает с возвращенного seq
+    """
+    limit = limit or get_settings().changelog_page_size
+    uid = uuid.UUID(user_id)
+    db = SessionLocal()
+    try:
+        watermark = db.scalar(select(GraphChangeWatermark.seq).where(GraphChangeWatermark.user_id == uid)) or 0
+        if since < watermark:
+            return {"since": since, "seq": current_seq(user_id), "reset": True, "has_more": False,
+                    "nodes": [], "deleted_nodes": [], "links": [], "deleted_links": []}
+        entries = db.execute(
+            select(GraphChangeEntry.seq, GraphChangeEntry.entity, GraphChangeEntry.op,
+                   GraphChangeEntry.key, GraphChangeEntry.data)
+            .where(GraphChangeEntry.user_id == uid, GraphChangeEntry.seq > since)
+            .order_by(GraphChangeEntry.seq)
+            .limit(limit + 1)
+        ).all()
+    finally:
+        db.close()
+
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    latest: Dict[Tuple[str, str], Tuple[str, Optional[Dict]]] = {}
+    for entry in entries:
+        latest[(entry.entity, entry.key)] = (entry.op, entry.data)
+
+    upserted_ids = sorted(key for (entity, key), (op, _) in latest.items() if entity == NODE and op == UPSERT)
+    nodes = _fetch_nodes(user_id, upserted_ids)
+    deleted_nodes = sorted(
+        {key for (entity, key), (op, _) in latest.items() if entity == NODE and op == DELETE}
+        | (set(upserted_ids) - nodes.keys())
+    )
+    gone = set(deleted_nodes)
+    links, deleted_links = [], []
+    for (entity, _), (op, data) in sorted(latest.items()):
+        if entity != LINK:
+            continue
+        if op == DELETE:
+            deleted_links.append(data)
+        elif data["source"] not in gone and data["target"] not in gone:
+            links.append(data)
+    return {
+        "since": since,
+        "seq": entries[-1].seq if entries else max(since, current_seq(user_id)),
+        "reset": False,
+        "has_more": has_more,
+        "nodes": [nodes[node_id] for node_id in upserted_ids if node_id in nodes],
+        "deleted_nodes": deleted_nodes,
+        "links": links,
+        "deleted_links": deleted_links,
+    }
+
+
+def compact(retention_days: Optional[int] = None) -> Dict[str, int]:
+    """
+    Сжимает журнал:
+    1. записи, перекрытые более поздней записью того же ключа;
+    2. связи узлов, удаленных позже (удаление узла их и так отменяет);
+    3. удаления старше retention_days - с подъемом водяного знака пользователя
+    """
+    retention_days = retention_days if retention_days is not None else get_settings().changelog_retention_days
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    db = SessionLocal()
+    try:
+        superseded = db.execute(text(
+            """
+            DELETE FROM graph_changes g
+            USING graph_changes h
+            WHERE h.user_id = g.user_id AND h.entity = g.entity AND h.key = g.key AND h.seq > g.seq
+            """
+        )).rowcount
+        orphaned = db.execute(text(
+            """
+            DELETE FROM graph_changes l
+            USING graph_changes d
+            WHERE l.entity = 'link' AND d.entity = 'node' AND d.op = 'delete'
+              AND d.user_id = l.user_id AND d.seq > l.seq
+              AND (l.data->>'source' = d.key OR l.data->>'target' = d.key)
+            """
+        )).rowcount
+        expired = db.execute(text(
+            """
+            WITH expired AS (
+                DELETE FROM graph_changes
+                WHERE op = 'delete' AND created_at < :cutoff
+                RETURNING user_id, seq
+            ), marks AS (
+                INSERT INTO graph_change_watermarks (user_id, seq)
+                SELECT user_id, max(seq) FROM expired GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE
+                SET seq = GREATEST(graph_change_watermarks.seq, EXCLUDED.seq)
+            )
+            SELECT count(*) FROM expired
+            """
+        ), {"cutoff": cutoff}).scalar()
+        db.commit()
+    finally:
+        db.close()
+    stats = {"superseded": superseded, "orphaned_links": orphaned, "expired_tombstones": expired}
+    logger.info(f"Graph change log compacted: {stats}")
+    return stats
+
+
+class ChangeLog:
+    """Подписка на события графа, слежение за чужими записями и периодическое сжатие журнала"""
+
+    def __init__(self):
+        s = get_settings()
+        self.interval = s.changelog_compact_interval
+        self.follow_interval = s.changelog_follow_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._follow_thread: Optional[threading.Thread] = None
+        self._own: Dict[int, float] = {}  # seq своих записей -> когда записаны
+        self._own_lock = threading.Lock()
+        self._last_seq: Optional[int] = None
+        self._gaps: Dict[int, float] = {}  # пропущенные seq -> когда замечены
+        self.replayed = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="graph-changelog-compact", daemon=True)
+        self._thread.start()
+        self._follow_thread = threading.Thread(target=self._follow, name="graph-changelog-follow", daemon=True)
+        self._follow_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in (self._thread, self._follow_thread):
+            if thread is not None:
+                thread.join(timeout=5)
+        self._thread = None
+        self._follow_thread = None
+
+    def remember_own(self, seqs: List[int]):
+        now = time.monotonic()
+        with self._own_lock:
+            for seq in seqs:
+                self._own[seq] = now
+
+    def follow_once(self):
+        """Публикует записи журнала, сделанные другими процессами после прошлого вызова"""
+        db = SessionLocal()
+        try:
+            if self._last_seq is None:
+                # Старт процесса: кэши пусты, прошлое переигрывать не нужно
+                self._last_seq = db.scalar(select(func.max(GraphChangeEntry.seq))) or 0
+                return
+            condition = GraphChangeEntry.seq > self._last_seq
+            if self._gaps:
+                condition = or_(condition, GraphChangeEntry.seq.in_(list(self._gaps)))
+            rows = db.execute(
+                select(
+                    GraphChangeEntry.seq, GraphChangeEntry.user_id, GraphChangeEntry.entity,
+                    GraphChangeEntry.op, GraphChangeEntry.key, GraphChangeEntry.data,
+                ).where(condition).order_by(GraphChangeEntry.seq)
+            ).all()
+        finally:
+            db.close()
+
+        now = time.monotonic()
+        foreign = []
+        with self._own_lock:
+            for row in rows:
+                self._gaps.pop(row.seq, None)
+                if row.seq > self._last_seq:
+                    if row.seq - self._last_seq <= FOLLOW_MAX_GAP:
+                        for missing in range(self._last_seq + 1, row.seq):
+                            self._gaps[missing] = now
+                    self._last_seq = row.seq
+                if self._own.pop(row.seq, None) is None:
+                    foreign.append(row)
+            # Незакоммиченная запись давно бы появилась: пропуск - откат или сжатие
+            self._gaps = {seq: seen for seq, seen in self._gaps.items() if now - seen < FOLLOW_GAP_TIMEOUT}
+            self._own = {seq: seen for seq, seen in self._own.items() if now - seen < FOLLOW_GAP_TIMEOUT}
+        for change in _replayed_changes(foreign):
+            self.replayed += 1
+            publish(change)
+
+    def _follow(self):
+        while not self._stop.wait(self.follow_interval):
+            try:
+                self.follow_once()
+            except Exception as e:
+                logger.error(f"Graph change log follow failed: {e}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                compact()
+            except Exception as e:
+                logger.error(f"Graph change log compaction failed: {e}")
+
+
+_changelog: Optional[ChangeLog] = None
+_changelog_lock = threading.Lock()
+
+
+def get_change_log() -> ChangeLog:
+    global _changelog
+    with _changelog_lock:
+        if _changelog is None:
+            _changelog = ChangeLog()
+            subscribe(record_change)
+        return _changelog
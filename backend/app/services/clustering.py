@@ -0,0 +1,300 @@
+"""
+Кластеризация графа пользователя для обзорного (LOD) представления.
+
+Сообщества ищутся по модулярности (локальные перемещения Louvain) по связям.
+Результат кэшируется на пользователя; после записи в граф пересчитываются
+только затронутые узлы и их окрестность, стартуя с прежних меток. Связи
+берутся из снимка кэша смежности (services.adjacency), который сам
+обновляется по событиям: в хранимой смежности заменяются только строки
+затронутых узлов, без повторного чтения графа из Neo4j.
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+import threading
+import logging
+from ..core.config import get_settings
+from .adjacency import CSRGraph, get_adjacency_cache
+from .graph_events import LAYOUT, GraphChange, subscribe
+
+logger = logging.getLogger(__name__)
+
+ISOLATED_CLUSTER = "__isolated__"
+OTHER_CLUSTER = "__other__"
+MAX_ITERATIONS = 20
+
+
+def local_moving(
+    adjacency: Dict[str, Dict[str, int]],
+    labels: Dict[str, str],
+    active: Optional[Iterable[str]] = None,
+    max_iterations: int = MAX_ITERATIONS,
+) -> Dict[str, str]:
+    """
+    Фаза локальных перемещений Louvain: узел переходит в соседнее сообщество,
+    если это увеличивает модулярность. Обрабатываются только узлы из active
+    (по умолчанию все); переход узла активирует его соседей.
+    Обход и разбор ничьих детерминированы
+    """
+    degree = {node: sum(neighbors.values()) for node, neighbors in adjacency.items()}
+    two_m = sum(degree.values())
+    if not two_m:
+        return labels
+    total: Dict[str, float] = {}
+    for node, label in labels.items():
+        total[label] = total.get(label, 0) + degree.get(node, 0)
+
+    frontier = set(adjacency if active is None else active) & adjacency.keys()
+    for _ in range(max_iterations):
+        if not frontier:
+            break
+        next_frontier: Set[str] = set()
+        for node in sorted(frontier):
+            k = degree[node]
+            if not k:
+                continue
+            current = labels[node]
+            weights: Dict[str, float] = {}
+            for neighbor, w in adjacency[node].items():
+                if neighbor != node:
+                    label = labels[neighbor]
+                    weights[label] = weights.get(label, 0) + w
+            total[current] -= k
+            best = current
+            best_gain = weights.get(current, 0) - total[current] * k / two_m
+            for label in sorted(weights):
+                gain = weights[label] - total[label] * k / two_m
+                if gain > best_gain + 1e-12:
+                    best, best_gain = label, gain
+            total[best] = total.get(best, 0) + k
+            if best != current:
+                labels[node] = best
+                next_frontier.update(adjacency[node])
+        frontier = next_frontier
+    return labels
+
+
+def detect_communities(
+    adjacency: Dict[str, Dict[str, int]],
+    labels: Dict[str, str],
+    active: Optional[Iterable[str]] = None,
+) -> Dict[str, str]:
+    """
+    Два уровня Louvain: локальные перемещения узлов (с теплым стартом из
+    labels), затем те же перемещения на графе сообществ, чтобы слить мелкие
+    """
+    labels = local_moving(adjacency, labels, active)
+
+    community_graph: Dict[str, Dict[str, int]] = {}
+    for node, neighbors in adjacency.items():
+        a = labels[node]
+        row = community_graph.setdefault(a, {})
+        for neighbor, w in neighbors.items():
+            b = labels[neighbor]
+            row[b] = row.get(b, 0) + w
+    merged = local_moving(community_graph, {c: c for c in community_graph})
+    return {node: merged[label] for node, label in labels.items()}
+
+
+class UserClusters:
+    """Снимок графа пользователя и назначения кластеров"""
+
+    def __init__(self):
+        self.nodes: Dict[str, Dict] = {}
+        self.adjacency: Dict[str, Dict[str, int]] = {}  # неориентированные связи с весом
+        self.links: Dict[tuple, int] = {}  # (source, target) -> число связей
+        self.labels: Dict[str, str] = {}
+        self.dirty: Set[str] = set()
+        self.stale = True
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _remove(self, node_id: str):
+        for neighbor in self.adjacency.pop(node_id, {}):
+            row = self.adjacency.get(neighbor)
+            if row is not None:
+                row.pop(node_id, None)
+            self.links.pop((node_id, neighbor), None)
+            self.links.pop((neighbor, node_id), None)
+        self.nodes.pop(node_id, None)
+
+    def apply(self, graph: CSRGraph, touched: Optional[Set[str]] = None):
+        """
+        Заменяет узлы touched (по умолчанию все) и их связи данными снимка
+        graph; узел, которого в снимке нет, удаляется
+        """
+        if touched is None:
+            self.nodes, self.adjacency, self.links = {}, {}, {}
+            touched = set(graph.ids)
+        for node_id in touched:
+            self._remove(node_id)
+        present = [(node_id, graph.index[node_id]) for node_id in touched if node_id in graph.index]
+        for node_id, i in present:
+            node = graph.nodes[i]
+            self.nodes[node_id] = {
+                "label": node.get("label") or node_id,
+                "has_gap": bool(node.get("has_gap")),
+                "level": node.get("level"),
+            }
+            self.adjacency.setdefault(node_id, {})
+        for node_id, i in present:
+            positions = graph.neighbor_slice(i)
+            for j, outgoing in zip(graph.targets[positions].tolist(), graph.outgoing[positions].tolist()):
+                other = graph.ids[j]
+                # Связь двух затронутых узлов видна с обеих сторон - учитывается у источника
+                if other == node_id or (other in touched and not outgoing):
+                    continue
+                row = self.adjacency[node_id]
+                row[other] = row.get(other, 0) + 1
+                back = self.adjacency.setdefault(other, {})
+                back[node_id] = back.get(node_id, 0) + 1
+                key = (node_id, other) if outgoing else (other, node_id)
+                self.links[key] = self.links.get(key, 0) + 1
+
+    def refresh(self, user_id: str):
+        first = not self.labels
+        cache = get_adjacency_cache()
+        graph = cache.get(user_id)
+        if not self.loaded:
+            self.apply(graph)
+            self.loaded = True
+        else:
+            self.apply(graph, self.dirty)
+        # Снимок отстает от идущей записи: затронутые узлы применятся еще раз
+        current = graph.version == cache.version(user_id)
+        if first:
+            labels = {node: node for node in self.adjacency}
+            self.labels = detect_communities(self.adjacency, labels)
+        else:
+            # Прежние метки для оставшихся узлов, новые узлы - своя метка
+            labels = {node: self.labels.get(node, node) for node in self.adjacency}
+            active = {node for node in self.adjacency if node not in self.labels} | self.dirty
+            for node in list(active):
+                active |= self.adjacency.get(node, {}).keys()
+            self.labels = detect_communities(self.adjacency, labels, active)
+        if current:
+            self.dirty.clear()
+            self.stale = False
+
+    def cluster_of(self, node_id: str) -> str:
+        if not self.adjacency.get(node_id):
+            return ISOLATED_CLUSTER
+        return self.labels[node_id]
+
+    def members(self) -> Dict[str, List[str]]:
+        clusters: Dict[str, List[str]] = {}
+        for node_id in self.nodes:
+            clusters.setdefault(self.cluster_of(node_id), []).append(node_id)
+        return clusters
+
+
+class ClusterCache:
+    """LRU кэш кластеров по пользователям"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users: "OrderedDict[str, UserClusters]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, user_id: str) -> UserClusters:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = UserClusters()
+                self._users[user_id] = entry
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return entry
+
+    def get(self, user_id: str) -> UserClusters:
+        entry = self._entry(user_id)
+        with entry.lock:
+            if entry.stale:
+                entry.refresh(user_id)
+        return entry
+
+    def on_graph_change(self, change: GraphChange):
+        if change.source == LAYOUT:
+            return
+        with self._lock:
+            entry = self._users.get(change.user_id)
+        if entry is None:
+            return
+        with entry.lock:
+            entry.dirty |= change.touched_nodes
+            entry.stale = True
+
+
+_cache: Optional[ClusterCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cluster_cache() -> ClusterCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ClusterCache(get_settings().cluster_cache_users)
+            # Кэш смежности подписывается раньше: к пометке stale его снимок уже обновлен
+            get_adjacency_cache()
+            subscribe(_cache.on_graph_change)
+        return _cache
+
+
+def _ranked_clusters(state: UserClusters, max_clusters: int) -> List[tuple]:
+    """Кластеры по убыванию размера; хвост сверх лимита сворачивается в OTHER_CLUSTER"""
+    clusters = state.members()
+    ranked = sorted(clusters.items(), key=lambda kv: (kv[0] == ISOLATED_CLUSTER, -len(kv[1]), kv[0]))
+    if len(ranked) > max_clusters:
+        folded = [node for _, members in ranked[max_clusters - 1:] for node in members]
+        ranked = ranked[:max_clusters - 1] + [(OTHER_CLUSTER, folded)]
+    return ranked
+
+
+def graph_overview(user_id: str, max_clusters: Optional[int] = None) -> Dict:
+    """
+    Супер-узлы (кластеры) с числом участников и агрегированными пробелами,
+    и связи между кластерами с весом. Мелкие кластеры сверх лимита
+    сворачиваются в один OTHER_CLUSTER
+    """
+    max_clusters = max_clusters or get_settings().overview_max_clusters
+    state = get_cluster_cache().get(user_id)
+    with state.lock:
+        ranked = _ranked_clusters(state, max_clusters)
+        cluster_id = {node: cid for cid, members in ranked for node in members}
+
+        super_nodes = []
+        for cid, members in ranked:
+            # Название кластера - самый связанный участник
+            head = max(members, key=lambda n: (len(state.adjacency.get(n, ())), -len(n), n))
+            gaps = sum(1 for n in members if state.nodes[n]["has_gap"])
+            levels = [state.nodes[n]["level"] for n in members if state.nodes[n]["level"] is not None]
+            super_nodes.append({
+                "id": cid,
+                "label": state.nodes[head]["label"],
+                "size": len(members),
+                "gap_count": gaps,
+                "has_gap": gaps > 0,
+                "level": min(levels) if levels else None,
+            })
+
+        weights: Dict[tuple, int] = {}
+        for (source, target), count in state.links.items():
+            a, b = cluster_id.get(source), cluster_id.get(target)
+            if a is None or b is None or a == b:
+                continue
+            key = (a, b) if a < b else (b, a)
+            weights[key] = weights.get(key, 0) + count
+        super_links = [
+            {"source": a, "target": b, "weight": w}
+            for (a, b), w in sorted(weights.items())
+        ]
+    return {"nodes": super_nodes, "links": super_links, "total_nodes": len(state.nodes)}
+
+
+def cluster_members(user_id: str, cluster: str, max_clusters: Optional[int] = None) -> Optional[List[str]]:
+    """Идентификаторы узлов кластера (в том же разбиении, что и обзор)"""
+    max_clusters = max_clusters or get_settings().overview_max_clusters
+    state = get_cluster_cache().get(user_id)
+    with state.lock:
+        members = dict(_ranked_clusters(state, max_clusters)).get(cluster)
+    return sorted(members) if members is not None else None
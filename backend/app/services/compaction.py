@@ -0,0 +1,198 @@
+"""
+Сжатие разросшихся узлов графа.
+
+При каждом совпадении концепта merge_node_data дописывал новое описание
+к summary и объединял пробелы и рекомендации без ограничений, так что
+узлы, о которых пишут часто, копили повторяющиеся абзацы и десятки
+пунктов. Новые слияния уже ограничены (node_matching.compact_node_data);
+это пакетное задание доводит до тех же лимитов существующие данные:
+
+1. выбирает узлы с составным описанием, длиннее node_summary_max_chars,
+   или со списками больше лимитов;
+2. убирает почти повторяющиеся предложения и пункты и обрезает списки
+   (compact_node_data);
+3. с --rewrite описания длиннее node_summary_rewrite_chars переписываются
+   LLM в одно связное; неудачный ответ оставляет сжатое описание. На узле
+   запоминается отпечаток описания после попытки (summary_rewrite_digest),
+   и, пока описание не изменится, следующие запуски его не отправляют.
+   Вызовы идут через планировщик LLM процесса задания (BULK ограничивает их
+   параллельность llm_bulk_max_in_flight), но с очередью API-процесса он не
+   согласован: интерактивный анализ делит с заданием лимиты провайдера,
+   поэтому --rewrite стоит запускать вне часов пик;
+4. пишет изменения пакетом, обновляет поисковый индекс и публикует
+   GraphChange: событие попадает в журнал изменений, из которого его
+   подхватывает API-процесс (ChangeLog.follow_once) и сбрасывает свои кэши.
+
+Запуск: python -m app.services.compaction [--rewrite] [--user USER_ID ...]
+"""
+from typing import Dict, Iterable, List, Optional
+import argparse
+import hashlib
+import logging
+from ..core.config import get_settings
+from ..db.neo4j import get_neo4j_driver
+from ..db.tenancy import tenant_session
+from .changelog import get_change_log
+from .graph_events import GraphChange, publish
+from .indexing import index_node
+from .knowledge import node_to_dict
+from .llm import get_llm_client
+from .llm_scheduler import BULK, get_llm_scheduler
+from .node_matching import compact_node_data, compact_summary
+from .realtime import get_hub
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH = 500
+
+
+def rewrite_summary(label: str, summary: str, max_chars: int) -> Optional[str]:
+    """Связное описание от LLM; None, если ответ пустой или не короче исходного"""
+    client = get_llm_client()
+    if not client:
+        return None
+    prompt = f"""Rewrite the description of the concept "{label}" below as one coherent paragraph.
+
+RULES:
+1. Respond in the SAME LANGUAGE as the description
+2. Keep every distinct fact, drop repetitions
+3. At most {max_chars} characters
+4. Return ONLY the rewritten description, without quotes or comments
+
+Description:
+{summary}
+"""
+    rewritten = (client.generate(prompt) or "").strip().strip('"')
+    if not rewritten or len(rewritten) >= len(summary):
+        return None
+    return compact_summary(rewritten, max_chars)
+
+
+def summary_digest(summary: str) -> str:
+    return hashlib.md5(summary.encode()).hexdigest()
+
+
+def _candidates(user_id: str, rewrite: bool) -> List[Dict]:
+    s = get_settings()
+    with tenant_session(user_id) as session:
+        result = session.run(
+            """
+            MATCH (n:Node {user_id: $user_id})
+            WHERE n.summary CONTAINS $paragraph
+               OR size(coalesce(n.summary, '')) > $max_chars
+               OR size(coalesce(n.knowledge_gaps, [])) > $max_gaps
+               OR size(coalesce(n.recommendations, [])) > $max_recs
+               OR size(coalesce(n.tags, [])) > $max_tags
+            RETURN n, n.summary_rewrite_digest AS rewrite_digest
+            """,
+            paragraph="\n\n",
+            # С --rewrite кандидаты и все описания длиннее порога переписывания
+            max_chars=s.node_summary_rewrite_chars if rewrite else s.node_summary_max_chars,
+            max_gaps=s.node_max_gaps,
+            max_recs=s.node_max_recommendations,
+            max_tags=s.node_max_tags,
+        )
+        return [{**node_to_dict(record["n"]), "rewrite_digest": record["rewrite_digest"]} for record in result]
+
+
+def compact_user(user_id: str, rewrite: bool = False) -> int:
+    """Сжимает узлы пользователя; возвращает число измененных"""
+    s = get_settings()
+    changed = []
+    # Узлы, у которых меняется только отпечаток переписанного описания
+    marked = []
+    for node in _candidates(user_id, rewrite):
+        compacted = compact_node_data(node)
+        compacted["rewrite_digest"] = None
+        summary = compacted["summary"]
+        if (rewrite and len(summary) > s.node_summary_rewrite_chars
+                and summary_digest(summary) != node["rewrite_digest"]):
+            try:
+                rewritten = get_llm_scheduler().run(
+                    user_id,
+                    lambda label=node["label"], text=summary: rewrite_summary(label, text, s.node_summary_rewrite_chars),
+                    BULK,
+                    timeout=s.llm_queue_timeout,
+                )
+                if rewritten:
+                    compacted["summary"] = rewritten
+                # И отказ LLM (ответ не короче) запоминается: то же описание не отправляется снова
+                compacted["rewrite_digest"] = summary_digest(compacted["summary"])
+            except Exception as e:
+                logger.warning(f"Summary rewrite for node {node['id']} failed: {e}")
+        if any(compacted[key] != node.get(key) for key in
+               ("summary", "knowledge_gaps", "recommendations", "tags", "has_gap")):
+            changed.append(compacted)
+        elif compacted["rewrite_digest"]:
+            marked.append(compacted)
+    if not changed and not marked:
+        return 0
+
+    rows = [
+        {**{key: node[key] for key in
+            ("id", "summary", "knowledge_gaps", "recommendations", "tags", "has_gap", "rewrite_digest")},
+         "changed": i < len(changed)}
+        for i, node in enumerate(changed + marked)
+    ]
+    with tenant_session(user_id) as session:
+        for start in range(0, len(rows), WRITE_BATCH):
+            session.run(
+                """
+                UNWIND $rows AS row
+                MATCH (n:Node {id: row.id, user_id: $user_id})
+                SET n.summary = row.summary,
+                    n.knowledge_gaps = row.knowledge_gaps,
+                    n.recommendations = row.recommendations,
+                    n.tags = row.tags,
+                    n.has_gap = row.has_gap,
+                    n.summary_rewrite_digest = coalesce(row.rewrite_digest, n.summary_rewrite_digest),
+                    n.updated_at = CASE WHEN row.changed THEN datetime() ELSE n.updated_at END
+                """,
+                rows=rows[start:start + WRITE_BATCH],
+            ).consume()
+    if not changed:
+        return 0
+    for node in changed:
+        index_node(node, user_id)
+    publish(GraphChange(user_id, upserted_nodes={node["id"] for node in changed}))
+    logger.info(f"Compacted {len(changed)} nodes of user {user_id}")
+    return len(changed)
+
+
+def _all_users() -> List[str]:
+    # Служебный обход всех арендаторов - без tenant_session
+    with get_neo4j_driver().session() as session:
+        result = session.run("MATCH (n:Node) WHERE n.user_id IS NOT NULL RETURN DISTINCT n.user_id AS user_id")
+        return [record["user_id"] for record in result]
+
+
+def compact_all(user_ids: Optional[Iterable[str]] = None, rewrite: bool = False) -> int:
+    total = 0
+    for user_id in user_ids or _all_users():
+        try:
+            total += compact_user(user_id, rewrite=rewrite)
+        except Exception as e:
+            logger.error(f"Compaction for user {user_id} failed: {e}")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact oversized knowledge graph nodes")
+    parser.add_argument("--user", action="append", dest="users", help="Only these users (repeatable)")
+    parser.add_argument("--rewrite", action="store_true", help="Rewrite long summaries with the LLM")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # Изменения попадают в журнал (дельта-синхронизация клиентов, кэши API) и,
+    # при общем брокере, в WebSocket клиентов
+    get_change_log()
+    get_hub()
+    scheduler = get_llm_scheduler()
+    try:
+        total = compact_all(args.users, rewrite=args.rewrite)
+    finally:
+        scheduler.stop()
+    logger.info(f"Compacted {total} nodes")
+
+
+if __name__ == "__main__":
+    main()
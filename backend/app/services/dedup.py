@@ -0,0 +1,678 @@
+"""
+Поиск и слияние узлов-дубликатов (пакетное задание).
+
+Онлайн-сопоставление при анализе (find_matching_node) сравнивает только
+названия и пропускает перефразировки вроде "Нейронные сети" / "нейросети":
+граф дробится на узлы-близнецы с половиной связей у каждого. Задание
+находит такие пары внутри графа каждого пользователя и сливает их:
+
+1. Блокировка MinHash/LSH: для каждого узла - сигнатуры по символьным
+   триграммам нормализованного названия и по словам описания; узлы,
+   совпавшие хотя бы в одной полосе LSH, становятся кандидатами. Это почти
+   линейно по числу узлов, попарное сравнение всего графа не нужно.
+2. Оценка кандидатов (score_pair): решают названия - те же слова с
+   точностью до окончаний или сложносокращенное слово; вложенность
+   названий, другие числа и аббревиатуры - вето ("Java" / "JavaScript",
+   "Windows 10" / "Windows 11"). Пары не ниже dedup_merge_threshold
+   объединяются в группы, основной узел группы - с наибольшим числом
+   связей. Порог подобран на размеченных парах benchmarks/dedup_calibration.py.
+3. Слияние пакетами по dedup_batch_size в одной транзакции: связи
+   дубликата (RELATED, MENTIONED_IN и прочие) переносятся на основной узел
+   без повторов, данные объединяются (merge_node_data), дубликат удаляется.
+   Каждое слияние записывается в Postgres (node_merges) со снимком
+   дубликата, его связей и прежних полей основного узла. GraphChange
+   задания попадает в журнал изменений, по которому API-процесс обновляет
+   свои кэши (ChangeLog.follow_once).
+4. Отмена (undo) в обратном порядке восстанавливает дубликат и его связи,
+   убирает перенесенные связи и возвращает поля основного узла, если их не
+   меняли после слияния.
+
+Запуск без --apply только печатает найденные пары для проверки:
+    python -m app.services.dedup run [--user USER_ID ...] [--threshold 0.81] [--apply]
+    python -m app.services.dedup undo RUN_ID | --merge MERGE_ID
+"""
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import argparse
+import os
+import re
+import uuid
+import zlib
+import logging
+import numpy as np
+from sqlalchemy import select
+from ..core.config import get_settings
+from ..db.models import NodeMerge
+from ..db.neo4j import get_neo4j_driver
+from ..db.postgres import SessionLocal
+from ..db.tenancy import TenantSession, tenant_session
+from .changelog import get_change_log
+from .graph_events import GraphChange, publish
+from .indexing import delete_node as delete_node_document, index_node
+from .knowledge import node_to_dict
+from .node_matching import merge_node_data, normalize_label, word_tokens
+from .realtime import get_hub
+
+logger = logging.getLogger(__name__)
+
+_PRIME = (1 << 31) - 1
+_REL_TYPE = re.compile(r"^\w+$")
+_WORD = re.compile(r"\w+")
+STEM = 5  # слова описания сравниваются по началу: "нейронные" и "нейросети" - "нейро"
+INFLECTION = 3  # букв окончания, которыми могут различаться словоформы
+MIN_STEM = 4  # общая основа словоформ: "Plan" / "Plane", "Кора" / "Корм" - разные слова
+# Окончания словоформ по алфавиту основы
+RU_ENDINGS = frozenset({
+    "", "а", "я", "о", "е", "ё", "ы", "и", "у", "ю", "ь", "й",
+    "ой", "ей", "ий", "ый", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "юю", "ия", "ию", "ии",
+    "ого", "его", "ому", "ему", "ым", "им", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "ых", "их",
+    "ами", "ями", "ыми", "ими",
+})
+EN_ENDINGS = frozenset({"", "s", "es"})
+_CYRILLIC = re.compile(r"[а-яё]")
+_SYMBOLS = re.compile(r"[+#]")  # "C" / "C++" / "C#" - разные языки
+COMPOUND_SCORE = 0.95
+SUMMARY_WEIGHT = 0.2  # доля описаний в оценке, если они есть у обоих узлов
+PREFIX_BLOCK = 3  # узлы с одинаковым началом названия - тоже кандидаты (словоформы, сокращения)
+# Поля основного узла, которые меняет слияние и возвращает отмена
+MERGED_FIELDS = ("summary", "knowledge_gaps", "recommendations", "tags", "has_gap", "level")
+
+
+class UndoConflict(RuntimeError):
+    """Слияние нельзя отменить: граф изменился после него"""
+
+
+@dataclass
+class _Candidate:
+    id: str
+    label: str
+    summary: str
+    degree: int
+    level: Optional[int]
+    label_features: Set[str] = field(default_factory=set)
+    summary_features: Set[str] = field(default_factory=set)
+
+
+def label_trigrams(label: str) -> Set[str]:
+    padded = f" {normalize_label(label)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def label_words(label: str) -> List[str]:
+    return _WORD.findall(normalize_label(label))
+
+
+def _acronyms(label: str) -> Set[str]:
+    return {word.lower() for word in _WORD.findall(label) if len(word) > 1 and word.isupper()}
+
+
+def _inflected(stem: str, tail_a: str, tail_b: str) -> bool:
+    """
+    Хвосты после основы stem - окончания ее алфавита. Основа от MIN_STEM
+    букв; трехбуквенная - только при двух непустых окончаниях одной длины
+    ("сеть" / "сети"): "Пар" / "Пара", "Лев" / "Левый", "Вес" / "Весы" -
+    разные слова
+    """
+    endings = RU_ENDINGS if _CYRILLIC.search(stem) else EN_ENDINGS
+    if tail_a not in endings or tail_b not in endings:
+        return False
+    if len(stem) >= MIN_STEM:
+        return True
+    return len(stem) == MIN_STEM - 1 and bool(tail_a) and len(tail_a) == len(tail_b)
+
+
+def summary_stems(summary: str) -> Set[str]:
+    return {word[:STEM] for word in word_tokens(summary)}
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _same_word(a: str, b: str, exact: Set[str] = frozenset()) -> bool:
+    """
+    Словоформы одного слова: после общей основы остаются только окончания
+    (_inflected). Общее начало может захватить часть окончания
+    ("социальны|е" / "социальны|х"), поэтому основа укорачивается на
+    INFLECTION букв. Числа и аббревиатуры (exact) - только точное совпадение:
+    "HTTP" / "HTTPS", "10" / "11"
+    """
+    if a == b:
+        return True
+    if a in exact or b in exact or any(ch.isdigit() for ch in a + b):
+        return False
+    common = len(os.path.commonprefix([a, b]))
+    return any(
+        _inflected(a[:cut], a[cut:], b[cut:])
+        for cut in range(common, max(common - INFLECTION, MIN_STEM - 1) - 1, -1)
+    )
+
+
+def _compound(word: str, words: List[str]) -> bool:
+    """
+    Сложносокращенное слово из начал слов: "нейросети" = "нейро" + "сети",
+    "соцсети" = "соц" + "сети". Каждое начало - от 3 букв, у последнего
+    слова допускается другое окончание
+    """
+    if not words:
+        return not word
+    head, rest = words[0], words[1:]
+    for length in range(len(head), 2, -1):
+        prefix = head[:length]
+        if not word.startswith(prefix):
+            continue
+        tail = word[length:]
+        if not rest:
+            if _inflected(prefix, tail, head[length:]):
+                return True
+        elif _compound(tail, rest):
+            return True
+    return False
+
+
+def label_score(a: str, b: str) -> float:
+    """
+    Сходство названий для слияния без проверки человеком. В отличие от
+    calculate_similarity вложенность названий ничего не дает: "Java" и
+    "JavaScript", "SQL" и "NoSQL", "Закон Ома" и "Закон Ома для полной
+    цепи" - разные понятия. Совпадением считаются только:
+
+    - те же слова с точностью до окончаний (1.0): "Нейронная сеть" /
+      "нейронные сети";
+    - сложносокращенное слово (COMPOUND_SCORE): "нейросети" /
+      "Нейронные сети".
+
+    Любое слово без пары (в том числе другое число или аббревиатура:
+    "Windows 10" / "Windows 11", "HTTP" / "HTTPS"), другие "+"/"#" ("C" /
+    "C++") или не окончание после основы ("Процесс" / "Процессор") - вето, 0
+    """
+    words_a, words_b = label_words(a), label_words(b)
+    if not words_a or not words_b or sorted(_SYMBOLS.findall(a)) != sorted(_SYMBOLS.findall(b)):
+        return 0.0
+    exact = _acronyms(a) | _acronyms(b)
+    if len(words_a) == len(words_b):
+        unmatched = list(words_b)
+        for word in words_a:
+            match = next((other for other in unmatched if _same_word(word, other, exact)), None)
+            if match is None:
+                break
+            unmatched.remove(match)
+        else:
+            return 1.0
+    short, long = sorted((words_a, words_b), key=len)
+    if len(short) == 1 and len(long) > 1 and not any(ch.isdigit() for ch in "".join(long)) \
+            and _compound(short[0], long):
+        return COMPOUND_SCORE
+    return 0.0
+
+
+def score_pair(a: _Candidate, b: _Candidate) -> float:
+    """
+    Сходство узлов 0..1. Решает название (label_score, вето - 0); описания,
+    если они есть у обоих, добавляют SUMMARY_WEIGHT * сходство. Порог
+    dedup_merge_threshold выше 1 - SUMMARY_WEIGHT: узлы с совсем разными
+    описаниями не сливаются и при совпавших названиях. Подобран на
+    benchmarks/dedup_calibration.py
+    """
+    label = label_score(a.label, b.label)
+    if not label or not a.summary_features or not b.summary_features:
+        return label
+    return (1 - SUMMARY_WEIGHT) * label + SUMMARY_WEIGHT * _jaccard(a.summary_features, b.summary_features)
+
+
+class MinHasher:
+    """MinHash: num_perm функций (a * x + b) mod p над crc32 признаков"""
+
+    def __init__(self, num_perm: int, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, features: Set[str]) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(feature.encode()) % _PRIME for feature in features), dtype=np.uint64, count=len(features)
+        )
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % _PRIME).min(axis=1)
+
+
+def lsh_pairs(signatures: Dict[int, np.ndarray], bands: int, max_bucket: int) -> Set[Tuple[int, int]]:
+    """Пары индексов, совпавшие хотя бы в одной полосе сигнатуры"""
+    pairs: Set[Tuple[int, int]] = set()
+    if not signatures:
+        return pairs
+    rows = len(next(iter(signatures.values()))) // bands
+    for band in range(bands):
+        buckets: Dict[bytes, List[int]] = {}
+        for index, signature in signatures.items():
+            buckets.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), []).append(index)
+        for members in buckets.values():
+            if 1 < len(members) <= max_bucket:
+                for i, first in enumerate(members):
+                    for second in members[i + 1:]:
+                        pairs.add((first, second))
+    return pairs
+
+
+def prefix_pairs(nodes: List[_Candidate], max_bucket: int) -> Set[Tuple[int, int]]:
+    """
+    Блокировка по началу названия: триграммы "нейронные сети" и "нейросети"
+    похожи слабо, и LSH может такую пару пропустить
+    """
+    buckets: Dict[str, List[int]] = {}
+    for index, node in enumerate(nodes):
+        key = "".join(label_words(node.label))[:PREFIX_BLOCK]
+        if len(key) == PREFIX_BLOCK:
+            buckets.setdefault(key, []).append(index)
+    pairs: Set[Tuple[int, int]] = set()
+    for members in buckets.values():
+        if 1 < len(members) <= max_bucket:
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    pairs.add((first, second))
+    return pairs
+
+
+def _load_candidates(user_id: str) -> List[_Candidate]:
+    with tenant_session(user_id) as session:
+        result = session.run(
+            """
+            MATCH (n:Node {user_id: $user_id})
+            RETURN n.id AS id, coalesce(n.label, n.id) AS label, coalesce(n.summary, '') AS summary,
+                   n.level AS level, COUNT { (n)--() } AS degree
+            """
+        )
+        return [
+            _Candidate(
+                id=record["id"],
+                label=record["label"],
+                summary=record["summary"],
+                degree=record["degree"],
+                level=record["level"],
+                label_features=label_trigrams(record["label"]),
+                summary_features=summary_stems(record["summary"]),
+            )
+            for record in result
+        ]
+
+
+def find_duplicates(user_id: str, threshold: Optional[float] = None) -> List[Tuple[str, str, float]]:
+    """
+    Пары (основной узел, дубликат, оценка) для графа пользователя. Группы
+    собираются по парам выше порога; в группу сливаются только узлы,
+    похожие на сам основной узел (цепочка A~B~C не сливает далекие A и C)
+    """
+    s = get_settings()
+    threshold = s.dedup_merge_threshold if threshold is None else threshold
+    nodes = _load_candidates(user_id)
+    hasher = MinHasher(s.dedup_num_perm)
+    candidates: Set[Tuple[int, int]] = set()
+    for attr in ("label_features", "summary_features"):
+        signatures = {
+            index: hasher.signature(getattr(node, attr))
+            for index, node in enumerate(nodes) if getattr(node, attr)
+        }
+        candidates |= lsh_pairs(signatures, s.dedup_bands, s.dedup_max_bucket)
+    candidates |= prefix_pairs(nodes, s.dedup_max_bucket)
+
+    parent = list(range(len(nodes)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for first, second in candidates:
+        if score_pair(nodes[first], nodes[second]) >= threshold:
+            parent[find(first)] = find(second)
+
+    groups: Dict[int, List[int]] = {}
+    for index in range(len(nodes)):
+        groups.setdefault(find(index), []).append(index)
+    merges = []
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        # Основной - самый связанный, затем более общий (меньший уровень)
+        survivor = max(members, key=lambda i: (
+            nodes[i].degree, -(nodes[i].level if nodes[i].level is not None else 1 << 30), nodes[i].id,
+        ))
+        for index in members:
+            if index == survivor:
+                continue
+            score = score_pair(nodes[survivor], nodes[index])
+            if score >= threshold:
+                merges.append((nodes[survivor].id, nodes[index].id, round(score, 4)))
+    logger.info(
+        f"User {user_id}: {len(nodes)} nodes, {len(candidates)} LSH candidates, {len(merges)} duplicates"
+    )
+    return merges
+
+
+def _encode(value: Any) -> Any:
+    # Временные типы Neo4j -> JSON (снимок хранится в JSONB)
+    if hasattr(value, "to_native"):
+        return {"$datetime": value.to_native().isoformat()}
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict) and "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    return value
+
+
+def _encode_props(props: Dict) -> Dict:
+    return {key: _encode(value) for key, value in props.items()}
+
+
+def _decode_props(props: Dict) -> Dict:
+    return {key: _decode(value) for key, value in props.items()}
+
+
+def _edge_query(edge: Dict, create: bool) -> str:
+    other = "(o:Note {id: e.other})" if edge["note"] else "(o:Node {id: e.other, user_id: $user_id})"
+    rel_type = edge["type"]
+    arrow = f"-[x:`{rel_type}`]->" if edge["outgoing"] else f"<-[x:`{rel_type}`]-"
+    if create:
+        existing = f"-[y:`{rel_type}`]->" if edge["outgoing"] else f"<-[y:`{rel_type}`]-"
+        return f"""
+            UNWIND $edges AS e
+            MATCH (n:Node {{id: $node_id, user_id: $user_id}}), {other}
+            WHERE NOT EXISTS {{ MATCH (n){existing}(o) WHERE properties(y) = e.props }}
+            CREATE (n){arrow}(o)
+            SET x = e.props
+            RETURN o.id AS other, properties(x) AS props
+        """
+    return f"""
+        UNWIND $edges AS e
+        MATCH (n:Node {{id: $node_id, user_id: $user_id}}){arrow}{other}
+        WHERE properties(x) = e.props
+        DELETE x
+    """
+
+
+def _group_edges(edges: List[Dict]) -> Dict[Tuple[str, bool, bool], List[Dict]]:
+    groups: Dict[Tuple[str, bool, bool], List[Dict]] = {}
+    for edge in edges:
+        groups.setdefault((edge["type"], edge["outgoing"], edge["note"]), []).append(edge)
+    return groups
+
+
+def _create_edges(tx: TenantSession, node_id: str, edges: List[Dict]) -> List[Dict]:
+    """Создает связи узла, которых у него еще нет; возвращает созданные"""
+    created = []
+    for (rel_type, outgoing, note), group in _group_edges(edges).items():
+        result = tx.run(
+            _edge_query(group[0], create=True),
+            node_id=node_id,
+            edges=[{"other": edge["other"], "props": edge["props"]} for edge in group],
+        )
+        created.extend(
+            {"type": rel_type, "outgoing": outgoing, "note": note, "other": record["other"],
+             "props": _encode_props(record["props"])}
+            for record in result
+        )
+    return created
+
+
+def _delete_edges(tx: TenantSession, node_id: str, edges: List[Dict]):
+    for group in _group_edges(edges).values():
+        tx.run(
+            _edge_query(group[0], create=False),
+            node_id=node_id,
+            edges=[{"other": edge["other"], "props": edge["props"]} for edge in group],
+        ).consume()
+
+
+def _node_edges(tx: TenantSession, node_id: str) -> List[Dict]:
+    result = tx.run(
+        """
+        MATCH (n:Node {id: $node_id, user_id: $user_id})-[r]-(o)
+        RETURN type(r) AS type, startNode(r) = n AS outgoing, 'Note' IN labels(o) AS note,
+               o.id AS other, properties(r) AS props
+        """,
+        node_id=node_id,
+    )
+    edges = []
+    for record in result:
+        if not _REL_TYPE.match(record["type"]):
+            continue
+        edges.append({
+            "type": record["type"], "outgoing": record["outgoing"], "note": record["note"],
+            "other": record["other"], "props": dict(record["props"]),
+        })
+    return edges
+
+
+def _node_props(tx: TenantSession, node_id: str) -> Optional[Dict]:
+    record = tx.run(
+        "MATCH (n:Node {id: $node_id, user_id: $user_id}) RETURN properties(n) AS props",
+        node_id=node_id,
+    ).single()
+    return dict(record["props"]) if record else None
+
+
+def _link(source: str, target: str, props: Dict, rel_type: str) -> Tuple[str, str, str]:
+    return source, target, props.get("relation") or props.get("type") or rel_type.lower()
+
+
+def _merge_one(tx: TenantSession, survivor_id: str, merged_id: str) -> Optional[Dict]:
+    """Сливает merged_id в survivor_id; снимок для отмены или None, если узла уже нет"""
+    survivor = _node_props(tx, survivor_id)
+    merged = _node_props(tx, merged_id)
+    if survivor is None or merged is None:
+        return None
+    edges = _node_edges(tx, merged_id)
+    # Связи между самими близнецами не переносятся (петля на основном узле)
+    moved = [edge for edge in edges if edge["note"] or edge["other"] not in (survivor_id, merged_id)]
+    unique = list({(e["type"], e["outgoing"], e["note"], e["other"], repr(sorted(e["props"].items()))): e
+                   for e in moved}.values())
+    created = _create_edges(tx, survivor_id, unique)
+
+    data = merge_node_data(survivor, merged)
+    levels = [level for level in (survivor.get("level"), merged.get("level")) if level is not None]
+    data["level"] = min(levels) if levels else None
+    after = {key: data.get(key) for key in MERGED_FIELDS}
+    tx.run(
+        """
+        MATCH (n:Node {id: $node_id, user_id: $user_id})
+        SET n += $fields, n.updated_at = datetime()
+        """,
+        node_id=survivor_id,
+        fields=after,
+    ).consume()
+    tx.run(
+        "MATCH (n:Node {id: $node_id, user_id: $user_id}) DETACH DELETE n",
+        node_id=merged_id,
+    ).consume()
+    return {
+        "merged": _encode_props(merged),
+        "edges": [{**edge, "props": _encode_props(edge["props"])} for edge in edges],
+        "survivor": {key: _encode(survivor.get(key)) for key in MERGED_FIELDS},
+        "survivor_after": after,
+        "created_edges": created,
+    }
+
+
+def merge_duplicates(user_id: str, pairs: List[Tuple[str, str, float]],
+                     run_id: Optional[uuid.UUID] = None) -> int:
+    """Сливает пары (основной, дубликат, оценка) пакетами; возвращает число слияний"""
+    s = get_settings()
+    run_id = run_id or uuid.uuid4()
+    total = 0
+    for start in range(0, len(pairs), s.dedup_batch_size):
+        batch = pairs[start:start + s.dedup_batch_size]
+        records = []
+        change = GraphChange(user_id)
+        with tenant_session(user_id) as session, session.transaction() as tx:
+            for survivor_id, merged_id, score in batch:
+                snapshot = _merge_one(tx, survivor_id, merged_id)
+                if snapshot is None:
+                    continue
+                records.append(NodeMerge(
+                    run_id=run_id, user_id=uuid.UUID(user_id), survivor_id=survivor_id,
+                    merged_id=merged_id, score=score, snapshot=snapshot,
+                ))
+                change.deleted_nodes.add(merged_id)
+                change.upserted_nodes.add(survivor_id)
+                for edge in snapshot["created_edges"]:
+                    if not edge["note"]:
+                        source, target = (survivor_id, edge["other"]) if edge["outgoing"] \
+                            else (edge["other"], survivor_id)
+                        change.upserted_links.append(_link(source, target, edge["props"], edge["type"]))
+            # Журнал слияний фиксируется до графа: без записи отмены слияния нет
+            db = SessionLocal()
+            try:
+                db.add_all(records)
+                db.commit()
+            finally:
+                db.close()
+        change.upserted_nodes -= change.deleted_nodes
+        _after_change(user_id, change)
+        total += len(records)
+    logger.info(f"Merged {total} duplicate nodes of user {user_id} (run {run_id})")
+    return total
+
+
+def _after_change(user_id: str, change: GraphChange):
+    for node_id in change.deleted_nodes:
+        delete_node_document(node_id, user_id)
+    if change.upserted_nodes:
+        with tenant_session(user_id) as session:
+            result = session.run(
+                "MATCH (n:Node {user_id: $user_id}) WHERE n.id IN $ids RETURN n",
+                ids=list(change.upserted_nodes),
+            )
+            for record in result:
+                index_node(node_to_dict(record["n"]), user_id)
+    publish(change)
+
+
+def _undo_one(tx: TenantSession, merge: NodeMerge) -> GraphChange:
+    snapshot = merge.snapshot
+    if _node_props(tx, merge.merged_id) is not None:
+        raise UndoConflict(f"Node {merge.merged_id} exists again, merge {merge.id} cannot be undone")
+    survivor = _node_props(tx, merge.survivor_id)
+    if survivor is None:
+        raise UndoConflict(
+            f"Survivor {merge.survivor_id} of merge {merge.id} is gone; undo later merges first"
+        )
+    _delete_edges(tx, merge.survivor_id,
+                  [{**edge, "props": _decode_props(edge["props"])} for edge in snapshot["created_edges"]])
+    tx.run(
+        """
+        CREATE (n:Node {id: $node_id, user_id: $user_id})
+        SET n += $props
+        """,
+        node_id=merge.merged_id,
+        props={key: value for key, value in _decode_props(snapshot["merged"]).items()
+               if key not in ("id", "user_id")},
+    ).consume()
+    _create_edges(tx, merge.merged_id,
+                  [{**edge, "props": _decode_props(edge["props"])} for edge in snapshot["edges"]])
+    # Поля основного узла возвращаются, только если их не меняли после слияния
+    restore = {
+        key: _decode(value) for key, value in snapshot["survivor"].items()
+        if survivor.get(key) == snapshot["survivor_after"].get(key)
+    }
+    if restore:
+        tx.run(
+            "MATCH (n:Node {id: $node_id, user_id: $user_id}) SET n += $fields",
+            node_id=merge.survivor_id,
+            fields=restore,
+        ).consume()
+    change = GraphChange(str(merge.user_id), upserted_nodes={merge.survivor_id, merge.merged_id})
+    for edge in snapshot["created_edges"]:
+        if not edge["note"]:
+            source, target = (merge.survivor_id, edge["other"]) if edge["outgoing"] \
+                else (edge["other"], merge.survivor_id)
+            change.deleted_links.append(_link(source, target, edge["props"], edge["type"]))
+    for edge in snapshot["edges"]:
+        if not edge["note"]:
+            source, target = (merge.merged_id, edge["other"]) if edge["outgoing"] \
+                else (edge["other"], merge.merged_id)
+            change.upserted_links.append(_link(source, target, edge["props"], edge["type"]))
+    return change
+
+
+def undo(run_id: Optional[uuid.UUID] = None, merge_id: Optional[int] = None) -> int:
+    """
+    Отменяет слияния запуска run_id (или одно слияние merge_id) от последнего
+    к первому. UndoConflict останавливает отмену на слиянии, которое уже
+    нельзя вернуть; отмененные до него остаются отмененными
+    """
+    db = SessionLocal()
+    try:
+        query = select(NodeMerge).where(NodeMerge.undone_at.is_(None)).order_by(NodeMerge.id.desc())
+        query = query.where(NodeMerge.id == merge_id) if merge_id is not None \
+            else query.where(NodeMerge.run_id == run_id)
+        merges = db.scalars(query).all()
+        undone = 0
+        for merge in merges:
+            user_id = str(merge.user_id)
+            with tenant_session(user_id) as session, session.transaction() as tx:
+                change = _undo_one(tx, merge)
+                merge.undone_at = datetime.now(timezone.utc)
+                db.commit()
+            _after_change(user_id, change)
+            undone += 1
+        return undone
+    finally:
+        db.close()
+
+
+def _all_users() -> List[str]:
+    # Служебный обход всех арендаторов - без tenant_session
+    with get_neo4j_driver().session() as session:
+        result = session.run("MATCH (n:Node) WHERE n.user_id IS NOT NULL RETURN DISTINCT n.user_id AS user_id")
+        return [record["user_id"] for record in result]
+
+
+def dedup_all(user_ids: Optional[Iterable[str]] = None, threshold: Optional[float] = None,
+              apply: bool = False) -> Tuple[uuid.UUID, int]:
+    """Находит дубликаты; сливает их только с apply=True, иначе печатает пары"""
+    run_id = uuid.uuid4()
+    total = 0
+    for user_id in user_ids or _all_users():
+        try:
+            pairs = find_duplicates(user_id, threshold)
+            if not apply:
+                for survivor_id, merged_id, score in pairs:
+                    logger.info(f"[review] {user_id}: {merged_id} -> {survivor_id} ({score:.2f})")
+                total += len(pairs)
+            elif pairs:
+                total += merge_duplicates(user_id, pairs, run_id)
+        except Exception as e:
+            logger.error(f"Dedup for user {user_id} failed: {e}")
+    return run_id, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find and merge near-duplicate graph nodes")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Find duplicates (and merge them with --apply)")
+    run.add_argument("--user", action="append", dest="users", help="Only these users (repeatable)")
+    run.add_argument("--threshold", type=float, help="Merge score threshold (default: dedup_merge_threshold)")
+    run.add_argument("--apply", action="store_true", help="Merge the pairs instead of only reporting them")
+    revert = commands.add_parser("undo", help="Undo merges of a run")
+    revert.add_argument("run_id", nargs="?", type=uuid.UUID)
+    revert.add_argument("--merge", type=int, help="Undo a single merge by id")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # Изменения попадают в журнал (дельта-синхронизация клиентов, кэши API) и,
+    # при общем брокере, в WebSocket клиентов
+    get_change_log()
+    get_hub()
+    if args.command == "run":
+        run_id, total = dedup_all(args.users, args.threshold, args.apply)
+        logger.info(f"Run {run_id}: {total} duplicate nodes {'merged' if args.apply else 'found, not merged'}")
+    else:
+        if args.run_id is None and args.merge is None:
+            parser.error("undo needs RUN_ID or --merge")
+        logger.info(f"Undone {undo(args.run_id, args.merge)} merges")
+
+
+if __name__ == "__main__":
+    main()
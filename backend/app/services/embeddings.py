@@ -0,0 +1,148 @@
+"""
+Локальные эмбеддинги для семантического поиска (только CPU, без сетевых вызовов).
+
+Рабочий эмбеддер - многоязычная модель sentence-transformers, которую образ
+API скачивает при сборке (backend/Dockerfile). Если она не загрузилась,
+эмбеддера нет (get_embedder возвращает None) и kNN-часть гибридного поиска
+выключается: векторы запросов от другого эмбеддера лежали бы в другом
+пространстве, чем векторы индекса. Каким эмбеддером заполнен индекс,
+записано в _meta его маппинга (db.elastic.EMBEDDING_META).
+"""
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional
+import hashlib
+import math
+import os
+import re
+import threading
+import logging
+from ..core.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    """
+    Эмбеддинг через feature hashing слов и символьных триграмм - для
+    разработки без модели (embedding_backend=hashing). Триграммы сглаживают
+    словоформы ("нейронные сети" / "нейросети"), но синонимы между языками
+    распознает только нейросетевая модель.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dims: int):
+        self.dims = dims
+
+    def _features(self, text: str):
+        for word in TOKEN_RE.findall(text.lower()):
+            yield "w:" + word, 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield "g:" + padded[i:i + 3], 0.5
+
+    def _embed_one(self, text: str) -> List[float]:
+        vec = [0.0] * self.dims
+        for feature, weight in self._features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            h = int.from_bytes(digest, "little")
+            sign = 1.0 if h & 1 else -1.0
+            vec[(h >> 1) % self.dims] += sign * weight
+        norm = math.sqrt(sum(v * v for v in vec))
+        if norm:
+            vec = [v / norm for v in vec]
+        return vec
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed_one(t) for t in texts]
+
+
+class SentenceTransformerEmbedder:
+    """Локальная модель sentence-transformers, загружаемая только с диска"""
+
+    name = "sentence-transformers"
+
+    def __init__(self, model_path: str, batch_size: int):
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_path, device="cpu", local_files_only=True)
+        self.dims = self.model.get_sentence_embedding_dimension()
+        self.batch_size = batch_size
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        vectors = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        return [v.tolist() for v in vectors]
+
+
+class CachedEmbedder:
+    """Обертка с LRU-кэшем по хэшу содержимого и пакетной обработкой промахов"""
+
+    def __init__(self, backend, cache_size: int):
+        self.backend = backend
+        self.dims = backend.dims
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(text: str) -> str:
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.content_hash(t) for t in texts]
+        result: List[Optional[List[float]]] = [None] * len(texts)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    result[i] = self._cache[key]
+                else:
+                    missing.setdefault(key, []).append(i)
+        if missing:
+            miss_keys = list(missing)
+            miss_texts = [texts[missing[k][0]] for k in miss_keys]
+            vectors = self.backend.embed(miss_texts)
+            with self._lock:
+                for key, vec in zip(miss_keys, vectors):
+                    for i in missing[key]:
+                        result[i] = vec
+                    self._cache[key] = vec
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def embed_one(self, text: str) -> List[float]:
+        return self.embed([text])[0]
+
+
+@lru_cache
+def get_embedder() -> Optional[CachedEmbedder]:
+    """Настроенный эмбеддер; None, если он недоступен - без подмены другим"""
+    s = get_settings()
+    try:
+        if s.embedding_backend == "hashing":
+            backend = HashingEmbedder(s.embedding_dims)
+        elif s.embedding_backend == "sentence-transformers":
+            if not s.embedding_model_path:
+                raise ValueError("embedding_model_path is not set")
+            backend = SentenceTransformerEmbedder(s.embedding_model_path, s.embedding_batch_size)
+        else:
+            raise ValueError(f"unknown embedding backend {s.embedding_backend!r}")
+        if backend.dims != s.embedding_dims:
+            raise ValueError(f"model has {backend.dims} dims, index expects {s.embedding_dims}")
+    except Exception as e:
+        logger.error(f"Embedder {s.embedding_backend} is unavailable, semantic search is disabled: {e}")
+        return None
+    logger.info(f"Using {backend.name} embedder ({backend.dims} dims)")
+    return CachedEmbedder(backend, s.embedding_cache_size)
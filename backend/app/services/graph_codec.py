@@ -0,0 +1,112 @@
+"""
+Форматы передачи графа: обычный GraphData, NDJSON и компактный колоночный.
+
+Колоночный формат:
+    {
+      "format": "columnar-v1",
+      "nodes": {"id": [...], "label": [...], "summary": [...], ...},  # параллельные массивы
+      "links": {"source": [0, ...], "target": [2, ...], "relation": [0, ...]},  # индексы
+      "relations": ["related", "part_of", ...]  # таблица типов связей
+    }
+Кодируется orjson (application/vnd.kyp.graph+json) или msgpack (application/x-msgpack).
+
+Поля ответа помимо nodes и links (например, cost пути обучения) передаются
+во всех форматах: в колоночном - рядом с "nodes", в NDJSON - первой строкой
+{"type": "meta", ...}.
+"""
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+import msgpack
+import orjson
+from fastapi import Request
+from fastapi.responses import ORJSONResponse, Response
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+COMPACT_MEDIA_TYPE = "application/vnd.kyp.graph+json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+GRAPH_FORMATS = "^(json|ndjson|compact|msgpack)$"
+COLUMNAR_VERSION = "columnar-v1"
+NODE_COLUMNS = ("id", "label", "summary", "tags", "has_gap", "level", "knowledge_gaps", "recommendations", "x", "y")
+
+_ACCEPT_FORMATS = (
+    (MSGPACK_MEDIA_TYPE, "msgpack"),
+    (COMPACT_MEDIA_TYPE, "compact"),
+    (NDJSON_MEDIA_TYPE, "ndjson"),
+)
+
+
+def negotiate_format(request: Request, format: Optional[str]) -> str:
+    """Формат из ?format=, иначе из заголовка Accept, по умолчанию json"""
+    if format:
+        return format
+    accept = request.headers.get("accept", "")
+    for media_type, name in _ACCEPT_FORMATS:
+        if media_type in accept:
+            return name
+    return "json"
+
+
+def graph_items(data: Dict) -> Iterator[Tuple[str, Dict]]:
+    for node in data["nodes"]:
+        yield "node", node
+    for link in data["links"]:
+        yield "link", link
+
+
+def columnar_graph(items: Iterable[Tuple[str, Dict]]) -> Dict:
+    """Собирает колоночное представление из потока ("node"|"link", dict)"""
+    nodes = {column: [] for column in NODE_COLUMNS}
+    index: Dict[str, int] = {}
+    pending_links = []
+    for kind, item in items:
+        if kind == "node":
+            if item["id"] in index:
+                continue
+            index[item["id"]] = len(index)
+            for column in NODE_COLUMNS:
+                nodes[column].append(item.get(column))
+        else:
+            pending_links.append(item)
+
+    relations: Dict[str, int] = {}
+    links = {"source": [], "target": [], "relation": []}
+    for link in pending_links:
+        source = index.get(link["source"])
+        target = index.get(link["target"])
+        if source is None or target is None:
+            continue
+        links["source"].append(source)
+        links["target"].append(target)
+        links["relation"].append(relations.setdefault(link["relation"], len(relations)))
+    return {
+        "format": COLUMNAR_VERSION,
+        "nodes": nodes,
+        "links": links,
+        "relations": list(relations),
+    }
+
+
+def compact_response(items: Iterable[Tuple[str, Dict]], fmt: str, extra: Optional[Dict] = None) -> Response:
+    payload = columnar_graph(items)
+    if extra:
+        payload.update(extra)
+    if fmt == "msgpack":
+        return Response(msgpack.packb(payload, use_bin_type=True), media_type=MSGPACK_MEDIA_TYPE)
+    return Response(orjson.dumps(payload), media_type=COMPACT_MEDIA_TYPE)
+
+
+def graph_response(request: Request, format: Optional[str], data: Dict) -> Response:
+    """
+    Граф {"nodes", "links"} из простых dict в формате GraphData (json)
+    или в компактном формате по запросу клиента; остальные поля data
+    сохраняются в любом формате
+    """
+    fmt = negotiate_format(request, format)
+    extra = {key: value for key, value in data.items() if key not in ("nodes", "links")}
+    if fmt in ("compact", "msgpack"):
+        return compact_response(graph_items(data), fmt, extra)
+    if fmt == "ndjson":
+        lines = [orjson.dumps({"type": "meta", **extra}) + b"\n"] if extra else []
+        lines.extend(orjson.dumps({"type": kind, **item}) + b"\n" for kind, item in graph_items(data))
+        return Response(b"".join(lines), media_type=NDJSON_MEDIA_TYPE)
+    return ORJSONResponse(data)
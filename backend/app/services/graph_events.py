@@ -0,0 +1,57 @@
+"""
+События записи в граф: кэши, журнал изменений и т.п. подписываются здесь,
+а роуты, меняющие граф, публикуют одно событие на пакет изменений
+"""
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Set, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHANGELOG = "changelog"
+LAYOUT = "layout"
+
+
+@dataclass
+class GraphChange:
+    user_id: str
+    upserted_nodes: Set[str] = field(default_factory=set)
+    deleted_nodes: Set[str] = field(default_factory=set)
+    # (source, target, relation)
+    upserted_links: List[Tuple[str, str, str]] = field(default_factory=list)
+    deleted_links: List[Tuple[str, str, str]] = field(default_factory=list)
+    # Откуда событие: "" - запись в этом процессе, CHANGELOG - запись другого
+    # процесса (CLI-задание, другой воркер), прочитанная из журнала изменений,
+    # LAYOUT - у узлов изменились только координаты x/y (services.layout)
+    source: str = ""
+
+    @property
+    def empty(self) -> bool:
+        return not (self.upserted_nodes or self.deleted_nodes or self.upserted_links or self.deleted_links)
+
+    @property
+    def touched_nodes(self) -> Set[str]:
+        touched = set(self.upserted_nodes) | set(self.deleted_nodes)
+        for source, target, _ in self.upserted_links + self.deleted_links:
+            touched.add(source)
+            touched.add(target)
+        return touched
+
+
+_listeners: List[Callable[[GraphChange], None]] = []
+
+
+def subscribe(listener: Callable[[GraphChange], None]):
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def publish(change: Optional[GraphChange]):
+    """Оповещает подписчиков; ошибки подписчиков не прерывают запись"""
+    if change is None or not change.user_id or change.empty:
+        return
+    for listener in list(_listeners):
+        try:
+            listener(change)
+        except Exception as e:
+            logger.error(f"Graph change listener {getattr(listener, '__name__', listener)} failed: {e}")
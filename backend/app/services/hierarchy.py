@@ -1,9 +1,10 @@
 from typing import Dict, List, Optional
 from ..models.schemas import GraphNode, GraphLink
-from ..db.neo4j import get_neo4j_driver
-from ..db.elastic import get_es
-from ..core.config import get_settings
+from ..db.tenancy import tenant_session
 from ..services.knowledge import upsert_node, link_nodes
+from ..services.indexing import index_node
+from ..services.graph_events import GraphChange, publish
+from ..services import quota
 import hashlib
 import logging
 
@@ -25,14 +26,11 @@ def create_hierarchical_graph(
     - Узлы первого уровня (основные концепции)
     - Узлы второго уровня (связанные концепции)
     """
-    driver = get_neo4j_driver()
-    es = get_es()
-    s = get_settings()
-    
     nodes: List[GraphNode] = []
     links: List[GraphLink] = []
+    created = 0
     
-    with driver.session() as session:
+    with tenant_session(user_id) as session:
         # Создаем центральный узел (главная тема)
         main_id = hashlib.md5(main_topic.encode()).hexdigest()[:16]
         main_node = GraphNode(
@@ -43,21 +41,11 @@ def create_hierarchical_graph(
             has_gap=False,
             level=0
         )
-        upsert_node(session, main_node, user_id=user_id)
+        created += upsert_node(session, main_node, user_id=user_id)
         nodes.append(main_node)
         
         # Индексируем в Elasticsearch
-        es_doc = {
-            "id": main_node.id,
-            "label": main_node.label,
-            "summary": main_node.summary,
-            "tags": main_node.tags,
-            "has_gap": main_node.has_gap,
-            "level": 0
-        }
-        if user_id:
-            es_doc["user_id"] = user_id
-        es.index(index=s.elastic_index_nodes, id=main_node.id, document=es_doc)
+        index_node(main_node.model_dump(), user_id)
         
         # Создаем узлы первого уровня (основные концепции)
         for concept in main_concepts:
@@ -72,7 +60,7 @@ def create_hierarchical_graph(
                 has_gap=False,
                 level=1
             )
-            upsert_node(session, concept_node, user_id=user_id)
+            created += upsert_node(session, concept_node, user_id=user_id)
             nodes.append(concept_node)
             
             # Связываем центральный узел с концепцией первого уровня
@@ -84,17 +72,7 @@ def create_hierarchical_graph(
             ))
             
             # Индексируем в Elasticsearch
-            es_doc = {
-                "id": concept_node.id,
-                "label": concept_node.label,
-                "summary": concept_node.summary,
-                "tags": concept_node.tags,
-                "has_gap": concept_node.has_gap,
-                "level": 1
-            }
-            if user_id:
-                es_doc["user_id"] = user_id
-            es.index(index=s.elastic_index_nodes, id=concept_node.id, document=es_doc)
+            index_node(concept_node.model_dump(), user_id)
             
             # Создаем узлы второго уровня (связанные концепции)
             related_concepts = concept_hierarchy.get(concept, [])
@@ -110,7 +88,7 @@ def create_hierarchical_graph(
                     has_gap=False,
                     level=2
                 )
-                upsert_node(session, related_node, user_id=user_id)
+                created += upsert_node(session, related_node, user_id=user_id)
                 nodes.append(related_node)
                 
                 # Связываем концепцию первого уровня с концепцией второго уровня
@@ -122,17 +100,14 @@ def create_hierarchical_graph(
                 ))
                 
                 # Индексируем в Elasticsearch
-                es_doc = {
-                    "id": related_node.id,
-                    "label": related_node.label,
-                    "summary": related_node.summary,
-                    "tags": related_node.tags,
-                    "has_gap": related_node.has_gap,
-                    "level": 2
-                }
-                if user_id:
-                    es_doc["user_id"] = user_id
-                es.index(index=s.elastic_index_nodes, id=related_node.id, document=es_doc)
+                index_node(related_node.model_dump(), user_id)
     
+    if user_id:
+        quota.record(user_id, created)
+        publish(GraphChange(
+            user_id,
+            upserted_nodes={n.id for n in nodes},
+            upserted_links=[(l.source, l.target, l.relation) for l in links],
+        ))
     return nodes, links
 
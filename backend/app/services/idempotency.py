@@ -0,0 +1,178 @@
+"""
+Идемпотентные запросы по заголовку Idempotency-Key.
+
+Первый запрос с ключом записывает в Postgres (idempotency_keys) отпечаток
+запроса и статус pending, выполняется и сохраняет итоговый ответ. Повтор с
+тем же ключом и отпечатком получает сохраненный ответ без повторной работы
+(без новой заметки и вызова LLM); повтор, пришедший пока первый еще
+выполняется, ждет его результата. Тот же ключ с другим телом - 422.
+
+Ошибки (исключения, HTTPException) не сохраняются: ключ освобождается, и
+повтор выполняется заново. Повтор уже выполненного запроса проходит мимо
+допуска (admission.admit): слот и токен нужны только настоящей работе. Запись живет idempotency_ttl_hours; pending,
+зависший дольше idempotency_pending_timeout (сбой процесса), перехватывается.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+import hashlib
+import time
+import uuid
+import logging
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import Response
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert
+from ..core.config import get_settings
+from ..db.postgres import SessionLocal
+from ..db.models import IdempotencyRecord
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+PENDING = "pending"
+DONE = "done"
+
+
+def fingerprint(*parts: Any) -> str:
+    """Отпечаток запроса: sha256 от канонического JSON частей (путь, параметры, тело)"""
+    return hashlib.sha256(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _claim(uid: uuid.UUID, key: str, digest: str) -> Optional[IdempotencyRecord]:
+    """Занимает ключ; None - занят нами, иначе существующая запись"""
+    s = get_settings()
+    now = _now()
+    db = SessionLocal()
+    try:
+        db.execute(delete(IdempotencyRecord).where(
+            IdempotencyRecord.user_id == uid, IdempotencyRecord.expires_at < now,
+        ))
+        # Зависший pending (сбой процесса) перехватывается
+        db.execute(delete(IdempotencyRecord).where(
+            IdempotencyRecord.user_id == uid,
+            IdempotencyRecord.key == key,
+            IdempotencyRecord.status == PENDING,
+            IdempotencyRecord.created_at < now - timedelta(seconds=s.idempotency_pending_timeout),
+        ))
+        claimed = db.execute(
+            insert(IdempotencyRecord)
+            .values(
+                user_id=uid, key=key, fingerprint=digest, status=PENDING,
+                created_at=now, expires_at=now + timedelta(hours=s.idempotency_ttl_hours),
+            )
+            .on_conflict_do_nothing()
+            .returning(IdempotencyRecord.key)
+        ).first()
+        db.commit()
+        if claimed is not None:
+            return None
+        record = db.scalar(select(IdempotencyRecord).where(
+            IdempotencyRecord.user_id == uid, IdempotencyRecord.key == key,
+        ))
+        if record is not None:
+            db.expunge(record)
+        return record
+    finally:
+        db.close()
+
+
+def _finish(uid: uuid.UUID, key: str, response: Optional[Response]):
+    db = SessionLocal()
+    try:
+        if response is None:
+            db.execute(delete(IdempotencyRecord).where(
+                IdempotencyRecord.user_id == uid, IdempotencyRecord.key == key,
+            ))
+        else:
+            db.execute(
+                update(IdempotencyRecord)
+                .where(IdempotencyRecord.user_id == uid, IdempotencyRecord.key == key)
+                .values(
+                    status=DONE,
+                    response_status=response.status_code,
+                    response_body=bytes(response.body),
+                    media_type=response.media_type,
+                )
+            )
+        db.commit()
+    finally:
+        db.close()
+
+
+def completed(user_id: str, key: Optional[str]) -> bool:
+    """Запрос с ключом уже выполнен: повтор получит сохраненный ответ (или 422) без работы"""
+    if not key:
+        return False
+    db = SessionLocal()
+    try:
+        return db.scalar(select(IdempotencyRecord.key).where(
+            IdempotencyRecord.user_id == uuid.UUID(user_id),
+            IdempotencyRecord.key == key,
+            IdempotencyRecord.status == DONE,
+            IdempotencyRecord.expires_at >= _now(),
+        )) is not None
+    finally:
+        db.close()
+
+
+def _replay(record: IdempotencyRecord) -> Response:
+    return Response(
+        content=record.response_body,
+        status_code=record.response_status,
+        media_type=record.media_type,
+        headers={REPLAYED_HEADER: "true"},
+    )
+
+
+def run_idempotent(user_id: str, key: Optional[str], digest: str, handler: Callable[[], Any]) -> Any:
+    """
+    Выполняет handler один раз на (пользователь, key). Без ключа - просто
+    вызывает handler. Результат handler (dict или Response) сохраняется
+    как JSON-ответ и возвращается как Response
+    """
+    if not key:
+        return handler()
+    s = get_settings()
+    uid = uuid.UUID(user_id)
+    deadline = time.monotonic() + s.idempotency_wait_timeout
+    delay = 0.05
+    while True:
+        record = _claim(uid, key, digest)
+        if record is None:
+            break
+        if record.fingerprint != digest:
+            raise HTTPException(
+                status_code=422,
+                detail=f"{IDEMPOTENCY_HEADER} was already used with a different request",
+            )
+        if record.status == DONE:
+            return _replay(record)
+        # Первый запрос еще выполняется - ждем его ответа
+        if time.monotonic() >= deadline:
+            raise HTTPException(
+                status_code=409,
+                detail=f"A request with this {IDEMPOTENCY_HEADER} is still in progress",
+                headers={"Retry-After": str(max(1, int(s.idempotency_wait_timeout / 4)))},
+            )
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+    response = None
+    try:
+        result = handler()
+        response = result if isinstance(result, Response) else Response(
+            content=orjson.dumps(result), media_type="application/json"
+        )
+        return response
+    finally:
+        try:
+            # Неуспех (исключение или ошибка HTTP) освобождает ключ для повтора
+            _finish(uid, key, response if response is not None and response.status_code < 400 else None)
+        except Exception as e:
+            logger.error(f"Failed to store idempotent response for key {key}: {e}")
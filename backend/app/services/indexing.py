@@ -0,0 +1,276 @@
+"""
+Фоновая индексация заметок и узлов в Elasticsearch вместе с эмбеддингами
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, List, Optional, Set, Tuple
+import queue
+import threading
+import time
+import logging
+from elasticsearch import helpers
+from sqlalchemy import func, select
+from ..core.config import get_settings
+from ..db.elastic import embedding_compatible, get_es, write_alias
+from ..db.models import SearchReindexRun, SearchTombstone
+from ..db.postgres import SessionLocal
+from .embeddings import get_embedder
+
+logger = logging.getLogger(__name__)
+
+REINDEX_CHECK_INTERVAL = 5.0  # секунд между проверками идущих переиндексаций
+REINDEX_RUN_TTL = 24 * 3600  # метка упавшей переиндексации перестает действовать
+
+
+@dataclass
+class IndexOp:
+    action: str  # "index" | "delete"
+    index: str
+    doc_id: str
+    routing: Optional[str] = None
+    document: Optional[Dict] = None
+    text: Optional[str] = None  # текст для эмбеддинга
+
+
+class BackgroundIndexer:
+    """
+    Очередь операций индексации, которую разбирает один поток:
+    операции собираются в пакеты, эмбеддинги считаются пакетом,
+    запись идет через bulk. Один поток сохраняет порядок операций
+    над одним документом (index -> delete).
+    """
+
+    def __init__(self):
+        s = get_settings()
+        self.batch_size = s.indexing_batch_size
+        self.flush_interval = s.indexing_flush_interval
+        self._queue: "queue.Queue[IndexOp]" = queue.Queue(maxsize=s.indexing_queue_size)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="es-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, op: IndexOp):
+        if not self.running:
+            # Без фонового потока (скрипты, CLI) пишем сразу
+            self.flush([op])
+            return
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            logger.warning("Indexing queue is full, indexing synchronously")
+            self.flush([op])
+
+    def _drain(self) -> List[IndexOp]:
+        batch: List[IndexOp] = []
+        try:
+            batch.append(self._queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = self._drain()
+            if batch:
+                self.flush(batch)
+
+    def flush(self, ops: List[IndexOp]):
+        embedder = get_embedder()
+        # Без эмбеддера и в индекс другого эмбеддера (до переиндексации) векторы не пишутся
+        to_embed = [
+            op for op in ops
+            if op.action == "index" and op.text and embedder is not None and embedding_compatible(get_es(), op.index)
+        ]
+        if to_embed:
+            try:
+                vectors = embedder.embed([op.text for op in to_embed])
+                for op, vec in zip(to_embed, vectors):
+                    op.document["embedding"] = vec
+            except Exception as e:
+                # Документ все равно индексируется, но без вектора
+                logger.error(f"Embedding failed for {len(to_embed)} documents: {e}")
+
+        _record_tombstones([op for op in ops if op.action == "delete"])
+        actions = []
+        for op in ops:
+            action = {"_op_type": op.action, "_index": op.index, "_id": op.doc_id}
+            if op.routing:
+                action["routing"] = op.routing
+            if op.action == "index":
+                action["_source"] = op.document
+            actions.append(action)
+        try:
+            _, errors = helpers.bulk(get_es(), actions, raise_on_error=False, stats_only=False)
+            for error in errors:
+                # Удаление уже отсутствующего документа - не ошибка
+                if "delete" in error and error["delete"].get("status") == 404:
+                    continue
+                logger.error(f"Bulk indexing error: {error}")
+        except Exception as e:
+            logger.error(f"Bulk indexing of {len(actions)} operations failed: {e}")
+
+
+_reindex_runs: Tuple[float, Set[str]] = (float("-inf"), set())
+
+
+def reindexing() -> Set[str]:
+    """
+    Алиасы записи, для которых идет переиндексация (search_reindex_runs).
+    Проверяется раз в REINDEX_CHECK_INTERVAL; переиндексация ждет дольше,
+    прежде чем переключить алиас записи
+    """
+    global _reindex_runs
+    checked_at, indices = _reindex_runs
+    now = time.monotonic()
+    if now - checked_at < REINDEX_CHECK_INTERVAL:
+        return indices
+    db = SessionLocal()
+    try:
+        indices = set(db.scalars(
+            select(SearchReindexRun.index).where(
+                SearchReindexRun.started_at > func.now() - timedelta(seconds=REINDEX_RUN_TTL)
+            )
+        ))
+    except Exception as e:
+        # Без Postgres надгробия все равно не записать
+        logger.error(f"Checking running reindexes failed: {e}")
+        indices = set()
+    finally:
+        db.close()
+    _reindex_runs = (now, indices)
+    return indices
+
+
+def _record_tombstones(deletes: List[IndexOp]):
+    """
+    Запоминает удаления для идущей переиндексации (services.reindex): пока
+    идет загрузка снимка, удаление еще не загруженного документа из нового
+    индекса дает 404, а затем загрузка создала бы его снова. Вне
+    переиндексации в Postgres ничего не пишется
+    """
+    if not deletes:
+        return
+    running = reindexing()
+    deletes = [op for op in deletes if op.index in running]
+    if not deletes:
+        return
+    db = SessionLocal()
+    try:
+        db.add_all([SearchTombstone(index=op.index, doc_id=op.doc_id, routing=op.routing) for op in deletes])
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Recording {len(deletes)} search tombstones failed: {e}")
+    finally:
+        db.close()
+
+
+_indexer: Optional[BackgroundIndexer] = None
+_indexer_lock = threading.Lock()
+
+
+def get_indexer() -> BackgroundIndexer:
+    global _indexer
+    with _indexer_lock:
+        if _indexer is None:
+            _indexer = BackgroundIndexer()
+        return _indexer
+
+
+def note_document(note) -> Dict:
+    return {
+        "id": note.id,
+        "user_id": str(note.user_id),
+        "title": note.title,
+        "content": note.content,
+        "tags": note.tags,
+    }
+
+
+def node_doc_id(node_id: str, user_id: Optional[str]) -> str:
+    """id документа узла: id узлов уникальны только в пределах пользователя"""
+    return f"{user_id}:{node_id}" if user_id else node_id
+
+
+def node_document(node: Dict, user_id: Optional[str]) -> Dict:
+    doc = {
+        "id": node["id"],
+        "label": node.get("label", node["id"]),
+        "summary": node.get("summary"),
+        "tags": node.get("tags") or [],
+        "has_gap": bool(node.get("has_gap", False)),
+        "level": node.get("level"),
+    }
+    if user_id:
+        doc["user_id"] = user_id
+    return doc
+
+
+def index_note(note):
+    """Ставит заметку в очередь индексации с маршрутизацией по пользователю"""
+    doc = note_document(note)
+    get_indexer().submit(IndexOp(
+        action="index",
+        index=write_alias(get_settings().elastic_index_notes),
+        doc_id=str(note.id),
+        routing=doc["user_id"],
+        document=doc,
+        text=f"{note.title}\n{note.content}",
+    ))
+
+
+def delete_note(note_id, user_id: str):
+    get_indexer().submit(IndexOp(
+        action="delete",
+        index=write_alias(get_settings().elastic_index_notes),
+        doc_id=str(note_id),
+        routing=user_id,
+    ))
+
+
+def index_node(node: Dict, user_id: Optional[str] = None):
+    """Ставит узел графа (dict с полями GraphNode) в очередь индексации"""
+    doc = node_document(node, user_id)
+    get_indexer().submit(IndexOp(
+        action="index",
+        index=write_alias(get_settings().elastic_index_nodes),
+        doc_id=node_doc_id(doc["id"], user_id),
+        routing=user_id,
+        document=doc,
+        text=f"{doc['label']}\n{doc['summary'] or ''}",
+    ))
+
+
+def delete_node(node_id: str, user_id: Optional[str] = None):
+    get_indexer().submit(IndexOp(
+        action="delete",
+        index=write_alias(get_settings().elastic_index_nodes),
+        doc_id=node_doc_id(node_id, user_id),
+        routing=user_id,
+    ))
@@ -1,64 +1,48 @@
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Tuple
 from neo4j import Session
 from elasticsearch import Elasticsearch
-from ..models.schemas import GraphNode, GraphLink, GraphData
+from ..models.schemas import GraphNode
+from .write_behind import overlay
 
 
-def upsert_node(session: Session, node: GraphNode, user_id: str = None):
-    query_params = {
-        "id": node.id,
-        "label": node.label,
-        "summary": node.summary,
-        "tags": node.tags,
-        "has_gap": node.has_gap,
-        "level": getattr(node, 'level', None),
-    }
-    if user_id:
-        query_params["user_id"] = user_id
-        
-    session.run(
+def upsert_node(session: Session, node: GraphNode, user_id: str) -> int:
+    """
+    Создает или обновляет узел пользователя; ключ узла - (user_id, id).
+    Возвращает число созданных узлов (0 или 1) - для квоты
+    """
+    result = session.run(
         """
-        MERGE (n:Node {id: $id})
+        MERGE (n:Node {id: $id, user_id: $user_id})
         SET n.label = $label,
             n.summary = $summary,
             n.tags = $tags,
             n.has_gap = $has_gap,
-            n.level = $level,
-            n.user_id = $user_id
+            n.level = $level
         """,
-        **query_params
+        id=node.id,
+        label=node.label,
+        summary=node.summary,
+        tags=node.tags,
+        has_gap=node.has_gap,
+        level=getattr(node, 'level', None),
+        user_id=user_id,
     )
+    return result.consume().counters.nodes_created
 
 
-def link_nodes(session: Session, source_id: str, target_id: str, relation: str, user_id: str = None):
-    query_params = {
-        "source": source_id,
-        "target": target_id,
-        "relation": relation,
-    }
-    
-    if user_id:
-        # Only link nodes belonging to the same user
-        session.run(
-            """
-            MATCH (a:Node {id: $source, user_id: $user_id}), (b:Node {id: $target, user_id: $user_id})
-            MERGE (a)-[r:RELATED {relation: $relation}]->(b)
-            RETURN r
-            """,
-            source=source_id,
-            target=target_id,
-            relation=relation,
-            user_id=user_id
-        )
-    else:
-        session.run(
-            """
-            MATCH (a:Node {id: $source}), (b:Node {id: $target})
-            MERGE (a)-[r:RELATED {relation: $relation}]->(b)
-            RETURN r
-            """,
-            **query_params
-        )
+def link_nodes(session: Session, source_id: str, target_id: str, relation: str, user_id: str):
+    # Связываются только узлы одного пользователя
+    session.run(
+        """
+        MATCH (a:Node {id: $source, user_id: $user_id}), (b:Node {id: $target, user_id: $user_id})
+        MERGE (a)-[r:RELATED {relation: $relation}]->(b)
+        RETURN r
+        """,
+        source=source_id,
+        target=target_id,
+        relation=relation,
+        user_id=user_id,
+    )
 
 
 def search_nodes_by_keywords(es: Elasticsearch, index: str, keywords: List[str], limit: int = 10) -> List[GraphNode]:
@@ -91,41 +75,98 @@ def search_nodes_by_keywords(es: Elasticsearch, index: str, keywords: List[str],
     return nodes
 
 
-def graph_from_cypher_records(records) -> GraphData:
+def graph_dict_from_cypher_records(records) -> Dict:
+    """
+    Записи (a, r, b) -> {"nodes": [...], "links": [...]} из простых dict.
+    Данные из БД доверенные, поэтому pydantic-валидация здесь не нужна
+    """
     node_map = {}
-    links: List[GraphLink] = []
+    links: List[Dict] = []
     for rec in records:
         a = rec.get("a")
         b = rec.get("b")
         r = rec.get("r")
         if a and a.id not in node_map:
-            node_map[a.id] = GraphNode(
-                id=a["id"],
-                label=a.get("label", a["id"]),
-                summary=a.get("summary"),
-                tags=a.get("tags", []),
-                has_gap=bool(a.get("has_gap", False)),
-                level=a.get("level"),
-                knowledge_gaps=a.get("knowledge_gaps", []),
-                recommendations=a.get("recommendations", []),
-            )
+            node_map[a.id] = node_to_dict(a)
         if b and b.id not in node_map:
-            node_map[b.id] = GraphNode(
-                id=b["id"],
-                label=b.get("label", b["id"]),
-                summary=b.get("summary"),
-                tags=b.get("tags", []),
-                has_gap=bool(b.get("has_gap", False)),
-                level=b.get("level"),
-                knowledge_gaps=b.get("knowledge_gaps", []),
-                recommendations=b.get("recommendations", []),
-            )
+            node_map[b.id] = node_to_dict(b)
         if r:
-            links.append(
-                GraphLink(
-                    source=a["id"],
-                    target=b["id"],
-                    relation=r.get("relation", "related"),
-                )
-            )
-    return GraphData(nodes=list(node_map.values()), links=links)
+            links.append({
+                "source": a["id"],
+                "target": b["id"],
+                "relation": r.get("relation") or r.get("type") or "related",
+            })
+    return {"nodes": list(node_map.values()), "links": links}
+
+
+GRAPH_RELATION_TYPES = "RELATED|contains|related_to"
+
+
+def node_to_dict(n) -> Dict:
+    """Узел Neo4j -> dict с полями GraphNode (без валидации pydantic)"""
+    data = {
+        "id": n["id"],
+        "label": n.get("label", n["id"]),
+        "summary": n.get("summary"),
+        "tags": n.get("tags") or [],
+        "has_gap": bool(n.get("has_gap", False)),
+        "level": n.get("level"),
+        "knowledge_gaps": n.get("knowledge_gaps") or [],
+        "recommendations": n.get("recommendations") or [],
+    }
+    # Координаты серверной раскладки (services.layout), если уже посчитаны
+    if n.get("x") is not None and n.get("y") is not None:
+        data["x"] = n["x"]
+        data["y"] = n["y"]
+    return overlay(n.get("user_id"), data)
+
+
+def iter_user_graph(session: Session, user_id: str) -> Iterator[Tuple[str, Dict]]:
+    """
+    Обходит граф пользователя одним запросом: по строке на узел вместе с его
+    исходящими связями. Направленный шаблон возвращает каждую связь один раз.
+    Выдает ("node", dict) и ("link", dict) в стабильном порядке (по id узла,
+    затем по target/relation), не материализуя весь результат
+    """
+    result = session.run(
+        f"""
+        MATCH (n:Node {{user_id: $user_id}})
+        OPTIONAL MATCH (n)-[r:{GRAPH_RELATION_TYPES}]->(m:Node {{user_id: $user_id}})
+        WITH n, collect(DISTINCT CASE WHEN r IS NULL THEN NULL
+                                      ELSE [m.id, coalesce(r.relation, r.type, 'related')] END) AS out
+        RETURN n, out
+        ORDER BY n.id
+        """,
+        user_id=user_id,
+    )
+    for record in result:
+        node = node_to_dict(record["n"])
+        yield "node", node
+        for target, relation in sorted(tuple(edge) for edge in record["out"]):
+            yield "link", {"source": node["id"], "target": target, "relation": relation}
+
+
+def iter_nodes_with_links(session: Session, user_id: str, node_ids: List[str]) -> Iterator[Tuple[str, Dict]]:
+    """
+    Текущее состояние узлов node_ids и всех их связей (в обе стороны) в виде
+    ("node", dict) и ("link", dict), как iter_user_graph. Отсутствующие узлы
+    пропускаются; связь между двумя узлами из node_ids выдается дважды
+    """
+    result = session.run(
+        f"""
+        MATCH (n:Node {{user_id: $user_id}})
+        WHERE n.id IN $ids
+        OPTIONAL MATCH (n)-[r:{GRAPH_RELATION_TYPES}]-(m:Node {{user_id: $user_id}})
+        WITH n, collect(DISTINCT CASE WHEN r IS NULL THEN NULL
+                                      ELSE [startNode(r) = n, m.id, coalesce(r.relation, r.type, 'related')] END) AS edges
+        RETURN n, edges
+        """,
+        user_id=user_id,
+        ids=node_ids,
+    )
+    for record in result:
+        node = node_to_dict(record["n"])
+        yield "node", node
+        for outgoing, other, relation in record["edges"]:
+            source, target = (node["id"], other) if outgoing else (other, node["id"])
+            yield "link", {"source": source, "target": target, "relation": relation}
@@ -0,0 +1,285 @@
+"""
+Серверная раскладка графа (force-directed, векторизовано на NumPy).
+
+Фоновый поток пересчитывает раскладку графа пользователя после записи и
+сохраняет координаты x/y на узлах. Пересчет инкрементальный: известные
+узлы стартуют с прежних позиций, новые - рядом с соседями, и температура
+ниже, поэтому старые узлы почти не сдвигаются. Записываются только
+сдвинувшиеся узлы; о них публикуется GraphChange(source=LAYOUT), чтобы
+клиенты (WebSocket, дельта-синхронизация) и кэши узлов получили новые
+координаты, а пересчеты структуры графа (раскладка, центральность,
+кластеры) его пропускали.
+"""
+from typing import Dict, List, Optional, Tuple
+import math
+import threading
+import time
+import logging
+import numpy as np
+from ..core.config import get_settings
+from ..db.tenancy import tenant_session
+from .knowledge import GRAPH_RELATION_TYPES
+from .graph_events import LAYOUT, GraphChange, publish, subscribe
+from .workers import DebouncedUserWorker
+
+logger = logging.getLogger(__name__)
+
+EXACT_LIMIT = 500  # до этого размера отталкивание считается точно
+CHUNK = 512
+MOVE_EPSILON = 10.0  # 0.1 длины связи (k = 100): меньшие сдвиги не записываются
+
+
+def _pairwise(targets: np.ndarray, sources: np.ndarray, k2: float, mass: Optional[np.ndarray] = None) -> np.ndarray:
+    """Сумма сил отталкивания k2 * m / d от sources на каждую из targets"""
+    dx = targets[:, 0, None] - sources[None, :, 0]
+    dy = targets[:, 1, None] - sources[None, :, 1]
+    weight = dx * dx
+    weight += dy * dy
+    np.maximum(weight, 1e-4, out=weight)
+    np.divide(k2 if mass is None else k2 * mass[None, :], weight, out=weight)
+    return np.stack([(dx * weight).sum(1), (dy * weight).sum(1)], axis=1)
+
+
+def _repulsion_exact(pos: np.ndarray, k2: float) -> np.ndarray:
+    disp = np.empty_like(pos)
+    for start in range(0, len(pos), CHUNK):
+        disp[start:start + CHUNK] = _pairwise(pos[start:start + CHUNK], pos, k2)
+    return disp
+
+
+def _repulsion_grid(pos: np.ndarray, k2: float) -> np.ndarray:
+    """
+    Приближение в духе Barnes–Hut на адаптивной сетке: узлы делятся на
+    ~sqrt(n) ячеек с равным числом узлов (полосы по x, в них - по y).
+    Внутри ячейки отталкивание точное, остальные ячейки действуют как
+    точечные массы в своем центре масс
+    """
+    n = len(pos)
+    side = max(2, int(n ** 0.25))
+    per_strip = -(-n // side)
+    order = np.argsort(pos[:, 0], kind="stable")
+    cells: List[np.ndarray] = []
+    for start in range(0, n, per_strip):
+        strip = order[start:start + per_strip]
+        strip = strip[np.argsort(pos[strip, 1], kind="stable")]
+        per_cell = -(-len(strip) // side)
+        cells.extend(strip[i:i + per_cell] for i in range(0, len(strip), per_cell))
+
+    c_pos = np.array([pos[members].mean(0) for members in cells])
+    c_mass = np.array([len(members) for members in cells], dtype=np.float64)
+    disp = np.empty_like(pos)
+    for c, members in enumerate(cells):
+        block = pos[members]
+        # Дальнее поле без своей ячейки, которая считается отдельно точно
+        mass = c_mass.copy()
+        mass[c] = 0.0
+        disp[members] = _pairwise(block, c_pos, k2, mass) + _pairwise(block, block, k2)
+    return disp
+
+
+def force_layout(
+    n: int,
+    edges: np.ndarray,
+    initial: Optional[np.ndarray] = None,
+    iterations: int = 100,
+    temperature: Optional[float] = None,
+    mobility: Optional[np.ndarray] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Fruchterman–Reingold. edges - массив (m, 2) индексов узлов.
+    mobility - множитель шага на узел (0..1), чтобы при теплом старте
+    двигались в основном новые узлы.
+    Возвращает позиции (n, 2) примерно в круге диаметром ~sqrt(n) * 100
+    """
+    if n == 0:
+        return np.zeros((0, 2))
+    size = math.sqrt(n) * 100.0
+    k = size / math.sqrt(n)
+    k2 = k * k
+    rng = np.random.default_rng(seed)
+    pos = initial.copy() if initial is not None else rng.uniform(-size / 2, size / 2, (n, 2))
+    temp = temperature if temperature is not None else size / 10
+    cooling = temp / max(iterations, 1)
+    repulsion = _repulsion_exact if n <= EXACT_LIMIT else _repulsion_grid
+    # Гравитация к центру уравновешивает суммарное отталкивание на радиусе size / 2
+    gravity = n * k2 / (size / 2) ** 2
+    step_scale = mobility[:, None] if mobility is not None else 1.0
+
+    src, dst = (edges[:, 0], edges[:, 1]) if len(edges) else (np.zeros(0, int), np.zeros(0, int))
+    for _ in range(iterations):
+        disp = repulsion(pos, k2)
+        if len(src):
+            delta = pos[src] - pos[dst]
+            dist = np.maximum(np.sqrt((delta ** 2).sum(1)), 1e-2)
+            pull = delta * (dist / k)[:, None]
+            np.add.at(disp, src, -pull)
+            np.add.at(disp, dst, pull)
+        disp -= pos * gravity
+        length = np.maximum(np.sqrt((disp ** 2).sum(1)), 1e-9)
+        pos += disp / length[:, None] * np.minimum(length, temp)[:, None] * step_scale
+        temp = max(temp - cooling, 1e-3)
+    return pos
+
+
+def layout_graph(
+    node_ids: List[str],
+    edges: List[Tuple[str, str]],
+    known: Dict[str, Tuple[float, float]],
+) -> Dict[str, Tuple[float, float]]:
+    """Раскладка с теплым стартом от известных позиций"""
+    s = get_settings()
+    n = len(node_ids)
+    index = {node: i for i, node in enumerate(node_ids)}
+    edge_array = np.array(
+        [(index[a], index[b]) for a, b in edges if a in index and b in index and a != b],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    if not known:
+        pos = force_layout(n, edge_array, iterations=s.layout_iterations)
+    else:
+        rng = np.random.default_rng(n)
+        size = math.sqrt(n) * 100.0
+        pos = np.zeros((n, 2))
+        placed = np.zeros(n, dtype=bool)
+        for node, xy in known.items():
+            if node in index:
+                pos[index[node]] = xy
+                placed[index[node]] = True
+        # Новые узлы - в центр масс уже размещенных соседей (или случайно)
+        neighbors: Dict[int, List[int]] = {}
+        for a, b in edge_array:
+            neighbors.setdefault(a, []).append(b)
+            neighbors.setdefault(b, []).append(a)
+        for i in np.nonzero(~placed)[0]:
+            anchors = [j for j in neighbors.get(i, []) if placed[j]]
+            base = pos[anchors].mean(0) if anchors else rng.uniform(-size / 2, size / 2, 2)
+            pos[i] = base + rng.normal(0, 10.0, 2)
+        # Новые узлы свободны, их соседи подстраиваются, остальные почти стоят
+        mobility = np.where(placed, 0.02, 1.0)
+        for i in np.nonzero(~placed)[0]:
+            for j in neighbors.get(i, []):
+                if placed[j]:
+                    mobility[j] = 0.3
+        pos = force_layout(
+            n,
+            edge_array,
+            initial=pos,
+            iterations=s.layout_incremental_iterations,
+            temperature=size / 20,
+            mobility=mobility,
+        )
+    return {node: (float(pos[i, 0]), float(pos[i, 1])) for node, i in index.items()}
+
+
+def _load_graph(user_id: str):
+    node_ids: List[str] = []
+    known: Dict[str, Tuple[float, float]] = {}
+    edges: List[Tuple[str, str]] = []
+    with tenant_session(user_id) as session:
+        result = session.run(
+            f"""
+            MATCH (n:Node {{user_id: $user_id}})
+            OPTIONAL MATCH (n)-[:{GRAPH_RELATION_TYPES}]->(m:Node {{user_id: $user_id}})
+            RETURN n.id AS id, n.x AS x, n.y AS y, collect(m.id) AS out
+            ORDER BY n.id
+            """,
+            user_id=user_id,
+        )
+        for record in result:
+            node_ids.append(record["id"])
+            if record["x"] is not None and record["y"] is not None:
+                known[record["id"]] = (record["x"], record["y"])
+            edges.extend((record["id"], target) for target in record["out"])
+    return node_ids, edges, known
+
+
+def _store_positions(user_id: str, positions: Dict[str, Tuple[float, float]]):
+    rows = [{"id": node, "x": round(x, 2), "y": round(y, 2)} for node, (x, y) in positions.items()]
+    with tenant_session(user_id) as session:
+        for start in range(0, len(rows), 1000):
+            session.run(
+                """
+                UNWIND $rows AS row
+                MATCH (n:Node {id: row.id, user_id: $user_id})
+                SET n.x = row.x, n.y = row.y
+                """,
+                rows=rows[start:start + 1000],
+                user_id=user_id,
+            )
+
+
+def _moved(
+    positions: Dict[str, Tuple[float, float]],
+    known: Dict[str, Tuple[float, float]],
+) -> Dict[str, Tuple[float, float]]:
+    moved = {}
+    for node, (x, y) in positions.items():
+        old = known.get(node)
+        if old is None or math.hypot(x - old[0], y - old[1]) >= MOVE_EPSILON:
+            moved[node] = (x, y)
+    return moved
+
+
+# Пользователи, у которых изменились только связи: узлы уже с координатами,
+# но раскладку все равно нужно подправить. Пишут обработчики событий (потоки
+# запросов), читает поток раскладки
+_pending_edges: Dict[str, bool] = {}
+_pending_lock = threading.Lock()
+
+
+def _mark_edges_changed(user_id: str):
+    with _pending_lock:
+        _pending_edges[user_id] = True
+
+
+def _take_edges_changed(user_id: str) -> bool:
+    with _pending_lock:
+        return _pending_edges.pop(user_id, False)
+
+
+def compute_user_layout(user_id: str):
+    # Флаг снимается до чтения графа: связь, добавленная во время пересчета,
+    # поставит его снова и вызовет следующий пересчет
+    edges_changed = _take_edges_changed(user_id)
+    node_ids, edges, known = _load_graph(user_id)
+    if not node_ids:
+        return
+    if len(known) == len(node_ids) and not edges_changed:
+        return
+    started = time.perf_counter()
+    positions = _moved(layout_graph(node_ids, edges, known), known)
+    if positions:
+        _store_positions(user_id, positions)
+        publish(GraphChange(user_id, upserted_nodes=set(positions), source=LAYOUT))
+    logger.info(
+        f"Layout for user {user_id}: {len(node_ids)} nodes ({len(node_ids) - len(known)} new, "
+        f"{len(positions)} moved) in {time.perf_counter() - started:.2f}s"
+    )
+
+
+class LayoutWorker(DebouncedUserWorker):
+    """Пересчитывает раскладку пользователей после серии записей"""
+
+    def __init__(self):
+        super().__init__("graph-layout", compute_user_layout, get_settings().layout_debounce)
+
+    def on_graph_change(self, change: GraphChange):
+        if change.source == LAYOUT:
+            return
+        if change.upserted_links or change.deleted_nodes:
+            _mark_edges_changed(change.user_id)
+        self.schedule(change.user_id)
+
+
+_worker: Optional[LayoutWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_layout_worker() -> LayoutWorker:
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = LayoutWorker()
+            subscribe(_worker.on_graph_change)
+        return _worker
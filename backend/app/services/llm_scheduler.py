@@ -0,0 +1,232 @@
+"""
+Планировщик вызовов LLM с честным разделением между пользователями.
+
+Все анализы идут через общую очередь, вызовы выполняют рабочие потоки;
+одновременных вызовов не больше лимита текущего провайдера
+(llm_provider_max_in_flight).
+
+- Классы приоритета: INTERACTIVE (анализ, которого ждет пользователь)
+  всегда выбирается раньше BULK (фоновое обогащение тегов заметок,
+  массовые загрузки).
+  BULK занимает не больше llm_bulk_max_in_flight слотов, так что для
+  интерактивных вызовов всегда есть свободный слот и их задержка не
+  зависит от фоновой нагрузки.
+- Внутри класса - взвешенная честная очередь (start-time fair queuing):
+  задание получает метку start = max(виртуальное время, finish прошлого
+  задания пользователя), finish = start + 1 / вес. Выбирается меньшая
+  метка, поэтому пользователь с тысячей заданий продвигается по одному
+  заданию на круг, а не занимает очередь целиком.
+"""
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+import heapq
+import itertools
+import threading
+import time
+import logging
+from ..core.config import get_settings
+from .llm import analyze_note_with_llm
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+@dataclass
+class _Job:
+    user_id: str
+    call: Callable[[], object]
+    priority: str
+    enqueued: float = field(default_factory=time.perf_counter)
+    future: Future = field(default_factory=Future)
+
+
+class _FairQueue:
+    """Очередь одного класса приоритета: SFQ по пользователям"""
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, _Job]] = []
+        self.virtual_time = 0.0
+        self.last_finish: Dict[str, float] = {}
+        self.queued: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, job: _Job, seq: int, weight: float):
+        start = max(self.virtual_time, self.last_finish.get(job.user_id, 0.0))
+        self.last_finish[job.user_id] = start + 1.0 / weight
+        self.queued[job.user_id] = self.queued.get(job.user_id, 0) + 1
+        heapq.heappush(self.heap, (start, seq, job))
+
+    def pop(self) -> _Job:
+        start, _, job = heapq.heappop(self.heap)
+        self.virtual_time = max(self.virtual_time, start)
+        left = self.queued[job.user_id] - 1
+        if left:
+            self.queued[job.user_id] = left
+        else:
+            del self.queued[job.user_id]
+            # Метка пользователя без заданий в прошлом больше не влияет на порядок
+            if self.last_finish.get(job.user_id, 0.0) <= self.virtual_time:
+                self.last_finish.pop(job.user_id, None)
+        return job
+
+
+class _ClassStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class LLMScheduler:
+    def __init__(self, max_in_flight: int, bulk_max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.bulk_max_in_flight = min(bulk_max_in_flight, max_in_flight)
+        self._queues = {priority: _FairQueue() for priority in PRIORITIES}
+        self._stats = {priority: _ClassStats() for priority in PRIORITIES}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop = False
+        for i in range(self.max_in_flight):
+            thread = threading.Thread(target=self._run, name=f"llm-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, user_id: str, call: Callable[[], object], priority: str = INTERACTIVE,
+               weight: float = 1.0) -> Future:
+        job = _Job(user_id, call, priority)
+        with self._cond:
+            self._queues[priority].push(job, next(self._seq), weight)
+            self._stats[priority].submitted += 1
+            self._cond.notify()
+        if not self._threads:
+            self.start()
+        return job.future
+
+    def run(self, user_id: str, call: Callable[[], object], priority: str = INTERACTIVE,
+            timeout: Optional[float] = None, weight: float = 1.0):
+        """
+        Выполняет call в очереди и ждет результат. TimeoutError, если за
+        timeout секунд (очередь плюс вызов) результата нет; задание, еще
+        не начавшееся к этому моменту, отменяется
+        """
+        future = self.submit(user_id, call, priority, weight)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            future.cancel()
+            with self._cond:
+                self._stats[priority].timeouts += 1
+            raise TimeoutError(f"LLM call for user {user_id} timed out in {priority} queue")
+
+    def _next_job(self) -> Optional[_Job]:
+        with self._cond:
+            while not self._stop:
+                if self._queues[INTERACTIVE]:
+                    return self._take(INTERACTIVE)
+                if self._queues[BULK] and self._stats[BULK].in_flight < self.bulk_max_in_flight:
+                    return self._take(BULK)
+                self._cond.wait()
+            return None
+
+    def _take(self, priority: str) -> _Job:
+        job = self._queues[priority].pop()
+        stats = self._stats[priority]
+        stats.in_flight += 1
+        waited = time.perf_counter() - job.enqueued
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            outcome = None  # отмененное по таймауту задание не выполняется
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.call())
+                        outcome = "completed"
+                    except Exception as e:
+                        outcome = "failed"
+                        job.future.set_exception(e)
+            finally:
+                with self._cond:
+                    stats = self._stats[job.priority]
+                    stats.in_flight -= 1
+                    if outcome:
+                        setattr(stats, outcome, getattr(stats, outcome) + 1)
+                    # Освободился слот BULK
+                    self._cond.notify()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            data = {"max_in_flight": self.max_in_flight, "bulk_max_in_flight": self.bulk_max_in_flight}
+            for priority in PRIORITIES:
+                queue, stats = self._queues[priority], self._stats[priority]
+                started = stats.completed + stats.failed + stats.in_flight
+                data[priority] = {
+                    "queued": len(queue),
+                    "queued_users": len(queue.queued),
+                    "max_user_queued": max(queue.queued.values(), default=0),
+                    "in_flight": stats.in_flight,
+                    "submitted": stats.submitted,
+                    "completed": stats.completed,
+                    "failed": stats.failed,
+                    "timeouts": stats.timeouts,
+                    "wait_avg_ms": round(stats.wait_total / started * 1000, 3) if started else 0.0,
+                    "wait_max_ms": round(stats.wait_max * 1000, 3),
+                }
+            return data
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            s = get_settings()
+            max_in_flight = s.llm_provider_max_in_flight.get(s.llm_provider, 4)
+            _scheduler = LLMScheduler(max_in_flight, s.llm_bulk_max_in_flight)
+        return _scheduler
+
+
+def scheduled_analysis(user_id: str, content: str, priority: str = INTERACTIVE,
+                       weight: float = 1.0) -> Optional[Dict]:
+    """analyze_note_with_llm через очередь; None, если не дождались (llm_queue_timeout)"""
+    try:
+        return get_llm_scheduler().run(
+            user_id, lambda: analyze_note_with_llm(content), priority,
+            timeout=get_settings().llm_queue_timeout, weight=weight,
+        )
+    except TimeoutError as e:
+        logger.warning(str(e))
+        return None
@@ -6,6 +6,7 @@ import unicodedata
 from typing import List, Dict, Optional, Tuple
 from difflib import SequenceMatcher
 import logging
+from ..core.config import get_settings
 
 logger = logging.getLogger(__name__)
 
@@ -114,41 +115,103 @@ def find_matching_node(
     return None
 
 
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+|\n+')
+_WORD = re.compile(r'\w+')
+
+
+def word_tokens(text: str) -> set:
+    # Короткие служебные слова не различают фразы, числа - различают
+    return {w for w in _WORD.findall(normalize_label(text)) if len(w) > 2 or w.isdigit()}
+
+
+def is_near_duplicate(a: str, b: str, threshold: float = 0.8) -> bool:
+    """
+    Почти одинаковые фразы: доля общих слов от меньшей фразы не ниже
+    threshold (перефразировка с теми же словами или вложенная фраза).
+    Фразы из одного-двух слов сравниваются целиком
+    """
+    ta, tb = word_tokens(a), word_tokens(b)
+    if min(len(ta), len(tb)) < 3:
+        return ta == tb if ta or tb else normalize_label(a) == normalize_label(b)
+    return len(ta & tb) / min(len(ta), len(tb)) >= threshold
+
+
+def dedupe_phrases(items: List[str]) -> List[str]:
+    """Убирает пустые и почти повторяющиеся фразы, сохраняя первую"""
+    kept: List[str] = []
+    for item in items:
+        item = (item or "").strip()
+        if item and not any(is_near_duplicate(item, other) for other in kept):
+            kept.append(item)
+    return kept
+
+
+def compact_summary(summary: str, max_chars: Optional[int] = None) -> str:
+    """
+    Описание без повторяющихся предложений, не длиннее max_chars (по
+    границе предложения). Первые предложения - исходное определение -
+    сохраняются, обрезаются поздние дополнения
+    """
+    if not summary:
+        return summary or ""
+    if max_chars is None:
+        max_chars = get_settings().node_summary_max_chars
+    paragraphs = []
+    total = 0
+    seen: List[str] = []
+    for paragraph in re.split(r'\n\s*\n', summary):
+        sentences = []
+        for sentence in _SENTENCE_END.split(paragraph):
+            sentence = sentence.strip()
+            if not sentence or any(is_near_duplicate(sentence, other) for other in seen):
+                continue
+            cost = len(sentence) + 1
+            if total + cost > max_chars and (seen or sentences):
+                break
+            seen.append(sentence)
+            sentences.append(sentence)
+            total += cost
+        if sentences:
+            paragraphs.append(" ".join(sentences))
+            total += 1
+    result = "\n\n".join(paragraphs)
+    return result[:max_chars]
+
+
+def rank_items(items: List[str], limit: int) -> List[str]:
+    """
+    Пробелы/рекомендации: items упорядочены от новых к старым, почти
+    повторяющиеся схлопываются в более новую формулировку, остаются limit
+    самых новых
+    """
+    return dedupe_phrases(items)[:limit]
+
+
+def compact_node_data(data: Dict) -> Dict:
+    """Ограничивает размер полей узла (описание, пробелы, рекомендации, теги)"""
+    s = get_settings()
+    compacted = data.copy()
+    compacted["summary"] = compact_summary(data.get("summary") or "")
+    compacted["knowledge_gaps"] = rank_items(data.get("knowledge_gaps") or [], s.node_max_gaps)
+    compacted["recommendations"] = rank_items(data.get("recommendations") or [], s.node_max_recommendations)
+    compacted["tags"] = list(dict.fromkeys(data.get("tags") or []))[:s.node_max_tags]
+    compacted["has_gap"] = bool(compacted["knowledge_gaps"] or compacted["recommendations"])
+    return compacted
+
+
 def merge_node_data(existing: Dict, new: Dict) -> Dict:
     """
-    Объединяет данные существующего и нового узла
+    Объединяет данные существующего и нового узла. Новые описание,
+    пробелы и рекомендации дополняют старые без повторов; размер полей
+    ограничен (compact_node_data)
     """
     merged = existing.copy()
-    
-    # Объединяем summary (если новый не пустой, дополняем существующий)
     existing_summary = existing.get("summary", "") or ""
     new_summary = new.get("summary", "") or ""
-    if new_summary and new_summary not in existing_summary:
-        if existing_summary:
-            # Добавляем новый summary только если он содержит новую информацию
-            merged["summary"] = f"{existing_summary}\n\n{new_summary}"
-        else:
-            merged["summary"] = new_summary
-    elif not existing_summary and new_summary:
-        merged["summary"] = new_summary
-    
-    # Объединяем knowledge_gaps
-    existing_gaps = set(existing.get("knowledge_gaps", []) or [])
-    new_gaps = set(new.get("knowledge_gaps", []) or [])
-    merged["knowledge_gaps"] = list(existing_gaps | new_gaps)
-    
-    # Объединяем recommendations
-    existing_recs = set(existing.get("recommendations", []) or [])
-    new_recs = set(new.get("recommendations", []) or [])
-    merged["recommendations"] = list(existing_recs | new_recs)
-    
-    # Объединяем tags
-    existing_tags = set(existing.get("tags", []) or [])
-    new_tags = set(new.get("tags", []) or [])
-    merged["tags"] = list(existing_tags | new_tags)
-    
-    # Обновляем has_gap
-    merged["has_gap"] = len(merged["knowledge_gaps"]) > 0 or len(merged["recommendations"]) > 0
-    
-    return merged
-
+    merged["summary"] = f"{existing_summary}\n\n{new_summary}" if existing_summary and new_summary \
+        else existing_summary or new_summary
+    # Новые пункты первыми: при обрезке по лимиту остаются актуальные
+    merged["knowledge_gaps"] = (new.get("knowledge_gaps") or []) + (existing.get("knowledge_gaps") or [])
+    merged["recommendations"] = (new.get("recommendations") or []) + (existing.get("recommendations") or [])
+    merged["tags"] = (existing.get("tags") or []) + (new.get("tags") or [])
+    return compact_node_data(merged)
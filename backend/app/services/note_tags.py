@@ -0,0 +1,58 @@
+"""
+Фоновое обогащение тегов заметок.
+
+Теги от LLM - обогащение, а не ответ на запрос: заметка сохраняется и
+возвращается сразу, анализ ставится в очередь планировщика LLM с
+приоритетом BULK и не держит ни поток запроса, ни слот допуска. Теги
+дописываются, когда анализ завершится; если текст заметки за это время
+изменился (для нового текста поставлен свой анализ) или заметку удалили,
+результат отбрасывается.
+"""
+from concurrent.futures import Future
+from typing import List
+import logging
+from ..db.postgres import SessionLocal
+from ..db.models import Note
+from .indexing import index_note
+from .llm import analyze_note_with_llm
+from .llm_scheduler import BULK, get_llm_scheduler
+
+logger = logging.getLogger(__name__)
+
+
+def enrich_note_tags(note: Note) -> Future:
+    """Ставит анализ заметки в очередь BULK; теги добавятся по его завершении"""
+    note_id, content = note.id, note.content
+    future = get_llm_scheduler().submit(str(note.user_id), lambda: analyze_note_with_llm(content), BULK)
+    future.add_done_callback(lambda done: _apply_tags(done, note_id, content))
+    return future
+
+
+def _apply_tags(future: Future, note_id: int, content: str):
+    if future.cancelled():
+        return
+    try:
+        analysis = future.result()
+    except Exception as e:
+        logger.warning(f"Tag analysis for note {note_id} failed: {e}")
+        return
+    tags: List[str] = (analysis or {}).get("tags") or []
+    if not tags:
+        return
+    db = SessionLocal()
+    try:
+        note = db.query(Note).filter(Note.id == note_id).with_for_update().first()
+        if note is None or note.content != content:
+            return
+        merged = list(dict.fromkeys(note.tags + tags))
+        if merged == note.tags:
+            return
+        note.tags = merged
+        db.commit()
+        db.refresh(note)
+        index_note(note)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Storing tags for note {note_id} failed: {e}")
+    finally:
+        db.close()
@@ -0,0 +1,151 @@
+"""
+Путь обучения между концептами: взвешенный кратчайший путь (двунаправленный Dijkstra) по
+снимку смежности пользователя (services.adjacency), без запросов к Neo4j.
+
+Связи вида "состоит из"/"часть" дешевле ассоциативных, поэтому путь
+предпочитает цепочки предпосылок. Результаты кэшируются (LRU) по версии
+графа: любая запись в граф меняет версию и старые пути больше не читаются.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import heapq
+import threading
+import numpy as np
+from ..core.config import get_settings
+from .adjacency import CSRGraph, get_adjacency_cache
+
+# Стоимость перехода по связи; чем меньше, тем предпочтительнее
+PREREQUISITE_WEIGHT = 1.0
+DEFAULT_WEIGHT = 2.0
+ASSOCIATIVE_WEIGHT = 3.0
+RELATION_WEIGHTS = {
+    "consists_of": PREREQUISITE_WEIGHT,
+    "part_of": PREREQUISITE_WEIGHT,
+    "contains": PREREQUISITE_WEIGHT,
+    "prerequisite": PREREQUISITE_WEIGHT,
+    "requires": PREREQUISITE_WEIGHT,
+    "depends_on": PREREQUISITE_WEIGHT,
+    "is_a": PREREQUISITE_WEIGHT,
+    "related": ASSOCIATIVE_WEIGHT,
+    "related_to": ASSOCIATIVE_WEIGHT,
+}
+
+
+def _edge_weights(graph: CSRGraph) -> np.ndarray:
+    table = np.array(
+        [RELATION_WEIGHTS.get(name, DEFAULT_WEIGHT) for name in graph.relation_names] or [DEFAULT_WEIGHT]
+    )
+    return table[graph.relations]
+
+
+def shortest_path(graph: CSRGraph, source: str, target: str) -> Optional[Dict]:
+    """
+    Двунаправленный Dijkstra от source и от target (связи проходятся в обе
+    стороны, так что обратный поиск идет по тем же спискам соседей).
+    Каждый поиск исследует лишь шар вокруг своего конца, что на графах
+    "малого мира" в разы меньше одного шара до цели.
+    Возвращает {"nodes", "links", "cost"} в порядке пути или None
+    """
+    start, goal = graph.index[source], graph.index[target]
+    if start == goal:
+        return {"nodes": [graph.nodes[start]], "links": [], "cost": 0.0}
+    weights = _edge_weights(graph)
+    # Для каждой стороны: расстояния, (предыдущий узел, позиция связи), куча
+    dist = ({start: 0.0}, {goal: 0.0})
+    came_from: Tuple[Dict[int, Tuple[int, int]], Dict[int, Tuple[int, int]]] = ({}, {})
+    heaps = ([(0.0, start)], [(0.0, goal)])
+    settled = (set(), set())
+    best, meeting = float("inf"), None
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        d, i = heapq.heappop(heaps[side])
+        if i in settled[side]:
+            continue
+        settled[side].add(i)
+        positions = graph.neighbor_slice(i)
+        neighbors = graph.targets[positions].tolist()
+        costs = weights[positions].tolist()
+        for offset, (j, w) in enumerate(zip(neighbors, costs)):
+            nd = d + w
+            if nd < dist[side].get(j, float("inf")):
+                dist[side][j] = nd
+                came_from[side][j] = (i, positions.start + offset)
+                heapq.heappush(heaps[side], (nd, j))
+            other = dist[1 - side].get(j)
+            if other is not None and nd + other < best:
+                best, meeting = nd + other, j
+    if meeting is None:
+        return None
+
+    # Половина от source до точки встречи, затем от нее до target
+    order = [meeting]
+    links = []
+    while order[-1] != start:
+        previous, position = came_from[0][order[-1]]
+        links.append(graph.link(previous, position))
+        order.append(previous)
+    order.reverse()
+    links.reverse()
+    while order[-1] != goal:
+        following, position = came_from[1][order[-1]]
+        links.append(graph.link(following, position))
+        order.append(following)
+    return {
+        "nodes": [graph.nodes[i] for i in order],
+        "links": links,
+        "cost": float(best),
+    }
+
+
+class PathCache:
+    """LRU путей по (пользователь, версия графа, откуда, куда)"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._paths: "OrderedDict[tuple, Optional[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            if key in self._paths:
+                self._paths.move_to_end(key)
+                return True, self._paths[key]
+            return False, None
+
+    def put(self, key: tuple, value: Optional[Dict]):
+        with self._lock:
+            self._paths[key] = value
+            self._paths.move_to_end(key)
+            while len(self._paths) > self.max_size:
+                self._paths.popitem(last=False)
+
+
+_cache: Optional[PathCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_path_cache() -> PathCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PathCache(get_settings().path_cache_size)
+        return _cache
+
+
+def learning_path(user_id: str, source: str, target: str) -> Tuple[bool, Optional[Dict]]:
+    """
+    (найдены ли оба узла, путь или None). Путь берется из кэша, если граф
+    с тех пор не менялся
+    """
+    graph = get_adjacency_cache().get(user_id)
+    if source not in graph.index or target not in graph.index:
+        return False, None
+    key = (user_id, graph.version, source, target)
+    cache = get_path_cache()
+    hit, path = cache.get(key)
+    if not hit:
+        path = shortest_path(graph, source, target)
+        cache.put(key, path)
+    return True, path
@@ -0,0 +1,204 @@
+"""
+Квота новых узлов на пользователя за скользящее окно.
+
+Созданные узлы считаются по корзинам (quota_bucket_minutes) в Postgres;
+использование за окно - сумма корзин окна плюс живые резервы, то есть
+фиксированное число строк по первичному ключу, без запросов к графу.
+
+Анализ заметки резервирует квоту до вызова LLM (reserve), после ответа
+при необходимости расширяет резерв до числа концептов (extend), а после
+записи в граф списывает реально созданные узлы (commit). Узлы, созданные
+без LLM-анализа (импорт из Wikipedia, POST /graph/nodes, построитель
+иерархии), списываются после записи (record). Незакрытый резерв
+(сбой процесса) истекает через quota_reservation_ttl. Удаление узлов квоту
+не возвращает: она ограничивает расход LLM, а не размер графа.
+
+Операции одного пользователя сериализуются advisory-блокировкой, поэтому
+параллельные анализы не превышают лимит.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+import uuid
+import logging
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from ..core.config import get_settings
+from ..db.postgres import SessionLocal
+from ..db.models import NodeQuotaBucket, NodeQuotaReservation, UserPlan
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, limit: int, used: int, window_hours: int):
+        self.limit = limit
+        self.used = used
+        self.remaining = max(limit - used, 0)
+        self.window_hours = window_hours
+        super().__init__(f"Node quota exceeded: {used}/{limit} in {window_hours}h")
+
+
+@dataclass
+class Reservation:
+    id: uuid.UUID
+    user_id: str
+    amount: int
+    settled: bool = False
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _bucket_start(moment: datetime) -> datetime:
+    size = get_settings().quota_bucket_minutes * 60
+    return datetime.fromtimestamp(int(moment.timestamp()) // size * size, timezone.utc)
+
+
+def _lock(db: Session, user_id: str):
+    db.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": f"quota:{user_id}"})
+
+
+def _limit(db: Session, uid: uuid.UUID) -> int:
+    s = get_settings()
+    plan = db.scalar(select(UserPlan.plan).where(UserPlan.user_id == uid)) or s.quota_default_plan
+    return s.quota_plans.get(plan, s.quota_plans[s.quota_default_plan])
+
+
+def _used(db: Session, uid: uuid.UUID, now: datetime, exclude: Optional[uuid.UUID] = None) -> int:
+    """Созданные за окно узлы плюс живые резервы (кроме exclude)"""
+    window_start = now - timedelta(hours=get_settings().quota_window_hours)
+    created = db.scalar(
+        select(func.coalesce(func.sum(NodeQuotaBucket.used), 0))
+        .where(NodeQuotaBucket.user_id == uid, NodeQuotaBucket.bucket > window_start)
+    )
+    reserved_query = select(func.coalesce(func.sum(NodeQuotaReservation.amount), 0)).where(
+        NodeQuotaReservation.user_id == uid, NodeQuotaReservation.expires_at > now
+    )
+    if exclude is not None:
+        reserved_query = reserved_query.where(NodeQuotaReservation.id != exclude)
+    return created + db.scalar(reserved_query)
+
+
+def usage(user_id: str) -> Dict:
+    s = get_settings()
+    uid = uuid.UUID(user_id)
+    db = SessionLocal()
+    try:
+        limit = _limit(db, uid)
+        used = _used(db, uid, _now())
+        return {"limit": limit, "used": used, "remaining": max(limit - used, 0), "window_hours": s.quota_window_hours}
+    finally:
+        db.close()
+
+
+def reserve(user_id: str, amount: Optional[int] = None) -> Reservation:
+    """
+    Резервирует до amount узлов (по умолчанию quota_reservation), но не
+    больше остатка. QuotaExceeded, если остатка нет
+    """
+    s = get_settings()
+    uid = uuid.UUID(user_id)
+    now = _now()
+    db = SessionLocal()
+    try:
+        _lock(db, user_id)
+        # Корзины вне окна и истекшие резервы больше не нужны
+        db.execute(delete(NodeQuotaBucket).where(
+            NodeQuotaBucket.user_id == uid,
+            NodeQuotaBucket.bucket <= now - timedelta(hours=s.quota_window_hours),
+        ))
+        db.execute(delete(NodeQuotaReservation).where(
+            NodeQuotaReservation.user_id == uid, NodeQuotaReservation.expires_at <= now,
+        ))
+        limit = _limit(db, uid)
+        used = _used(db, uid, now)
+        if used >= limit:
+            db.commit()
+            raise QuotaExceeded(limit, used, s.quota_window_hours)
+        reservation = Reservation(uuid.uuid4(), user_id, min(amount or s.quota_reservation, limit - used))
+        db.add(NodeQuotaReservation(
+            id=reservation.id,
+            user_id=uid,
+            amount=reservation.amount,
+            expires_at=now + timedelta(seconds=s.quota_reservation_ttl),
+        ))
+        db.commit()
+        return reservation
+    finally:
+        db.close()
+
+
+def extend(reservation: Reservation, amount: int):
+    """Увеличивает резерв до amount узлов; QuotaExceeded, если не хватает остатка"""
+    if amount <= reservation.amount:
+        return
+    s = get_settings()
+    uid = uuid.UUID(reservation.user_id)
+    now = _now()
+    db = SessionLocal()
+    try:
+        _lock(db, reservation.user_id)
+        limit = _limit(db, uid)
+        used = _used(db, uid, now, exclude=reservation.id)
+        if used + amount > limit:
+            raise QuotaExceeded(limit, used, s.quota_window_hours)
+        db.execute(
+            update(NodeQuotaReservation)
+            .where(NodeQuotaReservation.id == reservation.id)
+            .values(amount=amount, expires_at=now + timedelta(seconds=s.quota_reservation_ttl))
+        )
+        db.commit()
+        reservation.amount = amount
+    finally:
+        db.close()
+
+
+def _charge(db: Session, uid: uuid.UUID, created: int):
+    if created > 0:
+        stmt = insert(NodeQuotaBucket).values(user_id=uid, bucket=_bucket_start(_now()), used=created)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[NodeQuotaBucket.user_id, NodeQuotaBucket.bucket],
+            set_={"used": NodeQuotaBucket.used + stmt.excluded.used},
+        ))
+
+
+def commit(reservation: Reservation, created: int):
+    """Снимает резерв и списывает created созданных узлов в текущую корзину"""
+    uid = uuid.UUID(reservation.user_id)
+    db = SessionLocal()
+    try:
+        _lock(db, reservation.user_id)
+        db.execute(delete(NodeQuotaReservation).where(NodeQuotaReservation.id == reservation.id))
+        _charge(db, uid, created)
+        db.commit()
+        reservation.settled = True
+    finally:
+        db.close()
+
+
+def record(user_id: str, created: int):
+    """
+    Списывает узлы, созданные без резерва. Запись в граф уже сделана,
+    поэтому ошибка только логируется
+    """
+    if created <= 0:
+        return
+    db = SessionLocal()
+    try:
+        _lock(db, user_id)
+        _charge(db, uuid.UUID(user_id), created)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Failed to record {created} created nodes for user {user_id}: {e}")
+    finally:
+        db.close()
+
+
+def release(reservation: Reservation):
+    """Отменяет резерв, ничего не списывая (анализ не удался)"""
+    if not reservation.settled:
+        commit(reservation, 0)
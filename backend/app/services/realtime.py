@@ -0,0 +1,213 @@
+"""
+Push-уведомления клиентам по WebSocket.
+
+Hub держит открытые соединения пользователей в этом процессе и раздает им
+сообщения. Между процессами (несколько воркеров uvicorn) сообщения ходят
+через брокер:
+    memory   - в пределах процесса (по умолчанию, тесты, один воркер);
+    postgres - LISTEN/NOTIFY в уже имеющемся Postgres.
+
+Сообщения: {"type": "graph", ...} на каждое событие graph_events и
+{"type": "analysis", "stage": ...} о ходе анализа заметки.
+"""
+from typing import Callable, Dict, Optional, Set
+import asyncio
+import select
+import threading
+import logging
+import orjson
+from sqlalchemy import text
+from ..core.config import get_settings
+from ..db.postgres import engine
+from .graph_events import CHANGELOG, GraphChange, subscribe
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, Dict], None]
+
+NOTIFY_CHANNEL = "kyp_events"
+NOTIFY_MAX_PAYLOAD = 7900  # предел NOTIFY - 8000 байт
+
+
+class Broker:
+    """Доставка сообщений всем процессам; каждый процесс отдает их в свой Hub"""
+
+    def start(self, deliver: Deliver):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def publish(self, user_id: str, message: Dict):
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    def publish(self, user_id: str, message: Dict):
+        if self._deliver is not None:
+            self._deliver(user_id, message)
+
+
+class PostgresBroker(Broker):
+    """pg_notify на публикацию, отдельное соединение с LISTEN в фоновом потоке"""
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, deliver: Deliver):
+        self._deliver = deliver
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen, name="realtime-listen", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def publish(self, user_id: str, message: Dict):
+        payload = orjson.dumps({"user_id": user_id, "message": message})
+        if len(payload) > NOTIFY_MAX_PAYLOAD:
+            # Клиент дочитает подробности через /graph/changes
+            payload = orjson.dumps({"user_id": user_id, "message": {"type": message["type"], "truncated": True}})
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                         {"channel": NOTIFY_CHANNEL, "payload": payload.decode()})
+
+    def _listen(self):
+        while not self._stop.is_set():
+            try:
+                raw = engine.raw_connection()
+                try:
+                    # LISTEN вне транзакции, иначе уведомления не придут до COMMIT
+                    raw.driver_connection.autocommit = True
+                    cursor = raw.cursor()
+                    cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    pg = raw.driver_connection
+                    while not self._stop.is_set():
+                        if select.select([pg], [], [], 1.0) == ([], [], []):
+                            continue
+                        pg.poll()
+                        while pg.notifies:
+                            notify = pg.notifies.pop(0)
+                            event = orjson.loads(notify.payload)
+                            self._deliver(event["user_id"], event["message"])
+                finally:
+                    raw.invalidate()
+            except Exception as e:
+                logger.error(f"Realtime listener failed, reconnecting: {e}")
+                self._stop.wait(1.0)
+
+
+BROKERS = {
+    "memory": InMemoryBroker,
+    "postgres": PostgresBroker,
+}
+
+
+class Hub:
+    """
+    Соединения пользователей в этом процессе. deliver() потокобезопасен:
+    сообщения приходят из потоков роутов и брокера и передаются в event loop
+    """
+
+    def __init__(self, broker: Broker, queue_size: int):
+        self.broker = broker
+        self.queue_size = queue_size
+        self._connections: Dict[str, Set[asyncio.Queue]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started = False
+
+    def start(self):
+        if not self._started:
+            self.broker.start(self.deliver)
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            self.broker.stop()
+            self._started = False
+
+    def connect(self, user_id: str) -> asyncio.Queue:
+        self._loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._connections.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def disconnect(self, user_id: str, queue: asyncio.Queue):
+        queues = self._connections.get(user_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._connections[user_id]
+
+    def publish(self, user_id: str, message: Dict):
+        """Отправляет сообщение во все процессы через брокер"""
+        try:
+            self.broker.publish(user_id, message)
+        except Exception as e:
+            logger.error(f"Realtime publish failed: {e}")
+
+    def deliver(self, user_id: str, message: Dict):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        data = orjson.dumps(message).decode()
+        try:
+            asyncio.get_running_loop()
+            in_loop = True
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._fanout(user_id, data)
+        else:
+            loop.call_soon_threadsafe(self._fanout, user_id, data)
+
+    def _fanout(self, user_id: str, data: str):
+        for queue in list(self._connections.get(user_id, ())):
+            if queue.full():
+                # Медленный клиент: старое отбрасываем, свежие события важнее
+                queue.get_nowait()
+            queue.put_nowait(data)
+
+    def on_graph_change(self, change: GraphChange):
+        if change.source == CHANGELOG and not isinstance(self.broker, InMemoryBroker):
+            return  # записавший процесс уже разослал событие через общий брокер
+        self.publish(change.user_id, {
+            "type": "graph",
+            "upserted_nodes": sorted(change.upserted_nodes),
+            "deleted_nodes": sorted(change.deleted_nodes),
+            "upserted_links": [list(link) for link in change.upserted_links],
+            "deleted_links": [list(link) for link in change.deleted_links],
+        })
+
+
+_hub: Optional[Hub] = None
+_hub_lock = threading.Lock()
+
+
+def get_hub() -> Hub:
+    global _hub
+    with _hub_lock:
+        if _hub is None:
+            s = get_settings()
+            broker_class = BROKERS.get(s.realtime_broker)
+            if broker_class is None:
+                raise ValueError(f"Unknown realtime broker: {s.realtime_broker}")
+            _hub = Hub(broker_class(), s.realtime_queue_size)
+            subscribe(_hub.on_graph_change)
+        return _hub
+
+
+def notify_analysis(user_id: str, stage: str, **fields):
+    """Ход анализа заметки: started, llm_done, graph_saved, done, failed"""
+    get_hub().publish(user_id, {"type": "analysis", "stage": stage, **fields})
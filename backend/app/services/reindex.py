@@ -0,0 +1,305 @@
+"""
+Переиндексация Elasticsearch без простоя поиска.
+
+Данные перестраиваются из источников истины (Postgres для заметок,
+Neo4j для узлов) в новый версионированный индекс:
+
+1. создается "<name>_v<N+1>" без реплик и с отключенным refresh;
+2. ставится метка переиндексации (search_reindex_runs): с ней индексатор
+   записывает удаления в search_tombstones; после паузы, за которую ее
+   видят все индексаторы, алиас записи переключается на новый индекс,
+   поиск пока читает старый;
+3. данные загружаются параллельными срезами (op_type=create, чтобы не
+   затереть свежие записи, пришедшие во время загрузки);
+4. повторяются удаления, пришедшие во время загрузки (search_tombstones):
+   удаление еще не загруженного документа давало 404, и снимок создавал
+   его снова; документ удаляется, если его уже нет в источнике истины;
+5. восстанавливаются реплики и refresh_interval, индекс обновляется;
+6. алиас чтения атомарно переключается на новый индекс, метка и
+   надгробия индекса удаляются.
+
+Запуск: python -m app.services.reindex notes nodes --slices 4 [--delete-old]
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Set
+import argparse
+import logging
+import time
+from elasticsearch import Elasticsearch, helpers
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from ..core.config import get_settings
+from ..db.elastic import get_es, write_alias, alias_targets, next_index_version, create_versioned_index
+from ..db.postgres import SessionLocal
+from ..db.models import Note, SearchReindexRun, SearchTombstone
+from ..db.neo4j import get_neo4j_driver
+from .embeddings import get_embedder
+from .indexing import REINDEX_CHECK_INTERVAL, REINDEX_RUN_TTL, note_document, node_document, node_doc_id
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def _note_slice(slice_id: int, slices: int) -> Iterator[Dict]:
+    db = SessionLocal()
+    try:
+        query = db.query(Note).filter(Note.id % slices == slice_id).yield_per(BATCH_SIZE)
+        for note in query:
+            doc = note_document(note)
+            yield {"id": str(note.id), "doc": doc, "routing": doc["user_id"], "text": f"{note.title}\n{note.content}"}
+    finally:
+        db.close()
+
+
+def _node_element_ids() -> List[str]:
+    driver = get_neo4j_driver()
+    with driver.session() as session:
+        return [r["eid"] for r in session.run("MATCH (n:Node) RETURN elementId(n) AS eid")]
+
+
+def _node_slice(element_ids: List[str]) -> Iterator[Dict]:
+    driver = get_neo4j_driver()
+    with driver.session() as session:
+        for start in range(0, len(element_ids), BATCH_SIZE):
+            records = session.run(
+                "MATCH (n:Node) WHERE elementId(n) IN $eids RETURN n",
+                eids=element_ids[start:start + BATCH_SIZE],
+            )
+            for record in records:
+                props = dict(record["n"])
+                doc = node_document(props, props.get("user_id"))
+                yield {
+                    "id": node_doc_id(doc["id"], props.get("user_id")),
+                    "doc": doc,
+                    "routing": props.get("user_id"),
+                    "text": f"{doc['label']}\n{doc['summary'] or ''}",
+                }
+
+
+def _batched(items: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    batch: List[Dict] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _load(es: Elasticsearch, index: str, items: Iterable[Dict]) -> int:
+    """Загружает документы пакетами вместе с эмбеддингами, возвращает число загруженных"""
+    embedder = get_embedder()
+    loaded = 0
+    for batch in _batched(items, BATCH_SIZE):
+        vectors = embedder.embed([item["text"] for item in batch])
+        actions = []
+        for item, vec in zip(batch, vectors):
+            action = {
+                "_op_type": "create",
+                "_index": index,
+                "_id": item["id"],
+                "_source": {**item["doc"], "embedding": vec},
+            }
+            if item["routing"]:
+                action["routing"] = item["routing"]
+            actions.append(action)
+        ok, errors = helpers.bulk(es, actions, raise_on_error=False, stats_only=False)
+        loaded += ok
+        for error in errors:
+            # 409: документ уже записан живым трафиком - он свежее снимка
+            if error.get("create", {}).get("status") != 409:
+                logger.error(f"Reindex bulk error: {error}")
+    return loaded
+
+
+def _slices_for(name: str, slices: int) -> List[Iterable[Dict]]:
+    s = get_settings()
+    if name == s.elastic_index_notes:
+        return [_note_slice(i, slices) for i in range(slices)]
+    element_ids = _node_element_ids()
+    chunk = max(1, -(-len(element_ids) // slices))
+    return [_node_slice(element_ids[i:i + chunk]) for i in range(0, len(element_ids), chunk)]
+
+
+def _db_now() -> datetime:
+    # Время Postgres, а не процесса: отметки надгробий ставит сервер БД
+    db = SessionLocal()
+    try:
+        return db.execute(select(func.now())).scalar_one()
+    finally:
+        db.close()
+
+
+def _tombstones(write: str, since: datetime) -> List[SearchTombstone]:
+    db = SessionLocal()
+    try:
+        return db.query(SearchTombstone).filter(
+            SearchTombstone.index == write, SearchTombstone.deleted_at >= since,
+        ).all()
+    finally:
+        db.close()
+
+
+def _existing_notes(doc_ids: List[str]) -> Set[str]:
+    ids = [int(doc_id) for doc_id in doc_ids if doc_id.isdigit()]
+    db = SessionLocal()
+    try:
+        return {str(note_id) for (note_id,) in db.query(Note.id).filter(Note.id.in_(ids))}
+    finally:
+        db.close()
+
+
+def _existing_nodes(doc_ids: List[str]) -> Set[str]:
+    driver = get_neo4j_driver()
+    with driver.session() as session:
+        result = session.run(
+            """
+            MATCH (n:Node) WHERE n.id IN $ids
+            RETURN n.id AS id, n.user_id AS user_id
+            """,
+            ids=[doc_id.split(":", 1)[-1] for doc_id in doc_ids],
+        )
+        return {node_doc_id(record["id"], record["user_id"]) for record in result}
+
+
+def _apply_tombstones(es: Elasticsearch, name: str, index: str, since: datetime) -> int:
+    """Удаляет из нового индекса документы, удаленные во время загрузки; возвращает их число"""
+    tombstones = _tombstones(write_alias(name), since)
+    if not tombstones:
+        return 0
+    doc_ids = sorted({t.doc_id for t in tombstones})
+    existing = _existing_notes(doc_ids) if name == get_settings().elastic_index_notes else _existing_nodes(doc_ids)
+    actions = []
+    # Документ, созданный заново после удаления, остается
+    for tombstone in {t.doc_id: t for t in tombstones if t.doc_id not in existing}.values():
+        action = {"_op_type": "delete", "_index": index, "_id": tombstone.doc_id}
+        if tombstone.routing:
+            action["routing"] = tombstone.routing
+        actions.append(action)
+    _, errors = helpers.bulk(es, actions, raise_on_error=False, stats_only=False)
+    for error in errors:
+        if error.get("delete", {}).get("status") != 404:
+            logger.error(f"Reindex tombstone error: {error}")
+    return len(actions)
+
+
+def _start_run(name: str):
+    """Ставит метку переиндексации и ждет, пока ее увидят индексаторы (indexing.reindexing)"""
+    db = SessionLocal()
+    try:
+        stmt = insert(SearchReindexRun).values(index=write_alias(name))
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[SearchReindexRun.index], set_={"started_at": func.now()},
+        ))
+        db.commit()
+    finally:
+        db.close()
+    time.sleep(2 * REINDEX_CHECK_INTERVAL)
+
+
+def _finish_run(name: str):
+    """
+    Снимает метку и удаляет надгробия индекса (они уже применены или не
+    нужны), а заодно надгробия старше REINDEX_RUN_TTL от упавших запусков
+    """
+    db = SessionLocal()
+    try:
+        db.execute(delete(SearchReindexRun).where(SearchReindexRun.index == write_alias(name)))
+        db.execute(delete(SearchTombstone).where(
+            (SearchTombstone.index == write_alias(name))
+            | (SearchTombstone.deleted_at < func.now() - timedelta(seconds=REINDEX_RUN_TTL))
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def reindex(name: str, slices: int = 4, delete_old: bool = False) -> str:
+    """Перестраивает индекс name (алиас чтения) и возвращает имя нового физического индекса"""
+    s = get_settings()
+    if name not in (s.elastic_index_notes, s.elastic_index_nodes):
+        raise ValueError(f"Unknown index: {name}")
+    # Новый индекс помечается текущим эмбеддером (EMBEDDING_META): без него
+    # документы остались бы без векторов
+    if get_embedder() is None:
+        raise RuntimeError(f"Embedder {s.embedding_backend} is unavailable, see the log above")
+    es = get_es()
+    write = write_alias(name)
+    old_read = alias_targets(es, name)
+    legacy = not old_read and es.indices.exists(index=name)
+    old_write = alias_targets(es, write)
+
+    _start_run(name)
+    new_index = create_versioned_index(es, name, next_index_version(es, name), bulk_load=True)
+
+    # Удаления с этого момента могут не дойти до нового индекса
+    started = _db_now()
+    # Новые записи сразу идут в новый индекс
+    actions = [{"remove": {"index": idx, "alias": write}} for idx in old_write]
+    actions.append({"add": {"index": new_index, "alias": write, "is_write_index": True}})
+    es.indices.update_aliases(actions=actions)
+
+    try:
+        with ThreadPoolExecutor(max_workers=slices) as pool:
+            loaded = sum(pool.map(lambda items: _load(es, new_index, items), _slices_for(name, slices)))
+        logger.info(f"Loaded {loaded} documents into {new_index}")
+        removed = _apply_tombstones(es, name, new_index, started)
+        if removed:
+            logger.info(f"Re-applied {removed} deletes made during the load")
+
+        es.indices.put_settings(index=new_index, settings={
+            "number_of_replicas": s.elastic_number_of_replicas,
+            "refresh_interval": s.elastic_refresh_interval,
+        })
+        es.indices.refresh(index=new_index)
+        es.cluster.health(index=new_index, wait_for_status="yellow", timeout="60s")
+    except Exception:
+        logger.exception(f"Reindex of {name} failed, rolling back write alias")
+        actions = [{"remove": {"index": new_index, "alias": write}}]
+        actions += [{"add": {"index": idx, "alias": write, "is_write_index": True}} for idx in old_write]
+        es.indices.update_aliases(actions=actions)
+        es.indices.delete(index=new_index)
+        _finish_run(name)
+        raise
+
+    # Атомарное переключение чтения; старый неверсионированный индекс с тем же
+    # именем, что и алиас, удаляется в той же операции
+    if legacy:
+        actions = [{"remove_index": {"index": name}}]
+    else:
+        actions = [{"remove": {"index": idx, "alias": name}} for idx in old_read]
+    actions.append({"add": {"index": new_index, "alias": name}})
+    es.indices.update_aliases(actions=actions)
+    logger.info(f"Alias {name} now points to {new_index}")
+    _finish_run(name)
+
+    if delete_old:
+        for idx in old_read:
+            if idx != new_index:
+                es.indices.delete(index=idx)
+                logger.info(f"Deleted old index {idx}")
+    return new_index
+
+
+def main():
+    s = get_settings()
+    parser = argparse.ArgumentParser(description="Zero-downtime Elasticsearch reindex")
+    parser.add_argument(
+        "indices",
+        nargs="*",
+        default=[s.elastic_index_notes, s.elastic_index_nodes],
+        help="Read aliases to rebuild (default: notes and nodes)",
+    )
+    parser.add_argument("--slices", type=int, default=4, help="Parallel load slices")
+    parser.add_argument("--delete-old", action="store_true", help="Delete previous physical indices")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for name in args.indices:
+        reindex(name, slices=args.slices, delete_old=args.delete_old)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 import requests
 import time
 from typing import Dict, List, Optional
-from ..db.neo4j import get_neo4j_driver
-from ..db.elastic import get_es
-from ..core.config import get_settings
+from ..db.tenancy import tenant_session
 from ..models.schemas import GraphNode, GraphLink
 from ..services.knowledge import upsert_node, link_nodes
+from ..services.indexing import index_node
+from ..services.graph_events import GraphChange, publish
+from ..services import quota
 import hashlib
 import logging
 
@@ -72,9 +73,9 @@ def create_node_from_wikipedia(title: str, extract: str, tags: List[str] = None)
     )
 
 
-def import_wikipedia_article(title: str) -> Optional[GraphNode]:
+def import_wikipedia_article(title: str, user_id: str) -> Optional[GraphNode]:
     """
-    Импортирует одну статью из Wikipedia в граф знаний
+    Импортирует одну статью из Wikipedia в граф знаний пользователя
     """
     article = fetch_wikipedia_article(title)
     if not article:
@@ -86,22 +87,14 @@ def import_wikipedia_article(title: str) -> Optional[GraphNode]:
         tags=["wikipedia"]
     )
     
-    driver = get_neo4j_driver()
-    es = get_es()
-    s = get_settings()
-    
     try:
-        with driver.session() as session:
-            upsert_node(session, node)
+        with tenant_session(user_id) as session:
+            created = upsert_node(session, node, user_id=user_id)
             
             # Индексируем в Elasticsearch
-            es.index(index=s.elastic_index_nodes, id=node.id, document={
-                "id": node.id,
-                "label": node.label,
-                "summary": node.summary,
-                "tags": node.tags,
-                "has_gap": node.has_gap
-            })
+            index_node(node.model_dump(), user_id)
+        quota.record(user_id, created)
+        publish(GraphChange(user_id, upserted_nodes={node.id}))
         
         logger.info(f"Imported Wikipedia article: {title}")
         return node
@@ -110,7 +103,11 @@ def import_wikipedia_article(title: str) -> Optional[GraphNode]:
         return None
 
 
-def import_wikipedia_articles_by_keywords(keywords: List[str], max_articles: int = 20) -> List[GraphNode]:
+def import_wikipedia_articles_by_keywords(
+    keywords: List[str],
+    max_articles: int = 20,
+    user_id: str = None,
+) -> List[GraphNode]:
     """
     Импортирует статьи из Wikipedia по ключевым словам
     """
@@ -142,22 +139,14 @@ def import_wikipedia_articles_by_keywords(keywords: List[str], max_articles: int
                     tags=["wikipedia", keyword.lower()]
                 )
                 
-                driver = get_neo4j_driver()
-                es = get_es()
-                s = get_settings()
-                
                 try:
-                    with driver.session() as session:
-                        upsert_node(session, node)
+                    with tenant_session(user_id) as session:
+                        created = upsert_node(session, node, user_id=user_id)
                         
                         # Индексируем в Elasticsearch
-                        es.index(index=s.elastic_index_nodes, id=node.id, document={
-                            "id": node.id,
-                            "label": node.label,
-                            "summary": node.summary,
-                            "tags": node.tags,
-                            "has_gap": node.has_gap
-                        })
+                        index_node(node.model_dump(), user_id)
+                    quota.record(user_id, created)
+                    publish(GraphChange(user_id, upserted_nodes={node.id}))
                     
                     imported_nodes.append(node)
                     logger.info(f"Imported: {title}")
@@ -170,30 +159,36 @@ def import_wikipedia_articles_by_keywords(keywords: List[str], max_articles: int
     return imported_nodes
 
 
-def link_wikipedia_nodes(nodes: List[GraphNode]):
+def link_wikipedia_nodes(nodes: List[GraphNode], user_id: str):
     """
     Создает связи между узлами Wikipedia на основе общих тегов
     """
-    driver = get_neo4j_driver()
+    change = GraphChange(user_id)
     
-    with driver.session() as session:
+    with tenant_session(user_id) as session:
         for i, node1 in enumerate(nodes):
             for node2 in nodes[i+1:]:
                 # Связываем узлы, если у них есть общие теги
                 common_tags = set(node1.tags) & set(node2.tags)
                 if common_tags:
-                    link_nodes(session, node1.id, node2.id, "related")
+                    link_nodes(session, node1.id, node2.id, "related", user_id=user_id)
+                    change.upserted_links.append((node1.id, node2.id, "related"))
                     logger.debug(f"Linked {node1.label} <-> {node2.label}")
+    publish(change)
 
 
-def populate_knowledge_base_from_keywords(keywords: List[str], max_articles: int = 20):
+def populate_knowledge_base_from_keywords(
+    keywords: List[str],
+    max_articles: int = 20,
+    user_id: str = None,
+):
     """
-    Заполняет базу знаний статьями из Wikipedia по ключевым словам
+    Заполняет базу знаний пользователя статьями из Wikipedia по ключевым словам
     """
     logger.info(f"Starting Wikipedia import for keywords: {keywords}")
-    nodes = import_wikipedia_articles_by_keywords(keywords, max_articles)
+    nodes = import_wikipedia_articles_by_keywords(keywords, max_articles, user_id=user_id)
     if nodes:
-        link_wikipedia_nodes(nodes)
+        link_wikipedia_nodes(nodes, user_id=user_id)
         logger.info(f"Imported {len(nodes)} articles from Wikipedia")
     return nodes
 
@@ -0,0 +1,73 @@
+"""
+Фоновые пересчеты по пользователям с задержкой (debounce).
+
+Запись в граф планирует задачу пользователя; повторные записи в течение
+debounce секунд сдвигают срок, так что серия изменений дает один пересчет.
+"""
+from typing import Callable, Dict, Optional
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DebouncedUserWorker:
+    """Поток, вызывающий handler(user_id) после debounce секунд тишины"""
+
+    def __init__(self, name: str, handler: Callable[[str], None], debounce: float):
+        self.name = name
+        self.handler = handler
+        self.debounce = debounce
+        self._due: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if not self.running:
+            return
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def schedule(self, user_id: str):
+        with self._cond:
+            self._due[user_id] = time.monotonic() + self.debounce
+            self._cond.notify()
+
+    def _next_due(self) -> Optional[str]:
+        with self._cond:
+            while not self._stop:
+                now = time.monotonic()
+                ready = [u for u, due in self._due.items() if due <= now]
+                if ready:
+                    user_id = min(ready, key=self._due.get)
+                    del self._due[user_id]
+                    return user_id
+                timeout = min(self._due.values()) - now if self._due else None
+                self._cond.wait(timeout)
+            return None
+
+    def _run(self):
+        while True:
+            user_id = self._next_due()
+            if user_id is None:
+                return
+            try:
+                self.handler(user_id)
+            except Exception as e:
+                logger.error(f"{self.name} for user {user_id} failed: {e}")
@@ -0,0 +1,195 @@
+"""
+Отложенная запись обновлений существующих узлов (write-behind).
+
+Повторный анализ и автосохранение раз за разом переписывают одни и те же
+узлы (пробелы, рекомендации, уровень, updated_at), и каждая такая запись -
+отдельная транзакция, которая ждет блокировку того же узла. Буфер копит
+обновления по ключу (пользователь, id узла), сливает последовательные
+обновления по правилам merge_node_data и раз в write_behind_interval
+пишет их одной транзакцией на пользователя (UNWIND). При остановке
+приложения буфер дописывается.
+
+Чтение видит несохраненные обновления: node_to_dict и анализ заметки
+накладывают их на данные из Neo4j (overlay); обновление остается в буфере,
+пока запись не завершится. GraphChange об обновленных узлах публикуется
+после записи, поэтому журнал изменений, кэши смежности и другие процессы
+перечитывают уже новые данные. Буфер - в памяти процесса: при аварийном
+завершении теряются обновления последнего интервала. По умолчанию
+выключен (write_behind_enabled).
+"""
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+import threading
+import logging
+from ..core.config import get_settings
+from ..db.tenancy import tenant_session
+from .graph_events import GraphChange, publish, subscribe
+from .node_matching import merge_node_data
+
+logger = logging.getLogger(__name__)
+
+FLUSH_BATCH = 1000
+
+
+def _coalesce(pending: Dict, update: Dict) -> Dict:
+    """
+    Два обновления одного узла -> одно. Пробелы и рекомендации
+    объединяются (merge_node_data); описание, как в ON MATCH SET анализа,
+    заполняет только пустое; уровень - наименьший
+    """
+    merged = merge_node_data(pending, update)
+    merged["summary"] = pending.get("summary") or update.get("summary")
+    merged["has_gap"] = bool(pending.get("has_gap") or update.get("has_gap"))
+    levels = [level for level in (pending.get("level"), update.get("level")) if level is not None]
+    merged["level"] = min(levels) if levels else None
+    merged["updated_at"] = update["updated_at"]
+    merged.pop("tags", None)
+    return merged
+
+
+def apply_update(data: Dict, update: Dict) -> Dict:
+    """То же, что запрос записи (_flush_user), на dict узла"""
+    result = dict(data)
+    if not result.get("summary"):
+        result["summary"] = update.get("summary")
+    if update.get("has_gap"):
+        result["has_gap"] = True
+    result["knowledge_gaps"] = update.get("knowledge_gaps") or []
+    result["recommendations"] = update.get("recommendations") or []
+    level = update.get("level")
+    if level is not None and (result.get("level") is None or level < result["level"]):
+        result["level"] = level
+    return result
+
+
+class NodeWriteBuffer:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending: Dict[Tuple[str, str], Dict] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.staged = 0
+        self.written = 0
+        self.flushes = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="node-write-behind", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def stage(self, user_id: str, node_id: str, update: Dict):
+        """
+        Ставит обновление существующего узла: summary (если пусто),
+        knowledge_gaps, recommendations, has_gap, level
+        """
+        update = {**update, "updated_at": datetime.now(timezone.utc).isoformat()}
+        key = (user_id, node_id)
+        with self._lock:
+            pending = self._pending.get(key)
+            self._pending[key] = update if pending is None else _coalesce(pending, update)
+            self.staged += 1
+
+    def overlay(self, user_id: Optional[str], data: Dict) -> Dict:
+        if not self._pending or user_id is None:
+            return data
+        with self._lock:
+            update = self._pending.get((user_id, data["id"]))
+        return data if update is None else apply_update(data, update)
+
+    def on_graph_change(self, change: GraphChange):
+        # Удаленный (и, возможно, созданный заново) узел не получает старое обновление
+        if change.deleted_nodes:
+            with self._lock:
+                for node_id in change.deleted_nodes:
+                    self._pending.pop((change.user_id, node_id), None)
+
+    def flush(self):
+        # Снимок без изъятия: до конца записи overlay видит обновления
+        with self._lock:
+            if not self._pending:
+                return
+            batch = dict(self._pending)
+        by_user: Dict[str, List[Tuple[str, Dict]]] = {}
+        for (user_id, node_id), update in batch.items():
+            by_user.setdefault(user_id, []).append((node_id, update))
+        for user_id, updates in by_user.items():
+            try:
+                self._flush_user(user_id, [{"id": node_id, **update} for node_id, update in updates])
+            except Exception as e:
+                # Обновления остаются в буфере до следующей записи
+                logger.error(f"Write-behind flush for user {user_id} failed: {e}")
+                continue
+            # Записанное убирается, если его не дополнили во время записи;
+            # дополненное запишется целиком в следующий раз (запрос идемпотентен)
+            with self._lock:
+                for node_id, update in updates:
+                    if self._pending.get((user_id, node_id)) is update:
+                        del self._pending[(user_id, node_id)]
+            publish(GraphChange(user_id, upserted_nodes={node_id for node_id, _ in updates}))
+        self.flushes += 1
+
+    def _flush_user(self, user_id: str, rows: List[Dict]):
+        with tenant_session(user_id) as session:
+            for start in range(0, len(rows), FLUSH_BATCH):
+                session.run(
+                    """
+                    UNWIND $rows AS row
+                    MATCH (n:Node {id: row.id, user_id: $user_id})
+                    SET n.summary = CASE WHEN n.summary IS NULL OR n.summary = '' THEN row.summary
+                                         ELSE n.summary END,
+                        n.updated_at = datetime(row.updated_at),
+                        n.has_gap = CASE WHEN row.has_gap THEN true ELSE n.has_gap END,
+                        n.knowledge_gaps = row.knowledge_gaps,
+                        n.recommendations = row.recommendations,
+                        n.level = CASE WHEN row.level < n.level OR n.level IS NULL THEN row.level
+                                       ELSE n.level END
+                    """,
+                    rows=rows[start:start + FLUSH_BATCH],
+                ).consume()
+        self.written += len(rows)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "staged": self.staged,
+            "written": self.written,
+            "flushes": self.flushes,
+        }
+
+
+_buffer: Optional[NodeWriteBuffer] = None
+_buffer_lock = threading.Lock()
+
+
+def get_write_buffer() -> Optional[NodeWriteBuffer]:
+    """None, если отложенная запись выключена (write_behind_enabled)"""
+    global _buffer
+    s = get_settings()
+    if not s.write_behind_enabled:
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = NodeWriteBuffer(s.write_behind_interval)
+            subscribe(_buffer.on_graph_change)
+        return _buffer
+
+
+def overlay(user_id: Optional[str], data: Dict) -> Dict:
+    """data с несохраненным обновлением узла, если оно есть"""
+    return _buffer.overlay(user_id, data) if _buffer is not None else data
@@ -0,0 +1,109 @@
+"""
+Сравнение CPU на сериализацию большого графа:
+старый путь (валидированные GraphNode/GraphLink + повторная валидация
+response_model + json) против быстрого (dict + ORJSONResponse).
+
+Запуск: cd backend && python -m benchmarks.bench_graph_serialization [nodes] [links_per_node]
+"""
+import json
+import sys
+import time
+from pydantic import TypeAdapter
+from fastapi.responses import ORJSONResponse
+from app.models.schemas import GraphNode, GraphLink, GraphData
+from app.services.knowledge import graph_dict_from_cypher_records
+
+
+class FakeNode(dict):
+    """Имитирует neo4j.graph.Node: dict-свойства и атрибут id"""
+
+    @property
+    def id(self):
+        return self["id"]
+
+
+def make_records(n_nodes: int, links_per_node: int):
+    nodes = [
+        FakeNode(
+            id=f"node_{i:06d}",
+            label=f"Концепт {i}",
+            summary="Краткое описание концепта. " * 4,
+            tags=["общее", f"тег{i % 17}"],
+            has_gap=i % 3 == 0,
+            level=i % 3,
+            knowledge_gaps=["Что осталось непонятным"] if i % 3 == 0 else [],
+            recommendations=["Что изучить дальше"] if i % 3 == 0 else [],
+            # Часть узлов еще без серверной раскладки
+            **({"x": float(i), "y": float(-i)} if i % 2 else {}),
+        )
+        for i in range(n_nodes)
+    ]
+    records = []
+    for i, a in enumerate(nodes):
+        for k in range(1, links_per_node + 1):
+            b = nodes[(i + k) % n_nodes]
+            records.append({"a": a, "r": {"relation": "related_to"}, "b": b})
+    return records
+
+
+def legacy_path(records) -> bytes:
+    # Как было: GraphNode/GraphLink на каждую запись, затем FastAPI
+    # валидирует GraphData через response_model и сериализует json.dumps
+    node_map = {}
+    links = []
+    for rec in records:
+        a, b, r = rec["a"], rec["b"], rec["r"]
+        for n in (a, b):
+            if n.id not in node_map:
+                node_map[n.id] = GraphNode(
+                    id=n["id"],
+                    label=n.get("label", n["id"]),
+                    summary=n.get("summary"),
+                    tags=n.get("tags", []),
+                    has_gap=bool(n.get("has_gap", False)),
+                    level=n.get("level"),
+                    knowledge_gaps=n.get("knowledge_gaps", []),
+                    recommendations=n.get("recommendations", []),
+                    x=n.get("x"),
+                    y=n.get("y"),
+                )
+        links.append(GraphLink(source=a["id"], target=b["id"], relation=r.get("relation", "related")))
+    data = GraphData(nodes=list(node_map.values()), links=links)
+    adapter = TypeAdapter(GraphData)
+    validated = adapter.validate_python(data, from_attributes=True)
+    # Быстрый путь не пишет x/y узлов без раскладки, старый писал бы null;
+    # остальные поля в данных бенчмарка не бывают null
+    return json.dumps(
+        adapter.dump_python(validated, mode="json", exclude_none=True), ensure_ascii=False
+    ).encode()
+
+
+def fast_path(records) -> bytes:
+    return ORJSONResponse(graph_dict_from_cypher_records(records)).body
+
+
+def measure(fn, records, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        fn(records)
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def main():
+    n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    links_per_node = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    records = make_records(n_nodes, links_per_node)
+    assert json.loads(legacy_path(records)) == json.loads(fast_path(records))
+
+    legacy = measure(legacy_path, records, 3)
+    fast = measure(fast_path, records, 3)
+    print(f"records: {len(records)}, nodes: {n_nodes}")
+    print(f"legacy (pydantic + response_model + json): {legacy * 1000:.1f} ms CPU")
+    print(f"fast (dict + orjson):                      {fast * 1000:.1f} ms CPU")
+    print(f"speedup: {legacy / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
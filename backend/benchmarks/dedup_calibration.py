@@ -0,0 +1,115 @@
+"""
+Калибровка порога слияния дубликатов (services.dedup).
+
+Размеченные пары узлов - настоящие дубликаты и разные понятия с похожими
+названиями - в том виде, в каком их создает анализ (название и описание
+в одно предложение) или импорт без описания. Печатает оценку каждой пары
+и точность/полноту по порогам; падает, если порог по умолчанию
+(dedup_merge_threshold) сливает хоть одну пару разных понятий или не выше
+1 - SUMMARY_WEIGHT (совпавшие названия сливаются при любых описаниях).
+
+Запуск: cd backend && python -m benchmarks.dedup_calibration
+"""
+from app.core.config import get_settings
+from app.services.dedup import SUMMARY_WEIGHT, _Candidate, label_trigrams, score_pair, summary_stems
+
+# (название, описание) x 2; пустое описание - узел без описания (иерархия, Wikipedia)
+DUPLICATES = [
+    (("Нейронные сети", "Нейронные сети - модели машинного обучения, вдохновленные устройством мозга."),
+     ("нейросети", "Нейросети используются для распознавания изображений и речи.")),
+    (("Нейронные сети", ""), ("Нейросети", "")),
+    (("Нейронная сеть", "Вычислительная модель из связанных искусственных нейронов."),
+     ("Нейронные сети", "Класс моделей, обучаемых на данных с помощью обратного распространения ошибки.")),
+    (("Социальные сети", "Платформы для общения и обмена контентом между пользователями."),
+     ("Соцсети", "Соцсети влияют на распространение информации.")),
+    (("Математический анализ", ""), ("Матанализ", "")),
+    (("Градиентный спуск", "Итеративный метод поиска минимума функции по антиградиенту."),
+     ("градиентного спуска", "Метод оптимизации, используемый при обучении нейросетей.")),
+    (("Алгоритм Дейкстры", "Алгоритм поиска кратчайших путей во взвешенном графе."),
+     ("Алгоритмы Дейкстры", "")),
+    (("Машинное обучение", "Раздел искусственного интеллекта об алгоритмах, обучающихся на данных."),
+     ("машинное-обучение", "Обучение моделей на примерах.")),
+    (("Closure", "A function bundled with references to its surrounding state."),
+     ("Closures", "Closures capture variables from the enclosing scope.")),
+    (("Linked list", "A linear collection of nodes where each node points to the next."),
+     ("Linked lists", "")),
+    (("Фотосинтез", "Процесс образования органических веществ на свету."),
+     ("фотосинтеза", "Фотосинтез происходит в хлоропластах.")),
+]
+
+DISTINCT = [
+    (("Java", "Объектно-ориентированный язык программирования со статической типизацией."),
+     ("JavaScript", "Язык сценариев для веб-страниц.")),
+    (("Java", ""), ("JavaScript", "")),
+    (("SQL", "Декларативный язык запросов к реляционным базам данных."),
+     ("NoSQL", "Базы данных без реляционной модели.")),
+    (("SQL", ""), ("NoSQL", "")),
+    (("Закон Ома", "Сила тока пропорциональна напряжению и обратно пропорциональна сопротивлению."),
+     ("Закон Ома для полной цепи", "Учитывает внутреннее сопротивление источника тока.")),
+    (("Закон Ома", ""), ("Закон Ома для полной цепи", "")),
+    (("Windows 10", ""), ("Windows 11", "")),
+    (("Python 2", "Устаревшая версия языка Python."), ("Python 3", "Актуальная версия языка Python.")),
+    (("Python", ""), ("Python 3", "")),
+    (("Сети Петри", "Математическая модель дискретных распределенных систем."),
+     ("Нейронные сети", "Модели машинного обучения, вдохновленные устройством мозга.")),
+    (("Линейная регрессия", "Модель линейной зависимости целевой переменной от признаков."),
+     ("Логистическая регрессия", "Модель бинарной классификации на основе логистической функции.")),
+    (("Социальные сети", ""), ("Компьютерные сети", "")),
+    (("Граф", "Множество вершин и ребер между ними."), ("Графика", "Изображения, создаваемые на компьютере.")),
+    (("Кот", ""), ("Код", "")),
+    (("Процесс", "Экземпляр выполняемой программы."), ("Процессор", "Устройство, выполняющее инструкции.")),
+    (("Java", ""), ("Java EE", "")),
+    (("Квантовая механика", ""), ("Классическая механика", "")),
+    (("Теория графов", ""), ("Теория игр", "")),
+    (("HTTP", ""), ("HTTPS", "")),
+    (("C", ""), ("C++", "")),
+    (("Метод", ""), ("Методология", "")),
+    (("Первый закон Ньютона", ""), ("Второй закон Ньютона", "")),
+    # Короткая общая основа и "окончание", которое меняет слово
+    (("Plan", ""), ("Plane", "")),
+    (("Plan", "A detailed proposal for achieving a goal."), ("Plane", "A powered flying vehicle with fixed wings.")),
+    (("Note", ""), ("Not", "")),
+    (("Stat", ""), ("State", "")),
+    (("Кора", ""), ("Корм", "")),
+    (("Кора", "Наружный слой ствола дерева."), ("Корм", "Пища для домашних животных.")),
+    (("Лев", ""), ("Левый", "")),
+    (("Пар", ""), ("Пара", "")),
+    (("Вес", ""), ("Весы", "")),
+    # Совпавшие словоформы при совсем разных описаниях
+    (("Ключи", "Значения, по которым в словаре находят записи."), ("Ключ", "Родник, выходящий из-под земли.")),
+]
+
+
+def _node(label: str, summary: str) -> _Candidate:
+    return _Candidate(
+        id=label, label=label, summary=summary, degree=1, level=None,
+        label_features=label_trigrams(label), summary_features=summary_stems(summary),
+    )
+
+
+def _scores(pairs):
+    return [(a[0], b[0], score_pair(_node(*a), _node(*b))) for a, b in pairs]
+
+
+def main():
+    threshold = get_settings().dedup_merge_threshold
+    duplicates, distinct = _scores(DUPLICATES), _scores(DISTINCT)
+    for title, scores in (("duplicates", duplicates), ("distinct", distinct)):
+        print(title)
+        for a, b, score in scores:
+            print(f"  {score:.3f}  {a} / {b}")
+    print("threshold  recall  false merges")
+    for step in range(50, 100, 5):
+        t = step / 100
+        recall = sum(score >= t for _, _, score in duplicates) / len(duplicates)
+        false = sum(score >= t for _, _, score in distinct)
+        print(f"  {t:.2f}     {recall:.2f}    {false}")
+    assert threshold > 1 - SUMMARY_WEIGHT, "nodes with disjoint summaries must not merge on the label alone"
+    false_merges = [(a, b) for a, b, score in distinct if score >= threshold]
+    assert not false_merges, f"default threshold {threshold} merges distinct concepts: {false_merges}"
+    missed = [(a, b) for a, b, score in duplicates if score < threshold]
+    print(f"default threshold {threshold}: missed duplicates {missed}")
+
+
+if __name__ == "__main__":
+    main()
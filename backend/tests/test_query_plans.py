@@ -0,0 +1,34 @@
+"""
+Планы запросов Neo4j: ни один запрос тенанта не обходит метку :Node целиком.
+
+Нужен работающий Neo4j (настройки neo4j_* из окружения); без него тест
+планов пропускается.
+"""
+import pytest
+from app.db.migrations import apply_migrations, collect_queries, verify_query_plans
+from app.db.neo4j import get_neo4j_driver
+
+
+@pytest.fixture(scope="module")
+def neo4j_session():
+    driver = get_neo4j_driver()
+    try:
+        driver.verify_connectivity()
+    except Exception as e:
+        pytest.skip(f"Neo4j is not available: {e}")
+    with driver.session() as session:
+        apply_migrations(session)
+        yield session
+
+
+def test_queries_are_collected_from_code():
+    queries, _ = collect_queries()
+    texts = [" ".join(query.split()) for _, query in queries]
+    # f-строки с константами модуля раскрываются
+    assert any("(n)-[r:RELATED|contains|related_to]->(m:Node {user_id: $user_id})" in text for text in texts)
+    assert any(where.startswith("app.services.layout:") for where, _ in queries)
+    assert len(queries) >= 20
+
+
+def test_tenant_queries_use_indexes(neo4j_session):
+    assert verify_query_plans(neo4j_session) == []
@@ -7,7 +7,7 @@ import { Editor } from '../ui/Editor'
 import { GraphView } from '../ui/GraphView'
 import { NodeDetails } from '../ui/NodeDetails'
 import { NotesHistory } from '../ui/NotesHistory'
-import { analyzeNote, createNote, getNotes, deleteNote, Note, getAllGraph, GraphData, deleteNodes } from '../shared/api'
+import { analyzeNote, createNote, getNotes, deleteNote, Note, getAllGraph, GraphData, deleteNodes, subscribeEvents } from '../shared/api'
 import { Flash, Setting2, LogoutCurve, DocumentCopy, TickSquare, Trash } from 'iconsax-react'
 
 type Page = 'main' | 'settings'
@@ -65,6 +65,24 @@ export const App: React.FC = () => {
     loadData()
   }, [user, currentPage]) // Перезагружаем при возврате из настроек
 
+  // Изменения графа с других вкладок/устройств приходят по WebSocket,
+  // а getAllGraph подтягивает только дельту
+  useEffect(() => {
+    if (!user) return
+    return subscribeEvents(async (event) => {
+      if (event.type !== 'graph') return
+      const graphData = await getAllGraph()
+      setGraph({
+        nodes: graphData.nodes.map(n => ({
+          name: n.label,
+          tags: n.tags || [],
+          ...n
+        })),
+        links: graphData.links
+      })
+    })
+  }, [user])
+
   // Listen for Ctrl+Enter from Editor
   useEffect(() => {
     const handleEditorSubmit = () => {
@@ -11,11 +11,23 @@ axios.interceptors.request.use((config) => {
   return config;
 });
 
+// POST with an Idempotency-Key: a retry after a lost response replays the
+// stored result instead of creating a second note or LLM analysis
+async function postIdempotent(url: string, body: unknown, config: { params?: Record<string, unknown> } = {}) {
+  const headers = { 'Idempotency-Key': crypto.randomUUID() }
+  try {
+    return await axios.post(url, body, { ...config, headers })
+  } catch (error) {
+    if (!axios.isAxiosError(error) || error.response) throw error
+    return axios.post(url, body, { ...config, headers })
+  }
+}
+
 export type NoteCreate = { title: string; content: string; tags: string[] }
 
 export async function createNote(payload: NoteCreate) {
   try {
-    const { data } = await axios.post(`${API_URL}/notes/`, payload)
+    const { data } = await postIdempotent(`${API_URL}/notes/`, payload)
     return data
   } catch (error) {
     console.error('Error creating note:', error)
@@ -29,7 +41,7 @@ export async function searchNodes(q: string) {
       return []
     }
     const { data } = await axios.get(`${API_URL}/search/nodes`, { params: { q } })
-    return data || []
+    return data?.hits || []
   } catch (error) {
     console.error('Error searching nodes:', error)
     return []
@@ -41,7 +53,7 @@ export async function analyzeNote(content: string) {
     if (!content || content.trim().length < 10) {
       throw new Error('Content too short')
     }
-    const { data } = await axios.post(`${API_URL}/analyze/note`, null, {
+    const { data } = await postIdempotent(`${API_URL}/analyze/note`, null, {
       params: { content }
     })
     return data
@@ -86,6 +98,8 @@ export type GraphNode = {
   tags: string[]
   has_gap: boolean
   level?: number
+  x?: number
+  y?: number
 }
 
 export type GraphLink = {
@@ -99,11 +113,105 @@ export type GraphData = {
   links: GraphLink[]
 }
 
+// Компактный колоночный формат графа (см. backend/app/services/graph_codec.py)
+type ColumnarGraph = {
+  format: 'columnar-v1'
+  nodes: Record<string, any[]>
+  links: { source: number[]; target: number[]; relation: number[] }
+  relations: string[]
+}
+
+export function decodeColumnarGraph(payload: ColumnarGraph): GraphData {
+  const columns = Object.keys(payload.nodes)
+  const ids = payload.nodes.id || []
+  const nodes = ids.map((_, i) => {
+    const node: Record<string, any> = {}
+    for (const column of columns) {
+      const value = payload.nodes[column][i]
+      // null в x/y уложил бы узел в (0, 0): пусть такие раскладывает симуляция
+      if (value !== null || (column !== 'x' && column !== 'y')) {
+        node[column] = value
+      }
+    }
+    return node as GraphNode
+  })
+  const links = payload.links.source.map((source, i) => ({
+    source: ids[source],
+    target: ids[payload.links.target[i]],
+    relation: payload.relations[payload.links.relation[i]],
+  }))
+  return { nodes, links }
+}
+
+// Изменения графа после seq (см. backend/app/services/changelog.py)
+type GraphChanges = {
+  seq: number
+  reset: boolean
+  has_more: boolean
+  nodes: GraphNode[]
+  deleted_nodes: string[]
+  links: GraphLink[]
+  deleted_links: GraphLink[]
+}
+
+// Локальная копия графа: после первой полной загрузки подтягиваются только изменения
+type GraphCache = {
+  token: string | null
+  seq: number
+  nodes: Map<string, GraphNode>
+  links: Map<string, GraphLink>
+}
+
+let graphCache: GraphCache | null = null
+
+const linkKey = (link: GraphLink) => `${link.source}\t${link.target}\t${link.relation}`
+
+async function loadFullGraph(token: string | null): Promise<GraphCache> {
+  const response = await axios.get(`${API_URL}/graph/all`, { params: { format: 'compact' } })
+  const graph = response.data ? decodeColumnarGraph(response.data) : { nodes: [], links: [] }
+  return {
+    token,
+    seq: Number(response.headers['x-graph-seq'] || 0),
+    nodes: new Map(graph.nodes.map(n => [n.id, n])),
+    links: new Map(graph.links.map(l => [linkKey(l), l])),
+  }
+}
+
+// Применяет /graph/changes к кэшу; false - журнал сжат, нужна полная загрузка
+async function applyGraphChanges(cache: GraphCache): Promise<boolean> {
+  for (;;) {
+    const { data } = await axios.get<GraphChanges>(`${API_URL}/graph/changes`, { params: { since: cache.seq } })
+    if (data.reset) return false
+    for (const id of data.deleted_nodes) {
+      cache.nodes.delete(id)
+    }
+    if (data.deleted_nodes.length) {
+      const deleted = new Set(data.deleted_nodes)
+      for (const [key, link] of cache.links) {
+        if (deleted.has(link.source) || deleted.has(link.target)) cache.links.delete(key)
+      }
+    }
+    for (const link of data.deleted_links) cache.links.delete(linkKey(link))
+    for (const node of data.nodes) cache.nodes.set(node.id, node)
+    for (const link of data.links) cache.links.set(linkKey(link), link)
+    cache.seq = data.seq
+    if (!data.has_more) return true
+  }
+}
+
 export async function getAllGraph(): Promise<GraphData> {
   try {
-    const { data } = await axios.get(`${API_URL}/graph/all`)
-    return data || { nodes: [], links: [] }
+    const token = localStorage.getItem('token')
+    if (!graphCache || graphCache.token !== token || !(await applyGraphChanges(graphCache))) {
+      graphCache = await loadFullGraph(token)
+    }
+    // Копии: граф-вью дописывает в узлы и связи свои поля (x/y, объекты source/target)
+    return {
+      nodes: Array.from(graphCache.nodes.values(), n => ({ ...n })),
+      links: Array.from(graphCache.links.values(), l => ({ ...l })),
+    }
   } catch (error) {
+    graphCache = null
     console.error('Error fetching graph:', error)
     return { nodes: [], links: [] }
   }
@@ -145,4 +253,48 @@ export async function deleteNodes(nodeIds: string[]): Promise<void> {
     console.error('Error deleting nodes:', error)
     throw error
   }
-}
\ No newline at end of file
+}
+
+// Push-события сервера: изменения графа и ход анализа (см. backend/app/services/realtime.py)
+export type ServerEvent =
+  | { type: 'graph'; upserted_nodes?: string[]; deleted_nodes?: string[]; truncated?: boolean }
+  | { type: 'analysis'; stage: string; note_id?: string; [key: string]: any }
+
+export function subscribeEvents(onEvent: (event: ServerEvent) => void): () => void {
+  let socket: WebSocket | null = null
+  let retry: ReturnType<typeof setTimeout> | null = null
+  let closed = false
+  let delay = 1000
+
+  const connect = () => {
+    const token = localStorage.getItem('token')
+    if (!token || closed) return
+    const url = new URL('/ws', API_URL)
+    url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:'
+    url.searchParams.set('token', token)
+    socket = new WebSocket(url.toString())
+    socket.onopen = () => { delay = 1000 }
+    socket.onmessage = (message) => {
+      if (message.data === 'pong') return
+      try {
+        onEvent(JSON.parse(message.data))
+      } catch (error) {
+        console.error('Bad server event:', error)
+      }
+    }
+    socket.onclose = () => {
+      if (closed) return
+      // Переподключение с растущей задержкой (до 30 с)
+      retry = setTimeout(connect, delay)
+      delay = Math.min(delay * 2, 30000)
+    }
+  }
+
+  connect()
+  return () => {
+    closed = true
+    if (retry) clearTimeout(retry)
+    socket?.close()
+  }
+}
+
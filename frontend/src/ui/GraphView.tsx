@@ -141,7 +141,9 @@ export const GraphView: React.FC<GraphViewProps> = ({ data, onSelectNode, highli
       }
 
       // Применяем сохраненные позиции к новым данным
-      const updatedNodes = data.nodes.map((node: any) => {
+      const updatedNodes = data.nodes.map((raw: any) => {
+        // x/y: null (узел еще не разложен сервером) d3 понял бы как (0, 0)
+        const node = raw.x == null || raw.y == null ? { ...raw, x: undefined, y: undefined } : raw
         // Сначала проверяем текущие позиции из graphData
         const currentPos = nodePositions.get(node.id)
         if (currentPos) {
@@ -400,6 +402,12 @@ export const GraphView: React.FC<GraphViewProps> = ({ data, onSelectNode, highli
   }, [renderKey])
 
   // Создаем уникальный ключ для принудительного ререндера
+  // Координаты уже посчитаны сервером - симуляцию не крутим
+  const preLaidOut = useMemo(
+    () => !!graphData?.nodes?.length && graphData.nodes.every((n: any) => typeof n.x === 'number' && typeof n.y === 'number'),
+    [graphData]
+  )
+
   const graphKey = useMemo(() => {
     return `${renderKey}-${graphData?.nodes?.length || 0}-${graphData?.links?.length || 0}`
   }, [renderKey, graphData?.nodes?.length, graphData?.links?.length])
@@ -450,7 +458,7 @@ export const GraphView: React.FC<GraphViewProps> = ({ data, onSelectNode, highli
         linkDirectionalArrowLength={6}
         linkDirectionalArrowRelPos={1}
         linkColor={getLinkColor}
-        cooldownTicks={100}
+        cooldownTicks={preLaidOut ? 0 : 100}
         d3AlphaDecay={0.0228}
         d3AlphaMin={0.001}
         onEngineStop={() => {